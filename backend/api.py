@@ -1,18 +1,24 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import partial
+import json
 import os
 from pathlib import Path
 import shutil
-import time
-from typing import Dict
+from typing import Literal
 import requests
 from enum import Enum
 import logging
 import uuid
 
-from scripts import download_with_retry, load_data
-from sec_json import transform_to_json
+from job_executor import JobExecutor
+from jobs import download_job, sleep_job, transform_job, zip_version
+from scripts import load_data
+from task_store import open_task_store
+from warehouse import Warehouse, pool_options
 
-from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
@@ -21,7 +27,27 @@ load_dotenv(".env")
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="FastAPI Backend", version="0.1.0")
+# Jobs of each type that may run at once; a transform already keeps every
+# core busy. The limits are counted in the task store, so with a shared
+# TASK_STORE they hold across API workers; with the in-memory store each
+# worker counts only its own jobs.
+JOB_LIMITS = {"download": 2, "transform": 1, "long_running_task": 2}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Log in to Snowflake before serving, so the first queries do not wait
+    try:
+        connections = await asyncio.to_thread(warehouse.warm_up)
+        logger.info(f"Warmed up {connections} Snowflake connections")
+    except Exception as e:
+        logger.warning(f"Snowflake warm-up failed: {e}")
+    yield
+    jobs.shutdown()
+    warehouse.close()
+
+
+app = FastAPI(title="FastAPI Backend", version="0.1.0", lifespan=lifespan)
 
 SNOWFLAKE_URL = (
     "snowflake://{user}:{password}@{account}/{db}/{schema}?{wh}={wh}&role={role}"
@@ -40,42 +66,55 @@ class QueryRequest(BaseModel):
     sql: str
 
 
-class task(BaseModel):
-    name: str
-    status: str
-
-
 class Conf(BaseModel):
     quarter: int
     year: int
 
 
+class TransformRequest(BaseModel):
+    """Query parameters of /json/transform; the choices are those of
+    sec_json.transform_quarter, so a bad one is rejected before queueing"""
+
+    year: int
+    quarter: int
+    mode: Literal["full", "incremental", "resume"] = "incremental"
+    labels: Literal["inline", "dictionary"] = "inline"
+    output: Literal["json", "ndjson", "parquet"] = "json"
+    facts: Literal["all", "primary"] = "all"
+    other_contexts: bool = False
+    priority: int = 0
+
+
 class Dags(Enum):
     json_transformation = "json"
     sec_data_pipeline = "normalized"
     snow = "denormalized"
 
 
-tasks: Dict[uuid.UUID, task] = {}
+# Tasks are kept in memory by default; TASK_STORE=sqlite:///./tasks.db keeps
+# them across restarts and shares them between API worker processes
+tasks = open_task_store(os.getenv("TASK_STORE") or "memory")
+jobs = JobExecutor(tasks, limits=JOB_LIMITS)
 
 
 AIRFLOW_URL = "http://{airflow_host}/api/v1".format(
     airflow_host=os.getenv("AIRFLOW_URL", "127.0.0.1:8080")
 )
 
-engine = create_engine(SNOWFLAKE_URL)
-
-
-def download_task(task_id: uuid.UUID, year: int, quarter: int):
-    tasks[task_id] = task(name="download", status="running")
-    flag = download_with_retry(year=year, quarter=quarter)
-    tasks[task_id] = task(name="download", status="success" if flag else "failed")
-
-
-def transform_task(task_id: uuid.UUID, year: int, quarter: int):
-    tasks[task_id] = task(name="transform", status="running")
-    flag = transform_to_json(year=year, quarter=quarter)
-    tasks[task_id] = task(name="transform", status="success" if flag else "failed")
+# Connections stay logged in for the life of the API; SNOWFLAKE_POOL_SIZE of
+# them are opened at startup, and queries run in as many threads as there
+# can be connections
+SNOWFLAKE_POOL_SIZE = int(os.getenv("SNOWFLAKE_POOL_SIZE") or 5)
+SNOWFLAKE_MAX_OVERFLOW = int(os.getenv("SNOWFLAKE_MAX_OVERFLOW") or 5)
+engine = create_engine(
+    SNOWFLAKE_URL,
+    **pool_options(
+        pool_size=SNOWFLAKE_POOL_SIZE,
+        max_overflow=SNOWFLAKE_MAX_OVERFLOW,
+        recycle_seconds=int(os.getenv("SNOWFLAKE_POOL_RECYCLE") or 3600),
+    ),
+)
+warehouse = Warehouse(engine, max_workers=SNOWFLAKE_POOL_SIZE + SNOWFLAKE_MAX_OVERFLOW)
 
 
 @app.get("/")
@@ -134,43 +173,79 @@ def get_airflow_dagruns(dag_id: Dags):
 
 
 @app.post("/snowflake/execute")
-def execute_snowflake_query(query: QueryRequest):
+async def execute_snowflake_query(query: QueryRequest):
     """
-    Execute a SQL query on Snowflake.
+    Execute a SQL query on Snowflake, on a pooled connection.
     """
     try:
-        connection = engine.connect()
-        print("Successfully connected to Snowflake")
-        result = connection.execute(query.sql)
-        print("Successfully executed query")
-        return result.fetchall()
+        return await warehouse.execute(query.sql)
     except Exception as e:
         return {"error": str(e)}
-    finally:
-        connection.close()
-        engine.dispose()
+
+
+@app.get("/snowflake/metrics", status_code=200)
+def get_snowflake_metrics():
+    """
+    Query counts and latency percentiles in milliseconds, and the
+    connection pool's state
+    """
+    return {**warehouse.metrics.to_dict(), "pool": warehouse.pool_status()}
 
 
 @app.get("/json/download", status_code=200)
-def download_json(year: int, quarter: int, background_tasks: BackgroundTasks):
+def download_json(year: int, quarter: int, priority: int = 0):
     """
-    Download and extract SEC data for a specific year and quarter
+    Download and extract SEC data for a specific year and quarter; queued
+    jobs with a higher priority start first. Requests for a quarter being
+    downloaded, or already downloaded, get the task id of that download.
     """
-    task_id = uuid.uuid4()
-    background_tasks.add_task(
-        download_task, task_id=task_id, year=year, quarter=quarter
+    task_id = jobs.submit(
+        "download",
+        download_job,
+        year=year,
+        quarter=quarter,
+        priority=priority,
+        key=f"download:{year}q{quarter}",
+        version=partial(zip_version, year, quarter),
+        produces_version=True,
     )
     return {"task_id": task_id}
 
 
 @app.get("/json/transform", status_code=200)
-def transform_json(year: int, quarter: int, background_tasks: BackgroundTasks):
+def transform_json(request: TransformRequest = Depends()):
     """
-    transform data to JSON
+    transform data to JSON; mode is "incremental", "resume" or "full",
+    output is "json", "ndjson" or "parquet" (a long-format fact table),
+    labels is "inline" or "dictionary" (label ids plus labels.jsonl),
+    facts is "all" or "primary" (only the filing's own context), with the
+    other facts under "otherContexts" when other_contexts is true; queued
+    jobs with a higher priority start first. Requests with the same options
+    as a transform of the quarter in progress, or done since its zip last
+    changed, get the task id of that transform.
     """
-    task_id = uuid.uuid4()
-    background_tasks.add_task(
-        transform_task, task_id=task_id, year=year, quarter=quarter
+    if request.other_contexts and request.output == "parquet":
+        raise HTTPException(
+            status_code=422,
+            detail="other_contexts is not supported with output='parquet'",
+        )
+    year, quarter = request.year, request.quarter
+    options = {
+        "mode": request.mode,
+        "output": request.output,
+        "labels": request.labels,
+        "facts": request.facts,
+        "other_contexts": request.other_contexts,
+    }
+    task_id = jobs.submit(
+        "transform",
+        transform_job,
+        priority=request.priority,
+        key=f"transform:{year}q{quarter}:{json.dumps(options, sort_keys=True)}",
+        version=partial(zip_version, year, quarter),
+        year=year,
+        quarter=quarter,
+        **options,
     )
     return {"task_id": task_id}
 
@@ -202,25 +277,28 @@ def cleanup_json():
 @app.get("/task", status_code=200)
 def get_task(task_id: uuid.UUID):
     """
-    Get task status
+    Get task status, with its progress in percent, timestamps and error
     """
-    return {"status": tasks[task_id].status if task_id in tasks else "not found"}
+    task = tasks.get(task_id)
+    return task if task is not None else {"status": "not found"}
 
 
-@app.get("/longrunningtask", status_code=200)
-def create_long_running_task(duration: int, background_tasks: BackgroundTasks):
+@app.delete("/task", status_code=200)
+def cancel_task(task_id: uuid.UUID):
     """
-    Long running task
+    Cancel a task: a queued task is dropped, a running one stops at its next
+    progress update
     """
-    task_id = uuid.uuid4()
-    background_tasks.add_task(long_running_task, task_id=task_id, duration=duration)
-    return {"task_id": task_id}
+    task = jobs.cancel(task_id)
+    return task if task is not None else {"status": "not found"}
 
 
-def long_running_task(task_id: uuid.UUID, duration: int):
+@app.get("/longrunningtask", status_code=200)
+def create_long_running_task(duration: int, priority: int = 0):
     """
     Long running task
     """
-    tasks[task_id] = task(name="long_running_task", status="running")
-    time.sleep(duration)
-    tasks[task_id] = task(name="long_running_task", status="success")
+    task_id = jobs.submit(
+        "long_running_task", sleep_job, duration=duration, priority=priority
+    )
+    return {"task_id": task_id}
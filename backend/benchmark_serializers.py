@@ -0,0 +1,71 @@
+"""Compare JSON serializer throughput on the documents of a real quarter.
+
+Run from the backend directory with the quarter's zip and ticker.txt in
+./data, e.g. python benchmark_serializers.py 2024 4
+"""
+
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from sec_export import SERIALIZERS, get_serializer
+from sec_io import load_quarter, load_symbol_index
+from sec_json import transform_vectorized
+
+
+def benchmark(documents, serializer, repeat: int = 3) -> tuple:
+    """Best-of-repeat (seconds, bytes) to serialize every document"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total = sum(len(serializer.dumps(document)) for document in documents)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("year", type=int)
+    parser.add_argument("quarter", type=int)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    base_path = Path("./data")
+    dirname = f"{args.year}q{args.quarter}"
+
+    tables = load_quarter(
+        base_path / f"{dirname}.zip", cache_dir=base_path / "cache" / dirname
+    )
+    dfNum = tables["num"].dropna(subset=["value"])
+    documents = [
+        result
+        for _, result in transform_vectorized(
+            dfNum,
+            tables["pre"],
+            tables["sub"],
+            tables["tag"],
+            load_symbol_index(base_path / "ticker.txt", base_path / "cache"),
+            logger,
+        )
+        if result is not None
+    ]
+    print(f"{dirname}: {len(documents)} documents")
+
+    for name in SERIALIZERS[1:]:
+        try:
+            serializer = get_serializer(name)
+        except ImportError:
+            print(f"{name:>8}: not installed")
+            continue
+        seconds, total = benchmark(documents, serializer, args.repeat)
+        print(
+            f"{name:>8}: {total / 1e6:.1f} MB in {seconds:.2f}s "
+            f"({total / seconds / 1e6:.1f} MB/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Benchmark transform_to_json and process_submission on synthetic quarters.
+
+Generates a dataset per scale factor (sec_synthetic), times each case in a
+fresh process and reports num rows/sec and peak RSS, e.g.
+python benchmark_transform.py --scales 1 10 100 --baseline baseline.json
+
+With --baseline the run fails (exit status 1) when a case is more than
+--tolerance slower, or uses that much more memory, than the stored result;
+--update-baseline stores this run's results instead.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from sec_report import children_peak_rss_mb, current_peak_rss_mb
+
+YEAR, QUARTER = 2023, 1
+CASES = ("transform_to_json", "process_submission")
+MIN_SECONDS = 1.0
+MAX_PASSES = 5
+
+
+def _time_transform(options: Dict) -> tuple:
+    from sec_json import transform_quarter
+
+    start = time.perf_counter()
+    # Without per-stage resets, so the process's peak RSS covers the run
+    result = transform_quarter(YEAR, QUARTER, mode="full", stage_peaks=False, **options)
+    return time.perf_counter() - start, result["facts"]
+
+
+def _time_process_submission() -> tuple:
+    from sec_io import load_quarter, load_symbol_index
+    from sec_json import build_pre_dict, partition_by_adsh, process_submission
+
+    tables = load_quarter(Path("./data") / f"{YEAR}q{QUARTER}.zip")
+    dfNum, ranges = partition_by_adsh(tables["num"].dropna(subset=["value"]))
+    dfPre_dict = build_pre_dict(tables["pre"])
+    dfTag_dict = dict(zip(tables["tag"]["tag"], tables["tag"]["doc"]))
+    # Resolved once, outside the timed loop: callers pass a plain dict
+    ciks = tables["sub"]["cik"]
+    symbols = load_symbol_index(Path("./data") / "ticker.txt").resolve(ciks)
+    symbol_dict = {
+        str(cik): symbol for cik, symbol in zip(ciks, symbols) if symbol is not None
+    }
+    submissions = tables["sub"].to_dict("records")
+    logger = logging.getLogger("benchmark")
+    logger.disabled = True
+
+    # Fastest of several passes; a single pass is too short to time reliably
+    # at small scales
+    passes, elapsed = [], 0.0
+    while len(passes) < MAX_PASSES and elapsed < MIN_SECONDS:
+        start = time.perf_counter()
+        for submission in submissions:
+            begin, end = ranges.get(submission["adsh"], (0, 0))
+            process_submission(
+                submission,
+                dfNum.iloc[begin:end],
+                dfPre_dict,
+                dfTag_dict,
+                symbol_dict,
+                logger,
+            )
+        passes.append(time.perf_counter() - start)
+        elapsed += passes[-1]
+    return min(passes), len(dfNum)
+
+
+def run_case(case: str, workdir: Path, options: Dict) -> Dict:
+    """Run one case with workdir as the working directory; meant to be the
+    only thing a fresh process does, so its peak RSS is the case's own"""
+    logging.disable(logging.WARNING)
+    # This process was spawned; let the transform's own pool use the
+    # platform default start method, as it does in production
+    multiprocessing.set_start_method(None, force=True)
+    os.chdir(workdir)
+    if case == "transform_to_json":
+        seconds, rows = _time_transform(options)
+    else:
+        seconds, rows = _time_process_submission()
+    return {
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / max(seconds, 1e-9), 1),
+        # This process plus the largest of its finished children
+        "peak_rss_mb": round(current_peak_rss_mb() + children_peak_rss_mb(), 1),
+    }
+
+
+def prepare(root: Path, scale: float, seed: int) -> Path:
+    """Working directory with a generated quarter for scale, reused when
+    it already exists"""
+    from sec_synthetic import generate_dataset
+
+    workdir = root / f"scale-{scale:g}-seed-{seed}"
+    if not (workdir / "data" / f"{YEAR}q{QUARTER}.zip").is_file():
+        generate_dataset(workdir / "data", [(YEAR, QUARTER)], scale, seed)
+    return workdir
+
+
+def run_benchmarks(
+    scales: List[float], root: Path, seed: int = 0, options: Dict | None = None
+) -> Dict[str, Dict]:
+    results = {}
+    spawn = multiprocessing.get_context("spawn")
+    for scale in scales:
+        workdir = prepare(root, scale, seed)
+        for case in CASES:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                results[f"{case}@{scale:g}x"] = executor.submit(
+                    run_case, case, workdir.resolve(), options or {}
+                ).result()
+    return results
+
+
+def regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Cases slower, or with a higher peak RSS, than baseline by more than
+    tolerance (a fraction)"""
+    failures = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["rows_per_sec"] < expected["rows_per_sec"] * (1 - tolerance):
+            failures.append(
+                f"{name}: {result['rows_per_sec']:.0f} rows/s, "
+                f"baseline {expected['rows_per_sec']:.0f}"
+            )
+        if result["peak_rss_mb"] > expected["peak_rss_mb"] * (1 + tolerance):
+            failures.append(
+                f"{name}: peak RSS {result['peak_rss_mb']:.0f} MB, "
+                f"baseline {expected['peak_rss_mb']:.0f}"
+            )
+    return failures
+
+
+def format_results(results: Dict) -> str:
+    lines = [f"{'case':<28} {'rows':>10} {'seconds':>8} {'rows/s':>12} {'RSS MB':>8}"]
+    for name, result in results.items():
+        lines.append(
+            f"{name:<28} {result['rows']:>10} {result['seconds']:>8.2f} "
+            f"{result['rows_per_sec']:>12.0f} {result['peak_rss_mb']:>8.0f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default="pool")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "sec_benchmark",
+        help="where generated datasets are kept between runs",
+    )
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    options = {"engine": args.engine, "max_workers": args.workers, "cache": False}
+    results = run_benchmarks(args.scales, args.workdir, args.seed, options)
+    print(format_results(results))
+
+    if args.baseline is None:
+        return
+    if args.update_baseline:
+        stored = (
+            json.loads(args.baseline.read_text()) if args.baseline.is_file() else {}
+        )
+        args.baseline.write_text(json.dumps({**stored, **results}, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    failures = regressions(
+        results, json.loads(args.baseline.read_text()), args.tolerance
+    )
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
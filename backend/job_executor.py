@@ -0,0 +1,310 @@
+"""Runs the API's jobs in worker processes, away from request handling.
+
+Jobs wait in a priority queue until their job type has a free slot (see
+JobExecutor), then each runs in a process of its own, started with
+"spawn": a long transform neither holds the API process's GIL nor
+inherits its threads. A job function is called as
+function(context, *args, **kwargs) and reports progress and notices
+cancellation through its JobContext. Task status lives in a task store
+(see task_store), so every API worker sharing the store can serve it.
+"""
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from typing import Dict
+
+from task_store import TaskStore
+
+
+class JobCancelled(Exception):
+    """Raised in a job that has been asked to stop"""
+
+
+class JobContext:
+    """A running job's link to the executor that started it"""
+
+    def __init__(self, conn, cancel):
+        self._conn = conn
+        self._cancel = cancel
+
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check(self) -> None:
+        """Raise JobCancelled if the job has been asked to stop"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def progress(self, percent: float) -> None:
+        """Record the job's progress, then check for cancellation"""
+        self._conn.send(("progress", percent))
+        self.check()
+
+
+def _run_job(function, args, kwargs, conn, cancel) -> None:
+    logging.basicConfig(level=logging.INFO)
+    try:
+        function(JobContext(conn, cancel), *args, **kwargs)
+    except JobCancelled:
+        conn.send(("cancelled", None))
+    except Exception as e:
+        logging.getLogger(__name__).exception("Job failed")
+        conn.send(("failed", str(e) or type(e).__name__))
+    else:
+        conn.send(("success", None))
+    finally:
+        conn.close()
+
+
+class JobExecutor:
+    """Runs jobs in separate processes, at most limits[job_type] of a type
+    at a time (default_limit for types without a limit). The limits are
+    counted in the task store (see TaskStore.claim), so they hold across
+    every executor sharing it as long as all use the same limits; a slot
+    taken in another executor frees up here within poll_seconds.
+
+    Waiting jobs start highest priority first, in submission order within
+    a priority. Cancelling a waiting job drops it; a running job is asked
+    to stop and ends as "cancelled" when its function next calls
+    context.check() or context.progress(). A cancel request made through
+    another executor sharing the task store (another API worker) is seen
+    within poll_seconds.
+
+    Jobs submitted with a key are single-flight: while a job of the key is
+    waiting or running, in this executor or any other sharing the store,
+    submitting again returns its task id, and so does submitting after it
+    succeeded as long as version() still returns what it did when the job
+    was submitted: a job that read inputs which changed while it ran is not
+    reused. A job that produces what version() describes (say, downloads
+    the zip) is submitted with produces_version=True and is instead reused
+    while version() returns what it did when the job finished. Queued and running jobs are touched in the store every
+    poll_seconds; one left untouched for stale_polls polls belonged to an
+    executor that is gone, and is replaced.
+    """
+
+    def __init__(
+        self,
+        store: TaskStore,
+        limits: Dict[str, int] | None = None,
+        default_limit: int = 1,
+        poll_seconds: float = 1.0,
+        stale_polls: int = 30,
+    ):
+        self.store = store
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.poll_seconds = poll_seconds
+        self.stale_seconds = stale_polls * poll_seconds
+        self._mp = multiprocessing.get_context("spawn")
+        self._queue = []
+        self._order = itertools.count()
+        self._running: Dict[str, Dict] = {}
+        self._condition = threading.Condition()
+        self._scheduler = None
+        self._closed = False
+
+    def submit(
+        self,
+        job_type: str,
+        function,
+        *args,
+        priority: int = 0,
+        key: str | None = None,
+        version=None,
+        produces_version: bool = False,
+        **kwargs,
+    ) -> str:
+        """Queue function(context, *args, **kwargs) as a job of job_type and
+        return its task id; function must be importable by the job process.
+        key, version (a function returning a string, or None) and
+        produces_version coalesce duplicate jobs, see JobExecutor."""
+        task_id = str(uuid.uuid4())
+        task = self.store.create(
+            task_id,
+            job_type,
+            key=key,
+            version=version() if version is not None else None,
+            stale_seconds=self.stale_seconds,
+        )
+        if task["task_id"] != task_id:
+            return task["task_id"]
+
+        job = {
+            "task_id": task_id,
+            "job_type": job_type,
+            "function": function,
+            "args": args,
+            "kwargs": kwargs,
+            # Otherwise the version the task was created with stands
+            "version": version if produces_version else None,
+        }
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The job executor is shut down")
+            heapq.heappush(self._queue, (-priority, next(self._order), job))
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(
+                    target=self._schedule, name="job-scheduler", daemon=True
+                )
+                self._scheduler.start()
+            self._condition.notify_all()
+        return task_id
+
+    def cancel(self, task_id) -> Dict | None:
+        """Cancel a job; returns its task, or None if it is unknown"""
+        task_id = str(task_id)
+        with self._condition:
+            for entry in self._queue:
+                if entry[2]["task_id"] == task_id:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    return self.store.update(
+                        task_id, if_status=("pending",), status="cancelled"
+                    )
+            running = self._running.get(task_id)
+            if running is not None:
+                running["cancel"].set()
+                # The job may have finished meanwhile; its status stands
+                return self.store.update(
+                    task_id, if_status=("running",), status="cancelling"
+                )
+
+        # Waiting for or running in another executor sharing the store, which
+        # may start or finish it at any moment
+        task = self.store.update(task_id, if_status=("pending",), status="cancelled")
+        if task is None or task["status"] != "running":
+            return task
+        return self.store.update(task_id, if_status=("running",), status="cancelling")
+
+    def running(self) -> Dict[str, int]:
+        """Number of running jobs by job type"""
+        counts = {}
+        with self._condition:
+            for job in self._running.values():
+                counts[job["job_type"]] = counts.get(job["job_type"], 0) + 1
+        return counts
+
+    def _limit(self, job_type: str) -> int:
+        return self.limits.get(job_type, self.default_limit)
+
+    def _has_slot(self, job_type: str) -> bool:
+        """Whether this executor alone leaves job_type a slot, so it is worth
+        asking the store for one"""
+        running = sum(job["job_type"] == job_type for job in self._running.values())
+        return running < self._limit(job_type)
+
+    def _next_job(self) -> Dict | None:
+        """The first queued job the store lets start, now running"""
+        full = set()
+        for entry in sorted(self._queue):
+            job = entry[2]
+            if job["job_type"] in full:
+                continue
+            if not self._has_slot(job["job_type"]):
+                full.add(job["job_type"])
+                continue
+            task = self.store.claim(
+                job["task_id"], self._limit(job["job_type"]), self.stale_seconds
+            )
+            if task is not None and task["status"] == "pending":
+                # Every slot of the type is taken, here or in another executor
+                full.add(job["job_type"])
+                continue
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            if task is None or task["status"] != "running":
+                # Cancelled through another executor sharing the store
+                continue
+            return job
+        return None
+
+    def _schedule(self) -> None:
+        with self._condition:
+            while not self._closed:
+                job = self._next_job()
+                if job is not None:
+                    self._start(job)
+                elif not self._condition.wait(self.poll_seconds):
+                    for _, _, queued in self._queue:
+                        self.store.update(queued["task_id"])
+
+    def _start(self, job: Dict) -> None:
+        receiver, sender = self._mp.Pipe(duplex=False)
+        cancel = self._mp.Event()
+        process = self._mp.Process(
+            target=_run_job,
+            args=(job["function"], job["args"], job["kwargs"], sender, cancel),
+            name=f"job-{job['task_id']}",
+        )
+        process.start()
+        sender.close()
+        self._running[job["task_id"]] = {
+            "job_type": job["job_type"],
+            "process": process,
+            "cancel": cancel,
+        }
+        threading.Thread(
+            target=self._monitor,
+            args=(job["task_id"], process, receiver, cancel, job["version"]),
+            name=f"job-monitor-{job['task_id']}",
+            daemon=True,
+        ).start()
+
+    def _monitor(self, task_id: str, process, receiver, cancel, version) -> None:
+        status, error = None, None
+        try:
+            while status is None:
+                if not receiver.poll(self.poll_seconds):
+                    task = self.store.update(task_id)
+                    if task is not None and task["status"] == "cancelling":
+                        cancel.set()
+                    continue
+                try:
+                    kind, value = receiver.recv()
+                except EOFError:
+                    break
+                if kind == "progress":
+                    self.store.update(task_id, progress=value)
+                else:
+                    status, error = kind, value
+        finally:
+            process.join()
+            receiver.close()
+            if status is None:
+                status = "failed"
+                error = f"Job process exited with code {process.exitcode}"
+            fields = {"status": status, "error": error}
+            if status == "success" and version is not None:
+                # What a later job of the key must find to reuse this one
+                fields["version"] = version()
+            self.store.update(task_id, **fields)
+            with self._condition:
+                del self._running[task_id]
+                self._condition.notify_all()
+
+    def shutdown(self, wait_seconds: float = 10.0) -> None:
+        """Cancel every job, give running ones wait_seconds to stop and
+        terminate those that do not"""
+        with self._condition:
+            self._closed = True
+            for _, _, job in self._queue:
+                self.store.update(
+                    job["task_id"], if_status=("pending",), status="cancelled"
+                )
+            self._queue.clear()
+            running = list(self._running.values())
+            for job in running:
+                job["cancel"].set()
+            self._condition.notify_all()
+
+        deadline = time.monotonic() + wait_seconds
+        for job in running:
+            job["process"].join(max(0.0, deadline - time.monotonic()))
+            if job["process"].is_alive():
+                job["process"].terminate()
+                job["process"].join()
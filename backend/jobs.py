@@ -0,0 +1,50 @@
+"""The API's jobs, run in job processes by job_executor.JobExecutor"""
+
+import time
+from pathlib import Path
+from typing import Dict
+
+from scripts import download_with_retry
+from sec_io import file_sha256
+from sec_json import transform_to_json
+
+# SHA-256 of each zip by path, with the stat it was computed for
+_zip_hashes: Dict[Path, tuple] = {}
+
+
+def zip_version(year: int, quarter: int) -> str | None:
+    """SHA-256 of a quarter's zip in ./data, None while it is missing: jobs
+    that read it are reused until its content changes. The zip is hashed
+    again only when its size, mtime, ctime or inode change; a copy put in
+    its place always changes the ctime or inode, even one keeping the
+    size and mtime."""
+    path = Path("./data") / f"{year}q{quarter}.zip"
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino)
+    cached = _zip_hashes.get(path)
+    if cached is None or cached[0] != signature:
+        cached = signature, file_sha256(path)
+        _zip_hashes[path] = cached
+    return cached[1]
+
+
+def download_job(context, year: int, quarter: int) -> None:
+    context.check()
+    if not download_with_retry(year=year, quarter=quarter):
+        raise RuntimeError(f"Download of {year}q{quarter} failed")
+
+
+def transform_job(context, year: int, quarter: int, **options) -> None:
+    """Transform a quarter; cancelling takes effect at the next whole
+    percent of its submissions processed"""
+    context.check()
+    transform_to_json(year=year, quarter=quarter, progress=context.progress, **options)
+
+
+def sleep_job(context, duration: int) -> None:
+    for second in range(duration):
+        context.progress(100 * second / duration)
+        time.sleep(1)
@@ -1,3 +1,4 @@
+import json
 import os
 import time
 import requests
@@ -85,6 +86,40 @@ def download_with_retry(year, quarter, logger=None):
 #         raise
 
 
+def export_output(json_directory):
+    """How the quarter was last exported, from where its manifest puts the
+    documents: "parquet" (a table), "ndjson" (a shard) or "json" (a file,
+    also assumed without a manifest). Files of an earlier export with
+    another output may still be around."""
+    manifest = Path(json_directory) / "manifest.jsonl"
+    if manifest.exists():
+        with open(manifest) as f:
+            first = f.readline()
+        if first:
+            entry = json.loads(first)
+            if "table" in entry:
+                return "parquet"
+            if "shard" in entry:
+                return "ndjson"
+    return "json"
+
+
+def manifest_shards(json_directory):
+    """The NDJSON shards the manifest lists, in order: shard-*.ndjson, or
+    part-<i>-of-<n>-*.ndjson from a sharded run. Any other shard on disk
+    holds no current document."""
+    shards = {}
+    with open(Path(json_directory) / "manifest.jsonl") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn by a crash
+                continue
+            shards[entry["shard"]] = True
+    return list(shards)
+
+
 def load_data(year=2023, quarter=4, logger=None):
     if logger is None:
         logger = logging.getLogger(__name__)
@@ -104,6 +139,30 @@ def load_data(year=2023, quarter=4, logger=None):
     CREATE_STAGE = """CREATE STAGE IF NOT EXISTS json_stage
     FILE_FORMAT = my_json_format;
     """
+    CREATE_PARQUET_FILE_FORMAT = """
+    CREATE FILE FORMAT IF NOT EXISTS my_parquet_format
+    TYPE = 'PARQUET';
+    """
+    CREATE_FACTS_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS facts_{year}Q{quarter} (
+        symbol VARCHAR,
+        adsh VARCHAR,
+        year INTEGER,
+        quarter VARCHAR,
+        startDate DATE,
+        endDate DATE,
+        stmt VARCHAR,
+        concept VARCHAR,
+        label_id INTEGER,
+        unit VARCHAR,
+        value NUMBER(38, 0)
+    );
+    """
+    CREATE_LABELS_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS labels_{year}Q{quarter} (
+        json_data VARIANT
+    );
+    """
 
     load_dotenv()
     conn = connect(
@@ -116,25 +175,68 @@ def load_data(year=2023, quarter=4, logger=None):
     )
     cur = conn.cursor()
 
-    cur.execute(CREATE_TABLE)
-    logger.info("Created table")
     cur.execute(CREATE_FILE_FORMAT)
     logger.info("Created file format")
     cur.execute(CREATE_STAGE)
     logger.info("Created stage")
     json_directory = Path(f"./backend/exportfiles/{year}q{quarter}")
-    logger.info(f"Uploading data to stage {year}q{quarter}")
-    cur.execute(f"PUT file://{json_directory}/* @json_stage/{year}q{quarter}/")
-    logger.info("Uploaded data to stage")
-    cur.execute(
-        f"""
+    parquet_directory = json_directory / "parquet"
+    if export_output(json_directory) == "parquet":
+        # Exported with output="parquet": one row per fact, loaded by column
+        cur.execute(CREATE_PARQUET_FILE_FORMAT)
+        cur.execute(CREATE_FACTS_TABLE)
+        logger.info(f"Uploading facts to stage {year}q{quarter}")
+        for stmt_directory in sorted(parquet_directory.iterdir()):
+            cur.execute(
+                f"PUT file://{stmt_directory}/*.parquet @json_stage/parquet/{year}q{quarter}/{stmt_directory.name}/"
+            )
+        cur.execute(
+            f"""
+                COPY INTO facts_{year}Q{quarter}
+                FROM @json_stage/parquet/{year}q{quarter}
+                FILE_FORMAT = (FORMAT_NAME = my_parquet_format)
+                MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+                ON_ERROR = 'CONTINUE';
+            """
+        )
+        logger.info("Copied facts into table")
+    else:
+        cur.execute(CREATE_TABLE)
+        logger.info("Created table")
+        logger.info(f"Uploading data to stage {year}q{quarter}")
+        if export_output(json_directory) == "ndjson":
+            for shard in manifest_shards(json_directory):
+                cur.execute(
+                    f"PUT file://{json_directory / shard} @json_stage/{year}q{quarter}/"
+                )
+        else:
+            cur.execute(
+                f"PUT file://{json_directory}/*.json @json_stage/{year}q{quarter}/"
+            )
+        logger.info("Uploaded data to stage")
+        cur.execute(
+            f"""
                 COPY INTO json_{year}Q{quarter} (json_data)
                 FROM @json_stage/{year}q{quarter}
                 FILE_FORMAT = (FORMAT_NAME = my_json_format)
                 ON_ERROR = 'CONTINUE';
             """
-    )
-    logger.info("Copied data into table")
+        )
+        logger.info("Copied data into table")
+    labels_file = json_directory / "labels.jsonl"
+    if labels_file.exists():
+        # Exported with labels="dictionary": documents hold label ids
+        cur.execute(CREATE_LABELS_TABLE)
+        cur.execute(f"PUT file://{labels_file} @json_stage/labels/{year}q{quarter}/")
+        cur.execute(
+            f"""
+                COPY INTO labels_{year}Q{quarter} (json_data)
+                FROM @json_stage/labels/{year}q{quarter}
+                FILE_FORMAT = (FORMAT_NAME = my_json_format)
+                ON_ERROR = 'CONTINUE';
+            """
+        )
+        logger.info("Copied label dictionary into table")
     cur.close()
     conn.close()
 
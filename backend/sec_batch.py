@@ -0,0 +1,188 @@
+"""Transform a range of quarters with shared reference data and workers.
+
+Run from the backend directory with the quarterly zips and ticker.txt in
+./data, e.g. python sec_batch.py 2014q1 2024q4 --workers 16 --quarters 3
+
+A backfill can be spread over n nodes by running it with --shard i/n on
+node i, then once with --merge n to combine each quarter's manifests.
+"""
+
+import argparse
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from pathlib import Path
+from typing import Dict, List
+
+from sec_io import load_symbol_index
+from sec_export import merge_manifests
+from sec_json import ENGINES, MODES, parse_shard, transform_quarter
+from sec_report import current_peak_rss_mb
+
+
+def parse_quarter(text: str) -> tuple:
+    """Parse "2024q4" into (2024, 4)"""
+    match = re.fullmatch(r"(\d{4})[qQ]([1-4])", text.strip())
+    if match is None:
+        raise ValueError(f"Invalid quarter: {text}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def quarter_range(start: str, end: str) -> List[tuple]:
+    """All (year, quarter) pairs from start to end inclusive"""
+    year, quarter = parse_quarter(start)
+    last = parse_quarter(end)
+    quarters = []
+    while (year, quarter) <= last:
+        quarters.append((year, quarter))
+        year, quarter = (year + 1, 1) if quarter == 4 else (year, quarter + 1)
+    return quarters
+
+
+def transform_quarters(
+    quarters: List[tuple],
+    logger=None,
+    max_workers: int | None = None,
+    max_quarters: int = 2,
+    **options,
+) -> List[Dict]:
+    """Transform several quarters, max_quarters at a time, on one pool of
+    max_workers processes.
+
+    The symbol index is loaded once and the pool is started once for the
+    whole run; each running quarter keeps up to twice its share of the
+    workers busy. Quarters running at once share this process, so their
+    reports record its process-wide peak RSS rather than per-stage peaks.
+    options are passed on to transform_quarter. Returns the statistics of
+    every quarter in order; a quarter that failed has an "error" instead.
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_quarters = max(1, min(max_quarters, len(quarters)))
+    symbols = load_symbol_index(Path("./data") / "ticker.txt", Path("./data") / "cache")
+
+    # Workers must share the parent's resource tracker, which otherwise only
+    # starts with the first SharedQuarter, after the pool has been forked
+    resource_tracker.ensure_running()
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as processes:
+        # Start the workers before any other thread exists, so they are
+        # never forked from a multithreaded parent
+        processes.submit(int).result()
+
+        with ThreadPoolExecutor(max_workers=max_quarters) as threads:
+            futures = {
+                threads.submit(
+                    transform_quarter,
+                    year,
+                    quarter,
+                    logger,
+                    max_workers=max(1, max_workers // max_quarters),
+                    symbols=symbols,
+                    executor=processes,
+                    stage_peaks=False,
+                    **options,
+                ): (year, quarter)
+                for year, quarter in quarters
+            }
+            for future in as_completed(futures):
+                year, quarter = futures[future]
+                try:
+                    results[year, quarter] = future.result()
+                except Exception as e:
+                    logger.error(f"Transformation of {year}q{quarter} failed: {e}")
+                    results[year, quarter] = {
+                        "year": year,
+                        "quarter": quarter,
+                        "error": str(e),
+                    }
+
+    return [results[key] for key in quarters]
+
+
+def format_report(
+    results: List[Dict], elapsed: float, peak_rss_mb: float | None = None
+) -> str:
+    """One line of throughput per quarter plus a total over the elapsed
+    wall-clock seconds of the whole run, and the peak RSS of the whole
+    process if given"""
+    lines = [
+        f"{'quarter':<8} {'documents':>9} {'kept':>7} {'seconds':>8} "
+        f"{'docs/s':>9} {'facts/s':>11}"
+    ]
+    for result in results:
+        name = f"{result['year']}q{result['quarter']}"
+        if "error" in result:
+            lines.append(f"{name:<8} failed: {result['error']}")
+            continue
+        seconds = max(result["seconds"], 1e-9)
+        facts_rate = (
+            f"{result['facts'] / seconds:.0f}" if result["facts"] is not None else ""
+        )
+        lines.append(
+            f"{name:<8} {result['documents']:>9} {result['kept']:>7} "
+            f"{result['seconds']:>8.1f} {result['documents'] / seconds:>9.1f} "
+            f"{facts_rate:>11}"
+        )
+
+    documents = sum(result.get("documents", 0) for result in results)
+    lines.append(
+        f"{'total':<8} {documents:>9} {'':>7} {elapsed:>8.1f} "
+        f"{documents / max(elapsed, 1e-9):>9.1f}"
+    )
+    if peak_rss_mb is not None:
+        lines.append(f"peak RSS of the whole process: {peak_rss_mb:.0f} MB")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("start", help="first quarter, e.g. 2014q1")
+    parser.add_argument("end", help="last quarter, e.g. 2024q4")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--quarters", type=int, default=2)
+    parser.add_argument("--engine", choices=ENGINES, default="pool")
+    parser.add_argument("--mode", choices=MODES, default="incremental")
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="process only shard i of n of every quarter, e.g. 2/8",
+    )
+    parser.add_argument(
+        "--merge",
+        type=int,
+        default=None,
+        metavar="N",
+        help="merge the manifests of the N shards of every quarter and exit",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.merge is not None:
+        for year, quarter in quarter_range(args.start, args.end):
+            export_dir = Path("./exportfiles") / f"{year}q{quarter}"
+            entries = merge_manifests(export_dir, args.merge)
+            print(f"{year}q{quarter}: {entries} entries")
+        return
+
+    start = time.perf_counter()
+    results = transform_quarters(
+        quarter_range(args.start, args.end),
+        max_workers=args.workers,
+        max_quarters=args.quarters,
+        engine=args.engine,
+        mode=args.mode,
+        shard=args.shard,
+    )
+    print(format_report(results, time.perf_counter() - start, current_peak_rss_mb()))
+
+
+if __name__ == "__main__":
+    main()
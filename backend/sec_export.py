@@ -0,0 +1,667 @@
+import gzip
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST_NAME = "manifest.jsonl"
+LABELS_NAME = "labels.jsonl"
+PARQUET_DIR = "parquet"
+OUTPUTS = ("json", "ndjson", "parquet")
+LABELS = ("inline", "dictionary")
+COMPRESSIONS = (None, "gzip", "zstd")
+SERIALIZERS = ("auto", "orjson", "stdlib")
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+PARQUET_STATEMENTS = ("bs", "cf", "ic")
+# Rows of a statement buffered as Python objects before they become an
+# Arrow record batch
+PARQUET_BATCH_ROWS = 65536
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("symbol", pa.string()),
+        ("adsh", pa.string()),
+        ("year", pa.int32()),
+        ("quarter", pa.string()),
+        ("startDate", pa.date32()),
+        ("endDate", pa.date32()),
+        ("stmt", pa.string()),
+        ("concept", pa.string()),
+        ("label_id", pa.int32()),
+        ("unit", pa.string()),
+        ("value", pa.int64()),
+    ]
+)
+
+_NEWLINES = str.maketrans({"\r": "", "\n": " "})
+
+
+def _clean(value):
+    if isinstance(value, str) and ("\n" in value or "\r" in value):
+        return value.translate(_NEWLINES)
+    return value
+
+
+def sanitize_result(result: Dict) -> Dict:
+    """Copy of a submission document with CRs dropped and LFs turned into
+    spaces in every string field, facts in data and otherContexts included,
+    so the encoded JSON is a single line"""
+    return {
+        key: (
+            {
+                stmt: [{k: _clean(v) for k, v in fact.items()} for fact in facts]
+                for stmt, facts in value.items()
+            }
+            if key in ("data", "otherContexts")
+            else _clean(value)
+        )
+        for key, value in result.items()
+    }
+
+
+def serialize_result(result: Dict) -> str:
+    """Encode a submission document as one line of JSON with the stdlib"""
+    encoded = json.dumps(result)
+    if "\\n" in encoded or "\\r" in encoded:
+        # Rare: re-encode from sanitized strings. A literal backslash-n only
+        # costs a redundant re-encode.
+        encoded = json.dumps(sanitize_result(result))
+    return encoded
+
+
+class StdlibSerializer:
+    name = "stdlib"
+
+    def dumps(self, result: Dict) -> bytes:
+        return serialize_result(result).encode("utf-8")
+
+
+class OrjsonSerializer:
+    """Compact orjson encoding. NaN is written as null (the stdlib writes
+    NaN); documents with integers beyond 64 bits fall back to the stdlib."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+
+    def _encode(self, document: Dict) -> bytes:
+        try:
+            return self._orjson.dumps(document)
+        except self._orjson.JSONEncodeError:
+            return json.dumps(document, separators=(",", ":")).encode("utf-8")
+
+    def dumps(self, result: Dict) -> bytes:
+        encoded = self._encode(result)
+        if b"\\n" in encoded or b"\\r" in encoded:
+            encoded = self._encode(sanitize_result(result))
+        return encoded
+
+
+def get_serializer(name: str = "auto"):
+    """Return the named serializer; "auto" picks orjson when it is installed
+    and the stdlib otherwise"""
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown serializer: {name}")
+    if name == "auto":
+        try:
+            return OrjsonSerializer()
+        except ImportError:
+            return StdlibSerializer()
+    if name == "orjson":
+        return OrjsonSerializer()
+    return StdlibSerializer()
+
+
+def write_labels(export_dir: Path, labels: List[str]) -> None:
+    """Write the label dictionary sidecar of a quarter: one {"id", "label"}
+    object per line, id being the label's position in labels. Labels are
+    cleaned like document strings, so expanding gives the inline output."""
+    # Shards of one quarter may write the same dictionary at the same time
+    fd, tmp_path = tempfile.mkstemp(dir=export_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        for label_id, label in enumerate(labels):
+            f.write(json.dumps({"id": label_id, "label": _clean(label)}) + "\n")
+    os.replace(tmp_path, export_dir / LABELS_NAME)
+
+
+def read_labels(export_dir: Path) -> List[str]:
+    """The label dictionary of a quarter exported with labels="dictionary"
+    as a list indexed by label id"""
+    labels = []
+    with open(export_dir / LABELS_NAME) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry["id"] != len(labels):
+                raise ValueError(f"Label ids out of order at {entry['id']}")
+            labels.append(entry["label"])
+    return labels
+
+
+def expand_labels(result: Dict, labels: List[str]) -> Dict:
+    """Copy of a document exported with labels="dictionary" with the label
+    and info ids replaced by their text from read_labels, in data and
+    otherContexts"""
+
+    def expand(value):
+        return labels[value] if isinstance(value, int) else value
+
+    def expand_statements(statements: Dict) -> Dict:
+        return {
+            stmt: [
+                {**fact, "label": expand(fact["label"]), "info": expand(fact["info"])}
+                for fact in facts
+            ]
+            for stmt, facts in statements.items()
+        }
+
+    expanded = {**result, "data": expand_statements(result["data"])}
+    if "otherContexts" in result:
+        expanded["otherContexts"] = expand_statements(result["otherContexts"])
+    return expanded
+
+
+def result_filename(result: Dict) -> str:
+    return f"{result['symbol']}_{result['quarter']}_{result['year']}.json"
+
+
+def shard_manifest_name(shard: tuple) -> str:
+    """Name of the partial manifest written by shard (index, count)"""
+    index, count = shard
+    return f"manifest-{index}-of-{count}.jsonl"
+
+
+def read_manifest(export_dir: Path, name: str = MANIFEST_NAME) -> Dict[str, Dict]:
+    """Manifest entries of a previous export by adsh; empty if there is none.
+    A line torn by a crash is ignored."""
+    entries = {}
+    try:
+        with open(export_dir / name) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry["adsh"]] = entry
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def merge_manifests(export_dir: Path, count: int) -> int:
+    """Combine the partial manifests of a quarter exported in count shards
+    into its manifest.jsonl and return the number of entries. Every shard
+    must have written its manifest."""
+    names = [shard_manifest_name((index, count)) for index in range(1, count + 1)]
+    missing = [name for name in names if not (export_dir / name).is_file()]
+    if missing:
+        raise FileNotFoundError(
+            f"Missing shard manifests in {export_dir}: {', '.join(missing)}"
+        )
+
+    entries = {}
+    for name in names:
+        entries.update(read_manifest(export_dir, name))
+    tmp_path = export_dir / (MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in entries.values())
+    tmp_path.replace(export_dir / MANIFEST_NAME)
+    return len(entries)
+
+
+class ExportWriter:
+    """Base class for export writers.
+
+    kept lists manifest entries of a previous export whose output is left in
+    place; they are copied into the new manifest first. fingerprints maps
+    adsh to the content fingerprint recorded with each new entry. The
+    manifest is written to manifest (see shard_manifest_name).
+    """
+
+    def _open_manifest(
+        self,
+        export_dir: Path,
+        kept: List | None,
+        fingerprints: Dict | None,
+        manifest: str = MANIFEST_NAME,
+    ) -> None:
+        self.fingerprints = fingerprints or {}
+        self._manifest = open(export_dir / manifest, "w")
+        self._manifest.writelines(json.dumps(entry) + "\n" for entry in kept or [])
+        self._manifest.flush()
+
+    def _manifest_entry(self, adsh: str, result: Dict, **location) -> Dict:
+        entry = {
+            "adsh": adsh,
+            "symbol": result["symbol"],
+            "quarter": result["quarter"],
+            "year": result["year"],
+            **location,
+        }
+        if adsh in self.fingerprints:
+            entry["fingerprint"] = self.fingerprints[adsh]
+        return entry
+
+    def write(self, adsh: str, result: Dict) -> None:
+        raise NotImplementedError
+
+    def write_many(self, items: List) -> None:
+        for adsh, result in items:
+            self.write(adsh, result)
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def abort(self) -> None:
+        """Close after a failed run; what was written so far stays, as
+        resume mode relies on"""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JsonFileWriter(ExportWriter):
+    """Writes one JSON file per submission, named symbol_quarter_year.json"""
+
+    def __init__(
+        self,
+        export_dir: Path,
+        serializer=None,
+        kept=None,
+        fingerprints=None,
+        manifest: str = MANIFEST_NAME,
+    ):
+        self.export_dir = export_dir
+        self.serializer = serializer or StdlibSerializer()
+        self._open_manifest(export_dir, kept, fingerprints, manifest)
+
+    def _write_file(self, adsh: str, result: Dict) -> str:
+        filename = result_filename(result)
+        with open(self.export_dir / filename, "wb") as f:
+            f.write(self.serializer.dumps(result))
+        return json.dumps(self._manifest_entry(adsh, result, file=filename)) + "\n"
+
+    def write(self, adsh: str, result: Dict) -> None:
+        self._manifest.write(self._write_file(adsh, result))
+
+    def write_many(self, items: List) -> None:
+        self._manifest.write(
+            "".join(self._write_file(adsh, result) for adsh, result in items)
+        )
+        self._manifest.flush()
+
+    def close(self) -> None:
+        self._manifest.close()
+
+
+class NdjsonShardWriter(ExportWriter):
+    """Writes submissions as newline-delimited JSON shards.
+
+    A new shard is started once the current one holds shard_size_mb of
+    (uncompressed) JSON. Each document's shard, line number and uncompressed
+    byte offset are recorded in the manifest when its shard is closed.
+    Shards of a previous export are deleted unless kept entries point into
+    them (kept must hold every entry of such a shard, see
+    sec_json.kept_entries), in which case numbering continues after them.
+    A shard torn by a crash is never in the manifest, so it is deleted too.
+    Shard files are named prefix-00000.ndjson and so on; only those with
+    this writer's prefix are deleted or counted.
+    """
+
+    def __init__(
+        self,
+        export_dir: Path,
+        shard_size_mb: int = 100,
+        compression: str | None = None,
+        serializer=None,
+        kept=None,
+        fingerprints=None,
+        manifest: str = MANIFEST_NAME,
+        prefix: str = "shard",
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.export_dir = export_dir
+        self.shard_bytes = shard_size_mb * 1024 * 1024
+        self.compression = compression
+        self.serializer = serializer or StdlibSerializer()
+        self.prefix = prefix
+        self._shard_index = 0
+        self._shard = None
+
+        start = len(prefix) + 1
+        referenced = {entry["shard"] for entry in kept or []}
+        for path in sorted(export_dir.glob(f"{prefix}-[0-9]*.ndjson*")):
+            if path.name in referenced:
+                self._shard_index = max(
+                    self._shard_index, int(path.name[start : start + 5]) + 1
+                )
+            else:
+                path.unlink()
+        self._open_manifest(export_dir, kept, fingerprints, manifest)
+
+    def _shard_name(self) -> str:
+        suffix = {None: "", "gzip": ".gz", "zstd": ".zst"}[self.compression]
+        return f"{self.prefix}-{self._shard_index:05d}.ndjson{suffix}"
+
+    def _open_shard(self) -> None:
+        path = self.export_dir / self._shard_name()
+        raw = open(path, "wb", buffering=WRITE_BUFFER_BYTES)
+        if self.compression == "gzip":
+            f = gzip.GzipFile(fileobj=raw, mode="wb")
+        elif self.compression == "zstd":
+            import zstandard
+
+            f = zstandard.ZstdCompressor().stream_writer(raw)
+        else:
+            f = raw
+        self._shard = {
+            "name": path.name,
+            "raw": raw,
+            "file": f,
+            "bytes": 0,
+            "entries": [],
+        }
+
+    def _close_shard(self) -> None:
+        self._shard["file"].close()
+        if not self._shard["raw"].closed:
+            self._shard["raw"].close()
+        for entry in self._shard["entries"]:
+            self._manifest.write(json.dumps(entry) + "\n")
+        self._manifest.flush()
+        self._shard = None
+        self._shard_index += 1
+
+    def write(self, adsh: str, result: Dict) -> None:
+        if self._shard is None:
+            self._open_shard()
+
+        line = self.serializer.dumps(result) + b"\n"
+        self._shard["entries"].append(
+            self._manifest_entry(
+                adsh,
+                result,
+                shard=self._shard["name"],
+                line=len(self._shard["entries"]),
+                offset=self._shard["bytes"],
+            )
+        )
+        self._shard["file"].write(line)
+        self._shard["bytes"] += len(line)
+
+        if self._shard["bytes"] >= self.shard_bytes:
+            self._close_shard()
+
+    def close(self) -> None:
+        if self._shard is not None:
+            self._close_shard()
+        self._manifest.close()
+
+
+class ParquetWriter(ExportWriter):
+    """Writes the statement facts of all submissions as one long-format
+    Parquet table (PARQUET_SCHEMA), a row per fact.
+
+    The table is partitioned by statement into parquet/bs/, parquet/cf/ and
+    parquet/ic/, each file sorted by symbol and otherwise in document order.
+    Documents must hold label ids (labels="dictionary"); a fact whose tag
+    has no doc gets a null label_id, and infos are not exported. Each
+    write_many batch (or PARQUET_BATCH_ROWS rows) becomes an Arrow record
+    batch per statement; the batches stay in memory, columnar, until close
+    sorts and writes each table along with the manifest entries (the file
+    name and row count of each submission). Memory grows with the quarter.
+    A file named name.parquet replaces the files of a previous export: all
+    of them for "part", else only "part" and its own. Until then, and for
+    good if the run fails (abort), the previous export stays as it was.
+    """
+
+    def __init__(
+        self,
+        export_dir: Path,
+        compression: str | None = None,
+        kept=None,
+        fingerprints=None,
+        manifest: str = MANIFEST_NAME,
+        name: str = "part",
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.export_dir = export_dir
+        self.compression = compression or "snappy"
+        self.filename = f"{name}.parquet"
+        self.fingerprints = fingerprints or {}
+        self._kept = list(kept or [])
+        self._manifest_name = manifest
+        self._stale = (
+            ["*.parquet"] if name == "part" else ["part.parquet", self.filename]
+        )
+        self._columns = {
+            stmt: {column: [] for column in PARQUET_SCHEMA.names}
+            for stmt in PARQUET_STATEMENTS
+        }
+        self._batches = {stmt: [] for stmt in PARQUET_STATEMENTS}
+        self._entries = []
+
+    def _flush(self) -> None:
+        """Turn the buffered rows of each statement into a record batch"""
+        for stmt, columns in self._columns.items():
+            if not columns["symbol"]:
+                continue
+            # Dates are exported as ISO strings; Arrow parses them on cast
+            arrays = [
+                (
+                    pa.array(columns[field.name], type=pa.string()).cast(pa.date32())
+                    if field.type == pa.date32()
+                    else pa.array(columns[field.name], type=field.type)
+                )
+                for field in PARQUET_SCHEMA
+            ]
+            self._batches[stmt].append(
+                pa.RecordBatch.from_arrays(arrays, schema=PARQUET_SCHEMA)
+            )
+            for values in columns.values():
+                values.clear()
+
+    def write(self, adsh: str, result: Dict) -> None:
+        rows = 0
+        for stmt, facts in result["data"].items():
+            columns = self._columns[stmt]
+            for fact in facts:
+                columns["symbol"].append(result["symbol"])
+                columns["adsh"].append(adsh)
+                columns["year"].append(result["year"])
+                columns["quarter"].append(result["quarter"])
+                columns["startDate"].append(result["startDate"])
+                columns["endDate"].append(result["endDate"])
+                columns["stmt"].append(stmt)
+                columns["concept"].append(fact["concept"])
+                # A tag without a doc has no label id; NaN would not fit int32
+                label = fact["label"]
+                columns["label_id"].append(label if isinstance(label, int) else None)
+                columns["unit"].append(fact["unit"])
+                columns["value"].append(fact["value"])
+            rows += len(facts)
+            if len(columns["symbol"]) >= PARQUET_BATCH_ROWS:
+                self._flush()
+        self._entries.append(
+            self._manifest_entry(adsh, result, table=self.filename, rows=rows)
+        )
+
+    def write_many(self, items: List) -> None:
+        super().write_many(items)
+        self._flush()
+
+    def close(self) -> None:
+        written = []
+        try:
+            self._flush()
+            for stmt, batches in self._batches.items():
+                # A stable sort keeps document order within a symbol
+                table = pa.Table.from_batches(batches, schema=PARQUET_SCHEMA)
+                table = table.sort_by("symbol")
+                stmt_dir = self.export_dir / PARQUET_DIR / stmt
+                stmt_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = stmt_dir / (self.filename + ".tmp")
+                written.append(tmp_path)
+                pq.write_table(table, tmp_path, compression=self.compression)
+        except BaseException:
+            for tmp_path in written:
+                tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            self._columns = self._batches = None
+
+        # Every table is written; publish them, then the manifest
+        for tmp_path in written:
+            for pattern in self._stale:
+                for path in tmp_path.parent.glob(pattern):
+                    if path.name != self.filename:
+                        path.unlink()
+            tmp_path.replace(tmp_path.parent / self.filename)
+        manifest_path = self.export_dir / self._manifest_name
+        tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.writelines(
+                json.dumps(entry) + "\n" for entry in self._kept + self._entries
+            )
+        tmp_path.replace(manifest_path)
+
+    def abort(self) -> None:
+        self._columns = self._batches = None
+        self._entries = []
+
+
+class AsyncWriter(ExportWriter):
+    """Runs another writer on a background thread fed by a bounded queue, so
+    serialization and disk I/O overlap with building the next documents.
+
+    The thread drains up to batch_size queued documents at a time and hands
+    them to the wrapped writer in one write_many call. stats tracks the
+    deepest the queue got, how long producers were blocked on a full queue
+    (output is the bottleneck), how long the writer waited on an empty
+    one (compute is the bottleneck) and how long it spent serializing and
+    writing.
+    """
+
+    def __init__(self, writer: ExportWriter, max_queue: int = 1000, batch_size=100):
+        self.writer = writer
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.stats = {
+            "written": 0,
+            "max_queue_depth": 0,
+            "producer_blocked_seconds": 0.0,
+            "writer_idle_seconds": 0.0,
+            "writer_busy_seconds": 0.0,
+        }
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name="export-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            wait_start = time.perf_counter()
+            batch = [self._queue.get()]
+            self.stats["writer_idle_seconds"] += time.perf_counter() - wait_start
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            items = [item for item in batch if item is not None]
+            if items and self._error is None:
+                write_start = time.perf_counter()
+                try:
+                    self.writer.write_many(items)
+                    self.stats["written"] += len(items)
+                except Exception as e:
+                    # Keep draining so producers never block on a dead writer
+                    self._error = e
+                self.stats["writer_busy_seconds"] += time.perf_counter() - write_start
+            if batch[-1] is None:
+                return
+
+    def write(self, adsh: str, result: Dict) -> None:
+        if self._error is not None:
+            raise self._error
+
+        self.stats["max_queue_depth"] = max(
+            self.stats["max_queue_depth"], self._queue.qsize() + 1
+        )
+        put_start = time.perf_counter()
+        self._queue.put((adsh, result))
+        self.stats["producer_blocked_seconds"] += time.perf_counter() - put_start
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            self.writer.abort()
+            raise self._error
+        # Writers that buffer (ParquetWriter) do most of their work here
+        close_start = time.perf_counter()
+        self.writer.close()
+        self.stats["writer_busy_seconds"] += time.perf_counter() - close_start
+
+    def abort(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.abort()
+
+
+def open_writer(
+    export_dir: Path,
+    output: str = "json",
+    shard_size_mb: int = 100,
+    compression: str | None = None,
+    serializer=None,
+    kept: List | None = None,
+    fingerprints: Dict | None = None,
+    shard: tuple | None = None,
+) -> ExportWriter:
+    """Writer for output; a writer for shard (index, count) of a quarter
+    writes a partial manifest and, for ndjson, its own shard files"""
+    manifest = MANIFEST_NAME if shard is None else shard_manifest_name(shard)
+    if output == "json":
+        return JsonFileWriter(export_dir, serializer, kept, fingerprints, manifest)
+    if output == "ndjson":
+        prefix = "shard" if shard is None else f"part-{shard[0]}-of-{shard[1]}"
+        return NdjsonShardWriter(
+            export_dir,
+            shard_size_mb,
+            compression,
+            serializer,
+            kept,
+            fingerprints,
+            manifest,
+            prefix,
+        )
+    if output == "parquet":
+        name = "part" if shard is None else f"part-{shard[0]}-of-{shard[1]}"
+        return ParquetWriter(
+            export_dir, compression, kept, fingerprints, manifest, name
+        )
+    raise ValueError(f"Unknown output: {output}")
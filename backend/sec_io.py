@@ -0,0 +1,425 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+
+NUM_COLUMNS = ["adsh", "tag", "value", "uom"]
+NUM_DTYPES = {"value": "float64"}
+# Which context a num value is reported for: the date, the number of
+# quarters it covers (0 for a point in time), and the segments and
+# coregistrant it applies to (null for the filer as a whole)
+NUM_CONTEXT_COLUMNS = ["ddate", "qtrs", "segments", "coreg"]
+PRE_COLUMNS = ["adsh", "tag", "stmt", "plabel"]
+SUB_COLUMNS = ["adsh", "cik", "name", "countryma", "cityma", "period", "fp", "fy"]
+TAG_COLUMNS = ["tag", "doc"]
+
+# Low-cardinality columns stored dictionary-encoded in the cache
+DICTIONARY_COLUMNS = {
+    "num": ["adsh", "tag", "uom", "segments", "coreg"],
+    "pre": ["adsh", "tag", "stmt"],
+    "sub": [],
+    "tag": [],
+}
+
+# Explicit Arrow schemas for the arrow reader; dictionary types for the
+# low-cardinality string columns
+STRING = pa.string()
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+ARROW_COLUMN_TYPES = {
+    "num": {
+        "adsh": DICTIONARY,
+        "tag": DICTIONARY,
+        "value": pa.float64(),
+        "uom": DICTIONARY,
+        "ddate": pa.int64(),
+        "qtrs": pa.int64(),
+        "segments": DICTIONARY,
+        "coreg": DICTIONARY,
+    },
+    "pre": {
+        "adsh": DICTIONARY,
+        "tag": DICTIONARY,
+        "stmt": DICTIONARY,
+        "plabel": STRING,
+    },
+    "sub": {
+        "adsh": STRING,
+        "cik": pa.int64(),
+        "name": STRING,
+        "countryma": STRING,
+        "cityma": STRING,
+        "period": pa.int64(),
+        "fp": DICTIONARY,
+        "fy": pa.float64(),
+    },
+    "tag": {"tag": STRING, "doc": STRING},
+}
+
+# pandas' default NA strings, so both readers agree on what is missing
+NA_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+
+READERS = ("pandas", "arrow")
+
+CACHE_FORMAT = 2
+
+
+def read_sub(f) -> pd.DataFrame:
+    return pd.read_table(f, delimiter="\t", usecols=SUB_COLUMNS)
+
+
+def read_tag(f) -> pd.DataFrame:
+    return pd.read_table(f, delimiter="\t", usecols=TAG_COLUMNS)
+
+
+def arrow_to_pandas(table: pa.Table) -> pd.DataFrame:
+    df = table.to_pandas()
+    # Arrow hands string nulls back as None; read_table gives NaN
+    strings = df.select_dtypes(include="object").columns
+    df[strings] = df[strings].where(df[strings].notna(), np.nan)
+    return df
+
+
+def read_arrow_csv(f, column_types: Dict) -> pd.DataFrame:
+    """Parse one SEC table with the multithreaded Arrow CSV reader, reading
+    only the columns in column_types; those the file lacks are all null"""
+    table = pa_csv.read_csv(
+        f,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        parse_options=pa_csv.ParseOptions(delimiter="\t", newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(column_types),
+            column_types=column_types,
+            null_values=NA_VALUES,
+            strings_can_be_null=True,
+            include_missing_columns=True,
+        ),
+    )
+    return arrow_to_pandas(table)
+
+
+def read_num(f, contexts: bool = False, **options) -> pd.DataFrame:
+    """Read num.txt with pd.read_table, with the NUM_CONTEXT_COLUMNS if
+    contexts; older quarters without segments get an all-null column"""
+    columns = NUM_COLUMNS + NUM_CONTEXT_COLUMNS if contexts else NUM_COLUMNS
+    df = pd.read_table(
+        f,
+        delimiter="\t",
+        usecols=lambda column: column in columns,
+        dtype=NUM_DTYPES,
+        **options,
+    )
+    if options.get("chunksize"):
+        return df
+    return df.reindex(columns=columns)
+
+
+def read_quarter(
+    zip_path: Path, reader: str = "pandas", contexts: bool = False
+) -> Dict[str, pd.DataFrame]:
+    """Read the num, pre, sub and tag tables of a quarterly SEC zip.
+
+    reader="pandas" uses pd.read_table, reader="arrow" the multithreaded
+    Arrow CSV reader with explicit schemas (dictionary-encoded tag, uom,
+    stmt, fp, ...). Both return the same data. num has the
+    NUM_CONTEXT_COLUMNS too if contexts.
+    """
+    if reader not in READERS:
+        raise ValueError(f"Unknown reader: {reader}")
+
+    if reader == "arrow":
+        column_types = dict(ARROW_COLUMN_TYPES)
+        if not contexts:
+            column_types["num"] = {
+                column: column_types["num"][column] for column in NUM_COLUMNS
+            }
+        with ZipFile(zip_path) as myzip:
+            return {
+                name: read_arrow_csv(myzip.open(f"{name}.txt"), types)
+                for name, types in column_types.items()
+            }
+
+    with ZipFile(zip_path) as myzip:
+        return {
+            "num": read_num(myzip.open("num.txt"), contexts),
+            "pre": pd.read_table(
+                myzip.open("pre.txt"), delimiter="\t", usecols=PRE_COLUMNS
+            ),
+            "sub": read_sub(myzip.open("sub.txt")),
+            "tag": read_tag(myzip.open("tag.txt")),
+        }
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_cache(tables: Dict[str, pd.DataFrame], cache_dir: Path, source_hash: str):
+    """Write the tables as uncompressed Arrow IPC files plus a meta.json
+    recording the hash of the zip they came from.
+
+    The files are written to a new directory next to cache_dir that then
+    takes its place, so a reader never maps a half-written file. Several
+    processes (shards of a quarter) may build the same cache at once; the
+    first to finish wins and the others keep its cache."""
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent, prefix=f".{cache_dir.name}-"))
+    try:
+        for name, df in tables.items():
+            df = df.astype({column: "category" for column in DICTIONARY_COLUMNS[name]})
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            feather.write_feather(
+                table, tmp_dir / f"{name}.arrow", compression="uncompressed"
+            )
+        meta = {"format": CACHE_FORMAT, "source_sha256": source_hash}
+        (tmp_dir / "meta.json").write_text(json.dumps(meta))
+
+        if cache_is_valid(cache_dir, source_hash):
+            return
+        if cache_dir.exists():
+            # A directory can only be renamed over an empty one; readers
+            # keep the files of the stale cache they have mapped
+            stale_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent, prefix=".stale-"))
+            try:
+                cache_dir.rename(stale_dir / cache_dir.name)
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        try:
+            tmp_dir.rename(cache_dir)
+        except OSError:
+            # Another process put its cache in place first
+            if not cache_is_valid(cache_dir, source_hash):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_cache(cache_dir: Path, contexts: bool = False) -> Dict[str, pd.DataFrame]:
+    """Load cached tables memory-mapped; dictionary columns come back as
+    pandas categoricals. The cache always holds the num context columns;
+    they are only converted if contexts."""
+    tables = {}
+    for name in DICTIONARY_COLUMNS:
+        with pa.memory_map(str(cache_dir / f"{name}.arrow")) as source:
+            table = pa.ipc.open_file(source).read_all()
+        if name == "num" and not contexts:
+            table = table.select(NUM_COLUMNS)
+        tables[name] = arrow_to_pandas(table)
+    return tables
+
+
+def cache_is_valid(cache_dir: Path, source_hash: str) -> bool:
+    try:
+        meta = json.loads((cache_dir / "meta.json").read_text())
+    except (OSError, ValueError):
+        return False
+    return meta == {"format": CACHE_FORMAT, "source_sha256": source_hash}
+
+
+def load_quarter(
+    zip_path: Path,
+    cache_dir: Path | None = None,
+    reader: str = "pandas",
+    logger=None,
+    contexts: bool = False,
+) -> Dict[str, pd.DataFrame]:
+    """Load a quarter's tables, through the columnar cache if cache_dir is set.
+
+    The cache is rebuilt from the zip whenever the zip's SHA-256 differs from
+    the one recorded when the cache was written. num has the
+    NUM_CONTEXT_COLUMNS too if contexts.
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    if cache_dir is None:
+        return read_quarter(zip_path, reader, contexts)
+
+    source_hash = file_sha256(zip_path)
+    if cache_is_valid(cache_dir, source_hash):
+        logger.info(f"Loading cached tables from {cache_dir}")
+        return read_cache(cache_dir, contexts)
+
+    logger.info(f"Building columnar cache for {zip_path} in {cache_dir}")
+    tables = read_quarter(zip_path, reader, contexts=True)
+    write_cache(tables, cache_dir, source_hash)
+    return read_cache(cache_dir, contexts)
+
+
+# Longest ticker symbol exported; longer (and empty) ones are invalid
+MAX_SYMBOL_LENGTH = 19
+
+
+class SymbolIndex:
+    """CIK to ticker symbol lookup over sorted integer CIKs.
+
+    symbols holds each CIK's uppercased symbol, or "" when the symbol is not
+    a valid one (empty or longer than MAX_SYMBOL_LENGTH), so resolving needs
+    no per-call normalization. Integer keys make "0000320193" and "320193"
+    the same CIK. When a CIK is listed more than once the last symbol wins.
+    """
+
+    def __init__(self, ciks: np.ndarray, symbols: np.ndarray):
+        self.ciks = ciks
+        self.symbols = symbols
+
+    @classmethod
+    def from_pairs(cls, ciks, symbols) -> "SymbolIndex":
+        ciks = pd.to_numeric(pd.Series(ciks, dtype=object), errors="coerce")
+        symbols = pd.Series(symbols, dtype=object).astype(str).str.upper()
+        symbols = symbols.where(
+            symbols.str.len().between(1, MAX_SYMBOL_LENGTH).to_numpy(), ""
+        )
+        df = pd.DataFrame({"cik": ciks.to_numpy(), "symbol": symbols.to_numpy()})
+        df = df.dropna(subset=["cik"]).drop_duplicates(subset=["cik"], keep="last")
+        df = df.sort_values("cik")
+        return cls(
+            df["cik"].to_numpy(dtype=np.int64),
+            df["symbol"].to_numpy(dtype=f"<U{MAX_SYMBOL_LENGTH}"),
+        )
+
+    @classmethod
+    def from_dict(cls, symbol_dict: Dict) -> "SymbolIndex":
+        return cls.from_pairs(list(symbol_dict), list(symbol_dict.values()))
+
+    @classmethod
+    def read_tickers(cls, path: Path) -> "SymbolIndex":
+        """Build the index from the SEC's tab-separated symbol/CIK ticker.txt"""
+        df = pd.read_table(
+            path,
+            delimiter="\t",
+            header=None,
+            names=["symbol", "cik"],
+            dtype=str,
+            keep_default_na=False,
+        )
+        return cls.from_pairs(df["cik"], df["symbol"])
+
+    def resolve(self, ciks) -> np.ndarray:
+        """Symbols of a whole column of CIKs at once: the symbol, "" for an
+        invalid one and None when the CIK is not listed"""
+        ciks = pd.to_numeric(pd.Series(ciks), errors="coerce")
+        known = ciks.notna().to_numpy()
+        keys = ciks.fillna(-1).to_numpy(dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ciks, keys), len(self.ciks) - 1)
+        result = np.full(len(keys), None, dtype=object)
+        if len(self.ciks):
+            found = known & (self.ciks[positions] == keys)
+            result[found] = self.symbols[positions[found]].astype(object)
+        return result
+
+    def save(self, path: Path, source_hash: str) -> None:
+        """Save the index to path atomically; processes saving at the same
+        time each write their own temporary file, and the last one wins"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    ciks=self.ciks,
+                    symbols=self.symbols,
+                    meta=np.array([CACHE_FORMAT, source_hash], dtype=str),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    @classmethod
+    def load(cls, path: Path, source_hash: str) -> "SymbolIndex | None":
+        """The index saved at path, or None when it is missing or was built
+        from a different ticker.txt"""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if data["meta"].tolist() != [str(CACHE_FORMAT), source_hash]:
+                    return None
+                return cls(data["ciks"], data["symbols"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __len__(self) -> int:
+        return len(self.ciks)
+
+
+def lookup_symbol(symbol_dict: "SymbolIndex | Dict", cik) -> str | None:
+    """The symbol of one CIK as SymbolIndex.resolve gives it: uppercased, ""
+    if invalid, None if not listed. A {cik: symbol} dict is looked up
+    directly, under the CIK and the CIK without leading zeros, rather than
+    indexed for a single submission."""
+    if isinstance(symbol_dict, SymbolIndex):
+        return symbol_dict.resolve([cik])[0]
+    cik = str(cik)
+    for key in (cik, cik.lstrip("0")):
+        if key in symbol_dict:
+            symbol = str(symbol_dict[key]).upper()
+            return symbol if 1 <= len(symbol) <= MAX_SYMBOL_LENGTH else ""
+    return None
+
+
+def as_symbol_index(symbols: "SymbolIndex | Dict") -> SymbolIndex:
+    """symbols as a SymbolIndex; a {cik: symbol} dict is indexed on the fly,
+    which is fine for a few lookups but not once per submission of a
+    quarter"""
+    if isinstance(symbols, SymbolIndex):
+        return symbols
+    return SymbolIndex.from_dict(symbols)
+
+
+def load_symbol_index(
+    path: Path, cache_dir: Path | None = None, logger=None
+) -> SymbolIndex:
+    """Load the symbol index for ticker.txt at path, through cache_dir if set.
+
+    The persisted index is rebuilt whenever the SHA-256 of ticker.txt differs
+    from the one it was built from.
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    if cache_dir is None:
+        return SymbolIndex.read_tickers(path)
+
+    source_hash = file_sha256(path)
+    index_path = cache_dir / "symbols.npz"
+    index = SymbolIndex.load(index_path, source_hash)
+    if index is None:
+        logger.info(f"Building symbol index for {path} in {index_path}")
+        index = SymbolIndex.read_tickers(path)
+        index.save(index_path, source_hash)
+    return index
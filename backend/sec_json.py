@@ -1,17 +1,55 @@
+import argparse
+import hashlib
 import logging
+import os
+import re
 import sys
+import time
+import zlib
+from collections import Counter
 from zipfile import ZipFile
 import pandas as pd
 from pathlib import Path
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import pickle
+from multiprocessing import shared_memory
+from contextlib import ExitStack, nullcontext
+from itertools import chain
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from marshmallow import Schema, fields
 from typing import Dict, List
 import warnings
 
+from sec_export import (
+    LABELS,
+    LABELS_NAME,
+    OUTPUTS,
+    AsyncWriter,
+    ExportWriter,
+    get_serializer,
+    merge_manifests,
+    open_writer,
+    read_manifest,
+    shard_manifest_name,
+    write_labels,
+)
+from sec_io import (
+    NUM_COLUMNS,
+    NUM_CONTEXT_COLUMNS,
+    PRE_COLUMNS,
+    SymbolIndex,
+    as_symbol_index,
+    load_quarter,
+    load_symbol_index,
+    lookup_symbol,
+    read_num,
+    read_sub,
+    read_tag,
+)
+from sec_report import RunReport, current_peak_rss_mb
+
 
 class FinancialElementImportSchema(Schema):
     label = fields.String()
@@ -39,242 +77,1560 @@ class SymbolFinancialsSchema(Schema):
     data = fields.Nested(FinancialsDataSchema)
 
 
+QUARTER_MONTHS = {
+    "FY": 12,
+    "CY": 12,
+    "H1": 6,
+    "H2": 6,
+    "T1": 4,
+    "T2": 4,
+    "T3": 4,
+    "Q1": 3,
+    "Q2": 3,
+    "Q3": 3,
+    "Q4": 3,
+}
+
+# Quarters from the start of the fiscal year to the end of each fiscal period:
+# 10-Q cash flow statements are reported year to date
+FISCAL_YEAR_QTRS = {
+    "FY": 4,
+    "CY": 4,
+    "H1": 2,
+    "H2": 4,
+    "Q1": 1,
+    "Q2": 2,
+    "Q3": 3,
+    "Q4": 4,
+}
+
+STATEMENTS = {"BS": "bs", "CF": "cf", "IC": "ic"}
+
+# Rough in-memory size of one parsed num.txt row, used to size streaming chunks
+STREAM_ROW_BYTES = 200
+
+ENGINES = ("pool", "vectorized", "streaming")
+MODES = ("full", "incremental", "resume")
+FACTS = ("all", "primary")
+
+# Bump when a change to the document format should invalidate every
+# previously exported submission
+FINGERPRINT_VERSION = 1
+
+# Why a submission gets no document, as counted in the run report
+SKIP_REASONS = ("bad_quarter", "invalid_symbol", "no_symbol", "error")
+
+# Log progress once per this many submissions instead of once for each
+PROGRESS_EVERY = 1000
+
+
+def _skip(skipped: Counter | None, reason: str) -> None:
+    if skipped is not None:
+        skipped[reason] += 1
+
+
+def submission_header(
+    submission_data: Dict, symbol_dict, logger=None, skipped=None
+) -> Dict | None:
+    """Build the sub-level part of a submission document (dates, symbol, ...)
+
+    symbol_dict is a {cik: symbol} dict or a SymbolIndex, see lookup_symbol.
+    Returns None if the submission has an invalid quarter or no usable symbol,
+    counting the reason (see SKIP_REASONS) in the skipped Counter if given.
+    The engines use submission_headers, its vectorized equivalent.
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    period_start = date.fromisoformat(str(int(submission_data["period"])))
+
+    result = {
+        "startDate": period_start.isoformat(),
+        "year": (
+            int(submission_data["fy"]) if not np.isnan(submission_data["fy"]) else 0
+        ),
+        "quarter": str(submission_data["fp"]).strip().upper(),
+        "name": submission_data["name"],
+        "country": submission_data["countryma"],
+        "city": submission_data["cityma"],
+        "data": {"bs": [], "cf": [], "ic": []},
+    }
+
+    if result["quarter"] not in QUARTER_MONTHS:
+        logger.debug(f"Invalid quarter: {result['quarter']}")
+        _skip(skipped, "bad_quarter")
+        return None
+
+    result["endDate"] = (
+        period_start + relativedelta(months=+QUARTER_MONTHS[result["quarter"]], days=-1)
+    ).isoformat()
+
+    cik = submission_data["cik"]
+    symbol = lookup_symbol(symbol_dict, cik)
+    if symbol is None:
+        logger.debug(f"No symbol found for CIK <{cik}>")
+        _skip(skipped, "no_symbol")
+        return None
+    if not symbol:
+        logger.debug(f"Invalid symbol for CIK <{cik}>")
+        _skip(skipped, "invalid_symbol")
+        return None
+
+    result["symbol"] = symbol
+    return result
+
+
+def submission_headers(dfSub: pd.DataFrame, symbol_dict) -> pd.DataFrame:
+    """Vectorized submission_header for a whole sub table.
+
+    Returns a frame aligned with dfSub holding adsh, the header fields
+    (startDate, endDate, year, quarter, name, country, city, symbol) and
+    "skip", the reason a submission gets no document (see SKIP_REASONS) or
+    None. A period that is not a valid YYYYMMDD date counts as an error, as
+    it makes submission_header raise.
+    """
+    period = pd.to_numeric(dfSub["period"], errors="coerce").to_numpy(dtype=float)
+    valid_period = np.isfinite(period) & (period == np.floor(period))
+    number = np.where(valid_period, period, 0).astype(np.int64)
+    year, month, day = number // 10000, number // 100 % 100, number % 100
+    valid_period &= (number >= 10000101) & (month >= 1) & (month <= 12) & (day >= 1)
+    month = np.where(valid_period, month, 1)
+
+    month_start = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days_in_month = (
+        (month_start + 1).astype("datetime64[D]") - month_start.astype("datetime64[D]")
+    ).astype(np.int64)
+    valid_period &= day <= days_in_month
+    start = month_start.astype("datetime64[D]") + (np.where(valid_period, day, 1) - 1)
+
+    # fp repeats a lot; normalize each distinct value once
+    codes, uniques = pd.factorize(dfSub["fp"], use_na_sentinel=False)
+    quarters = np.array([str(fp).strip().upper() for fp in uniques], dtype=object)
+    quarter = quarters[codes]
+    months = np.array([QUARTER_MONTHS.get(fp, 0) for fp in quarters], dtype=np.int64)
+    months = months[codes]
+    valid_quarter = months > 0
+
+    # Same as relativedelta(months=+n, days=-1): add the months, clamping the
+    # day to the target month's length, then step back one day
+    end_month = month_start + months
+    end_length = (
+        (end_month + 1).astype("datetime64[D]") - end_month.astype("datetime64[D]")
+    ).astype(np.int64)
+    end = end_month.astype("datetime64[D]") + (
+        np.minimum(np.where(valid_period, day, 1), end_length) - 2
+    )
+
+    symbol = as_symbol_index(symbol_dict).resolve(dfSub["cik"])
+    found = pd.notna(symbol)
+    valid_symbol = found & (symbol != "")
+
+    skip = np.full(len(dfSub), None, dtype=object)
+    # Checked in the order of submission_header, so the first failure wins
+    for reason, invalid in reversed(
+        [
+            ("error", ~valid_period),
+            ("bad_quarter", ~valid_quarter),
+            ("no_symbol", ~found),
+            ("invalid_symbol", ~valid_symbol),
+        ]
+    ):
+        skip[invalid] = reason
+    return pd.DataFrame(
+        {
+            "adsh": dfSub["adsh"].to_numpy(),
+            "startDate": np.datetime_as_string(start, unit="D"),
+            "year": dfSub["fy"].fillna(0).to_numpy(dtype=np.int64),
+            "quarter": quarter,
+            "name": dfSub["name"].to_numpy(),
+            "country": dfSub["countryma"].to_numpy(),
+            "city": dfSub["cityma"].to_numpy(),
+            "endDate": np.datetime_as_string(end, unit="D"),
+            "symbol": symbol,
+            "skip": skip,
+        }
+    )
+
+
+def header_documents(headers: pd.DataFrame):
+    """Yield (adsh, document, skip) for each row of submission_headers: the
+    statement-less document of a submission to export, or None and the
+    reason it is skipped"""
+    columns = [
+        headers[column].tolist()
+        for column in (
+            "adsh",
+            "startDate",
+            "year",
+            "quarter",
+            "name",
+            "country",
+            "city",
+            "endDate",
+            "symbol",
+            "skip",
+        )
+    ]
+    for adsh, start, year, quarter, name, country, city, end, symbol, skip in zip(
+        *columns
+    ):
+        if skip is not None:
+            yield adsh, None, skip
+            continue
+        yield adsh, {
+            "startDate": start,
+            "year": year,
+            "quarter": quarter,
+            "name": name,
+            "country": country,
+            "city": city,
+            "data": {"bs": [], "cf": [], "ic": []},
+            "endDate": end,
+            "symbol": symbol,
+        }, None
+
+
+def _submission_documents(
+    dfSub: pd.DataFrame, symbols, logger, skipped: Counter
+) -> tuple[Dict, List]:
+    """Header documents of the submissions to export, by adsh in dfSub order,
+    and the (adsh, None) results of the skipped ones"""
+    documents, skipped_results = {}, []
+    for adsh, document, skip in header_documents(submission_headers(dfSub, symbols)):
+        if document is not None:
+            documents[adsh] = document
+            continue
+        if skip == "error":
+            logger.warning(f"Error processing submission <{adsh}>: invalid period")
+        _skip(skipped, skip)
+        skipped_results.append((adsh, None))
+    return documents, skipped_results
+
+
+def append_facts(
+    result: Dict, adsh: str, facts, dfPre_dict: Dict, dfTag_dict: Dict
+) -> None:
+    """Append (tag, value, uom) facts to the statements of a submission document"""
+    for tag, value, uom in facts:
+        if tag in dfTag_dict:
+            label = dfTag_dict[tag]
+        else:
+            continue
+
+        pre_key = (adsh, tag)
+        if pre_key in dfPre_dict:
+            stmt, plabel = dfPre_dict[pre_key]
+        else:
+            continue
+
+        if pd.isna(value):
+            continue
+
+        element = {
+            "label": label,
+            "concept": tag,
+            # "info": plabel.replace('"', "'"),
+            "info": plabel,
+            "unit": uom,
+            "value": int(value),
+        }
+
+        if stmt in STATEMENTS:
+            result["data"][STATEMENTS[stmt]].append(element)
+
+
 def process_submission(
     submission_data: Dict,
     dfNum_filtered: pd.DataFrame,
     dfPre_dict: Dict,
     dfTag_dict: Dict,
-    symbol_dict: Dict,
+    symbol_dict,
     logger=None,
+    skipped=None,
 ) -> Dict | None:
     if logger is None:
         logger = logging.getLogger(__name__)
 
     try:
-        period_start = date.fromisoformat(str(int(submission_data["period"])))
+        result = submission_header(submission_data, symbol_dict, logger, skipped)
+        if result is None:
+            return None
+
+        if len(dfNum_filtered):
+            facts = zip(
+                dfNum_filtered["tag"], dfNum_filtered["value"], dfNum_filtered["uom"]
+            )
+            append_facts(result, submission_data["adsh"], facts, dfPre_dict, dfTag_dict)
+
+        logger.debug(f"Processed submission <{submission_data['adsh']}>")
+        return result
+
+    except Exception as e:
+        logger.warning(
+            f"Error processing submission <{submission_data['adsh']}>: {str(e)}"
+        )
+        _skip(skipped, "error")
+        return None
+
+
+def statement_pre(dfPre: pd.DataFrame) -> pd.DataFrame:
+    """Keep the pre.txt rows that place a fact on an exported statement.
+
+    The last row wins for an (adsh, tag) pair, as in a plain dict build; pairs
+    whose winning row is not BS/CF/IC are dropped since they are never exported.
+    """
+    dfPre = dfPre.drop_duplicates(subset=["adsh", "tag"], keep="last")
+    return dfPre[dfPre["stmt"].isin(list(STATEMENTS))]
+
+
+def join_statement_facts(
+    dfNum: pd.DataFrame,
+    dfPre: pd.DataFrame,
+    dfTag: pd.DataFrame,
+    columns: List[str] = [],
+) -> pd.DataFrame:
+    """Join num, pre and tag into one row per exported BS/CF/IC element.
+
+    Mirrors the dict lookups in ``process_submission``: the last tag.txt row
+    wins for a tag, the last pre.txt row wins for an (adsh, tag) pair, and
+    facts keep their num.txt order. columns are further num columns to keep.
+    """
+    facts = dfNum.loc[dfNum["tag"].notna(), ["adsh", "tag", "value", "uom", *columns]]
+    facts = facts.assign(_order=np.arange(len(facts)))
+    tags = dfTag.drop_duplicates(subset=["tag"], keep="last")[["tag", "doc"]]
+    pre = statement_pre(dfPre)
+
+    joined = facts.merge(tags, on="tag", how="inner").merge(
+        pre[["adsh", "tag", "stmt", "plabel"]], on=["adsh", "tag"], how="inner"
+    )
+    return joined.sort_values("_order", kind="stable").drop(columns="_order")
+
+
+def transform_vectorized(
+    dfNum: pd.DataFrame,
+    dfPre: pd.DataFrame,
+    dfSub: pd.DataFrame,
+    dfTag: pd.DataFrame,
+    symbol_dict,
+    logger=None,
+    skipped=None,
+    label_ids=None,
+):
+    """Yield submission documents built from a single num/pre/tag join; with
+    label_ids, labels and infos are written as ids"""
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    joined, ranges = partition_by_adsh(join_statement_facts(dfNum, dfPre, dfTag))
+    labels = joined["doc"].tolist()
+    concepts = joined["tag"].tolist()
+    infos = joined["plabel"].tolist()
+    if label_ids is not None:
+        labels = [label_ids.get(label, label) for label in labels]
+        infos = [label_ids.get(info, info) for info in infos]
+    units = joined["uom"].tolist()
+    values = joined["value"].tolist()
+    stmts = joined["stmt"].tolist()
+
+    for adsh, result, skip in header_documents(submission_headers(dfSub, symbol_dict)):
+        if result is None:
+            if skip == "error":
+                logger.warning(f"Error processing submission <{adsh}>: invalid period")
+            _skip(skipped, skip)
+            yield adsh, None
+            continue
+
+        try:
+            start, stop = ranges.get(adsh, (0, 0))
+            for i in range(start, stop):
+                result["data"][STATEMENTS[stmts[i]]].append(
+                    {
+                        "label": labels[i],
+                        "concept": concepts[i],
+                        "info": infos[i],
+                        "unit": units[i],
+                        "value": int(values[i]),
+                    }
+                )
+            yield adsh, result
+
+        except Exception as e:
+            logger.warning(f"Error processing submission <{adsh}>: {str(e)}")
+            _skip(skipped, "error")
+            yield adsh, None
+
+
+def primary_contexts(dfNum: pd.DataFrame, dfSub: pd.DataFrame) -> np.ndarray:
+    """Mask of the num rows reported for their filing's primary context:
+    dated at the sub period, for a point in time, the span of the fiscal
+    period or the fiscal year to date (qtrs 0; 1 for a quarter up to 4 for a
+    year; 2 for Q2, as in 10-Q cash flows), and for the filer as a whole (no
+    segments, no coregistrant)"""
+    dfSub = dfSub.drop_duplicates(subset=["adsh"], keep="last")
+    positions = pd.Index(dfSub["adsh"]).get_indexer(
+        np.asarray(dfNum["adsh"], dtype=object)
+    )
+    # Position -1 (no sub row) picks the trailing NaN, which matches nothing
+    period = np.append(
+        pd.to_numeric(dfSub["period"], errors="coerce").to_numpy(dtype=float), np.nan
+    )
+    fp = dfSub["fp"].astype(str).str.strip().str.upper()
+    span = np.append(fp.map(QUARTER_MONTHS).to_numpy(dtype=float) // 3, np.nan)
+    to_date = np.append(fp.map(FISCAL_YEAR_QTRS).to_numpy(dtype=float), np.nan)
+
+    qtrs = pd.to_numeric(dfNum["qtrs"], errors="coerce").to_numpy(dtype=float)
+    return (
+        (
+            pd.to_numeric(dfNum["ddate"], errors="coerce").to_numpy(dtype=float)
+            == period[positions]
+        )
+        & ((qtrs == 0) | (qtrs == span[positions]) | (qtrs == to_date[positions]))
+        & dfNum["segments"].isna().to_numpy()
+        & dfNum["coreg"].isna().to_numpy()
+    )
+
+
+def _optional(value):
+    return None if pd.isna(value) else value
+
+
+def other_contexts_of(
+    dfNum: pd.DataFrame, dfPre: pd.DataFrame, dfTag: pd.DataFrame, label_ids=None
+) -> Dict[str, Dict]:
+    """Statement elements of num rows outside the primary context, by adsh,
+    each with the ddate, qtrs, segments and coreg of its context"""
+    joined, ranges = partition_by_adsh(
+        join_statement_facts(dfNum, dfPre, dfTag, NUM_CONTEXT_COLUMNS)
+    )
+    labels = joined["doc"].tolist()
+    infos = joined["plabel"].tolist()
+    if label_ids is not None:
+        labels = [label_ids.get(label, label) for label in labels]
+        infos = [label_ids.get(info, info) for info in infos]
+    concepts = joined["tag"].tolist()
+    units = joined["uom"].tolist()
+    values = joined["value"].tolist()
+    stmts = joined["stmt"].tolist()
+    ddates = joined["ddate"].tolist()
+    qtrs = joined["qtrs"].tolist()
+    segments = joined["segments"].tolist()
+    coregs = joined["coreg"].tolist()
+
+    contexts = {}
+    for adsh, (start, stop) in ranges.items():
+        data = {"bs": [], "cf": [], "ic": []}
+        for i in range(start, stop):
+            data[STATEMENTS[stmts[i]]].append(
+                {
+                    "label": labels[i],
+                    "concept": concepts[i],
+                    "info": infos[i],
+                    "unit": units[i],
+                    "value": int(values[i]),
+                    "ddate": int(ddates[i]),
+                    "qtrs": int(qtrs[i]),
+                    "segments": _optional(segments[i]),
+                    "coreg": _optional(coregs[i]),
+                }
+            )
+        contexts[adsh] = data
+    return contexts
+
+
+class _OtherContextsWriter(ExportWriter):
+    """Adds the otherContexts of each document on its way to writer"""
+
+    def __init__(self, writer: ExportWriter, contexts: Dict[str, Dict]):
+        self.writer = writer
+        self.contexts = contexts
+
+    def write(self, adsh: str, result: Dict) -> None:
+        result["otherContexts"] = self.contexts.get(
+            adsh, {"bs": [], "cf": [], "ic": []}
+        )
+        self.writer.write(adsh, result)
+
+
+def partition_by_adsh(dfNum: pd.DataFrame) -> tuple[pd.DataFrame, Dict]:
+    """Group num rows by submission in a single pass.
+
+    Returns the rows reordered so that each submission's facts are contiguous
+    (original order is kept within a submission) and a dict mapping each adsh
+    to its ``(start, stop)`` row range in the reordered frame.
+    """
+    codes, uniques = pd.factorize(dfNum["adsh"])
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    stops = np.cumsum(counts)
+    starts = stops - counts
+
+    dfNum_sorted = dfNum.iloc[order[codes[order] >= 0]].reset_index(drop=True)
+    ranges = dict(zip(uniques, zip(starts.tolist(), stops.tolist())))
+    return dfNum_sorted, ranges
+
+
+class SharedQuarter:
+    """Quarter data published to worker processes through shared memory.
+
+    The num columns live in NumPy arrays (tag and uom dictionary-encoded as
+    int32 codes), as do any further arrays, such as the pre lookup of
+    encode_pre; the other lookup tables are one pickled blob. Tasks carry
+    only ``ref`` and row ranges; workers attach by name and read the arrays
+    without copying, but each unpickles its own copy of the blob: the tag
+    lookup and the tag and uom vocabularies, O(distinct tags) per worker.
+    """
+
+    def __init__(
+        self, dfNum: pd.DataFrame | None, lookups: Dict, arrays: Dict | None = None
+    ):
+        self._blocks = []
+        self.ref = {}
+
+        if dfNum is not None:
+            tag_codes, tags = pd.factorize(dfNum["tag"])
+            uom_codes, uoms = pd.factorize(dfNum["uom"])
+            # Code -1 (missing) indexes the trailing NaN
+            lookups = {
+                **lookups,
+                "tags": np.append(np.asarray(tags, dtype=object), np.nan),
+                "uoms": np.append(np.asarray(uoms, dtype=object), np.nan),
+            }
+            self.ref["tag_codes"] = self._share(tag_codes.astype(np.int32))
+            self.ref["uom_codes"] = self._share(uom_codes.astype(np.int32))
+            self.ref["value"] = self._share(dfNum["value"].to_numpy(dtype=np.float64))
+        for name, array in (arrays or {}).items():
+            self.ref[name] = self._share(array)
+
+        self.ref["lookups"] = self._share(
+            np.frombuffer(
+                pickle.dumps(lookups, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8
+            )
+        )
+
+    def _share(self, array: np.ndarray) -> tuple:
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(shm)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        return shm.name, array.dtype.str, len(array)
+
+    def close(self) -> None:
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Quarters attached by this worker process, keyed by their lookups block,
+# least recently used first. Several stay attached so a pool shared by
+# concurrently transformed quarters does not re-attach on every task.
+_attached_quarters: Dict = {}
+MAX_ATTACHED_QUARTERS = 4
+
+
+def _attach_quarter(ref: Dict) -> Dict:
+    key = ref["lookups"][0]
+    if key in _attached_quarters:
+        _attached_quarters[key] = _attached_quarters.pop(key)
+    else:
+        while len(_attached_quarters) >= MAX_ATTACHED_QUARTERS:
+            stale = _attached_quarters.pop(next(iter(_attached_quarters)))
+            for shm in stale["blocks"]:
+                shm.close()
+
+        quarter = {"blocks": []}
+        for column, (name, dtype, length) in ref.items():
+            shm = shared_memory.SharedMemory(name=name)
+            quarter["blocks"].append(shm)
+            quarter[column] = np.ndarray((length,), dtype=dtype, buffer=shm.buf)
+        quarter.update(pickle.loads(quarter.pop("lookups")))
+        _attached_quarters[key] = quarter
+    return _attached_quarters[key]
+
+
+def build_label_ids(pre_tags, plabels, dfTag: pd.DataFrame) -> Dict[str, int]:
+    """Ids of the label dictionary (labels="dictionary"): every plabel and
+    the tag.txt doc of every tag placed on an exported statement, numbered
+    in sorted order so every engine assigns the same ids"""
+    dfTag_dict = dict(zip(dfTag["tag"], dfTag["doc"]))
+    texts = set(plabels)
+    texts.update(dfTag_dict[tag] for tag in set(pre_tags) if tag in dfTag_dict)
+    return {
+        text: label_id
+        for label_id, text in enumerate(
+            sorted(text for text in texts if isinstance(text, str))
+        )
+    }
+
+
+def encode_tag_dict(dfTag_dict: Dict, label_ids: Dict[str, int]) -> Dict:
+    """The tag lookup with its label texts replaced by ids"""
+    return {tag: label_ids.get(doc, doc) for tag, doc in dfTag_dict.items()}
+
+
+def encode_strings(values) -> tuple[np.ndarray, np.ndarray]:
+    """Strings as one UTF-8 byte array and the offsets of each in it, the
+    last offset being the end of the array"""
+    encoded = [str(value).encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data: np.ndarray, offsets: np.ndarray, codes: np.ndarray) -> List:
+    """The strings of encode_strings at codes, NaN for code -1"""
+    starts = offsets[codes].tolist()
+    stops = offsets[codes + 1].tolist()
+    return [
+        np.nan if code < 0 else data[start:stop].tobytes().decode("utf-8")
+        for code, start, stop in zip(codes.tolist(), starts, stops)
+    ]
+
+
+def encode_pre(
+    dfPre_dict: Dict, label_ids: Dict[str, int] | None = None
+) -> tuple[Dict[str, np.ndarray], Dict]:
+    """The pre lookup of build_pre_dict as arrays to share with the workers,
+    rows grouped by adsh, and each adsh's (start, stop) row range in them.
+
+    pre_tag codes the tag and pre_plabel the plabel into string tables (see
+    encode_strings), pre_stmt the statement into STATEMENTS. With label_ids,
+    pre_plabel holds the label ids themselves, -1 for none. A worker decodes
+    one submission's rows at a time, see _pre_lookup.
+    """
+    keys, values = list(dfPre_dict), list(dfPre_dict.values())
+    frame, ranges = partition_by_adsh(
+        pd.DataFrame(
+            {
+                "adsh": [adsh for adsh, _ in keys],
+                "tag": [tag for _, tag in keys],
+                "stmt": [stmt for stmt, _ in values],
+                "plabel": [plabel for _, plabel in values],
+            }
+        )
+    )
+
+    tag_codes, tags = pd.factorize(frame["tag"])
+    arrays = {
+        "pre_tag": tag_codes.astype(np.int32),
+        "pre_stmt": pd.Categorical(
+            frame["stmt"], categories=list(STATEMENTS)
+        ).codes.astype(np.int8),
+    }
+    arrays["pre_tags"], arrays["pre_tag_offsets"] = encode_strings(tags)
+    if label_ids is None:
+        plabel_codes, plabels = pd.factorize(frame["plabel"])
+        arrays["pre_plabels"], arrays["pre_plabel_offsets"] = encode_strings(plabels)
+    else:
+        plabel_codes = frame["plabel"].map(label_ids).fillna(-1).to_numpy()
+    arrays["pre_plabel"] = plabel_codes.astype(np.int32)
+    return arrays, ranges
+
+
+def _pre_lookup(quarter: Dict, adsh: str, start: int, stop: int) -> Dict:
+    """The (adsh, tag) -> (stmt, plabel) lookup of one submission, decoded
+    from its rows of the shared pre arrays"""
+    tags = decode_strings(
+        quarter["pre_tags"], quarter["pre_tag_offsets"], quarter["pre_tag"][start:stop]
+    )
+    plabels = quarter["pre_plabel"][start:stop]
+    if "pre_plabels" in quarter:
+        plabels = decode_strings(
+            quarter["pre_plabels"], quarter["pre_plabel_offsets"], plabels
+        )
+    else:
+        plabels = [
+            np.nan if label_id < 0 else label_id for label_id in plabels.tolist()
+        ]
+    statements = list(STATEMENTS)
+    stmts = [statements[code] for code in quarter["pre_stmt"][start:stop].tolist()]
+    return dict(zip([(adsh, tag) for tag in tags], zip(stmts, plabels)))
+
+
+def build_pre_dict(dfPre: pd.DataFrame) -> Dict:
+    """Map (adsh, tag) to (stmt, plabel) for the exported statements only"""
+    dfPre = statement_pre(dfPre)
+    return dict(
+        zip(zip(dfPre["adsh"], dfPre["tag"]), zip(dfPre["stmt"], dfPre["plabel"]))
+    )
+
+
+def _build_document(
+    quarter: Dict, adsh: str, result: Dict, facts, pre_range: tuple, skipped: Counter
+) -> tuple:
+    try:
+        dfPre_dict = _pre_lookup(quarter, adsh, *pre_range)
+        append_facts(result, adsh, facts, dfPre_dict, quarter["tag"])
+    except Exception as e:
+        logging.getLogger(__name__).warning(
+            f"Error processing submission <{adsh}>: {str(e)}"
+        )
+        _skip(skipped, "error")
+        result = None
+    return adsh, result
+
 
-        result = {
-            "startDate": period_start.isoformat(),
-            "year": (
-                int(submission_data["fy"]) if not np.isnan(submission_data["fy"]) else 0
+def _batch_metrics(start: float, skipped: Counter) -> Dict:
+    """What a worker reports with each batch: compute seconds, its own peak
+    RSS so far and the submissions skipped by reason"""
+    return {
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": current_peak_rss_mb(),
+        "skipped": dict(skipped),
+    }
+
+
+def _process_batch(ref: Dict, batch: List) -> tuple:
+    start = time.perf_counter()
+    quarter = _attach_quarter(ref)
+    skipped = Counter()
+    results = [
+        _build_document(
+            quarter,
+            adsh,
+            result,
+            zip(
+                quarter["tags"][quarter["tag_codes"][start:stop]].tolist(),
+                quarter["value"][start:stop].tolist(),
+                quarter["uoms"][quarter["uom_codes"][start:stop]].tolist(),
             ),
-            "quarter": str(submission_data["fp"]).strip().upper(),
-            "name": submission_data["name"],
-            "country": submission_data["countryma"],
-            "city": submission_data["cityma"],
-            "data": {"bs": [], "cf": [], "ic": []},
-        }
+            pre_range,
+            skipped,
+        )
+        for adsh, result, start, stop, pre_range in batch
+    ]
+    return results, _batch_metrics(start, skipped)
 
-        quarter_map = {
-            "FY": 12,
-            "CY": 12,
-            "H1": 6,
-            "H2": 6,
-            "T1": 4,
-            "T2": 4,
-            "T3": 4,
-            "Q1": 3,
-            "Q2": 3,
-            "Q3": 3,
-            "Q4": 3,
-        }
 
-        if result["quarter"] not in quarter_map:
-            logger.warning(f"Invalid quarter: {result['quarter']}")
-            return None
+def _process_streamed_batch(ref: Dict, batch: List) -> tuple:
+    start = time.perf_counter()
+    quarter = _attach_quarter(ref)
+    skipped = Counter()
+    results = [
+        _build_document(quarter, adsh, result, facts, pre_range, skipped)
+        for adsh, result, facts, pre_range in batch
+    ]
+    return results, _batch_metrics(start, skipped)
+
 
-        result["endDate"] = (
-            period_start
-            + relativedelta(months=+quarter_map[result["quarter"]], days=-1)
-        ).isoformat()
+def plan_batches(sizes: Dict, batch_facts: int) -> List[List]:
+    """Pack submissions into work units of roughly batch_facts facts each.
 
-        cik = str(submission_data["cik"])
+    Submissions are taken largest first so the biggest filers start early and
+    the many small ones fill in at the end of the run. A submission larger
+    than batch_facts gets a unit of its own.
+    """
+    batches, batch, batch_size = [], [], 0
+    for adsh in sorted(sizes, key=sizes.get, reverse=True):
+        batch.append(adsh)
+        batch_size += max(sizes[adsh], 1)
+        if batch_size >= batch_facts:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
 
-        if cik in symbol_dict:
-            symbol = symbol_dict[cik]
-            symbol = str(symbol).upper()
-            if 1 <= len(symbol) <= 19:
-                result["symbol"] = symbol
+
+def _dispatch(executor, tasks, max_in_flight: int, report: RunReport):
+    """Submit (fn, *args) tasks keeping at most max_in_flight pending and
+    yield the items of each result list as tasks complete, adding each
+    task's metrics to report"""
+    tasks = iter(tasks)
+    pending = set()
+    exhausted = False
+
+    while True:
+        while not exhausted and len(pending) < max_in_flight:
+            task = next(tasks, None)
+            if task is None:
+                exhausted = True
             else:
-                logger.warning(f"Invalid symbol: CIK <{cik}> -> {symbol}")
-                return None
+                pending.add(executor.submit(*task))
+        if not pending:
+            return
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            results, metrics = future.result()
+            report.add_worker(metrics)
+            yield from results
+
+
+def _write_results(results, writer: ExportWriter, logger, report: RunReport) -> None:
+    counters = report.counters
+    for adsh, result in results:
+        counters["processed"] += 1
+        report.update_progress()
+        if result is not None:
+            writer.write(adsh, result)
+            counters["exported"] += 1
         else:
-            cik_no_zeros = cik.lstrip("0")
-            if cik_no_zeros in symbol_dict:
-                symbol = symbol_dict[cik_no_zeros]
-                symbol = str(symbol).upper()
-                if 1 <= len(symbol) <= 19:
-                    result["symbol"] = symbol
-                else:
-                    logger.warning(
-                        f"Invalid symbol: CIKNZ <{cik_no_zeros}> -> <{symbol}>"
+            logger.debug(f"Skipping submission <{adsh}>")
+        if counters["processed"] % PROGRESS_EVERY == 0:
+            logger.info(
+                f"Processed {counters['processed']} submissions, "
+                f"{counters['exported']} exported"
+            )
+
+
+def _pool(executor, max_workers: int):
+    """A new process pool, or a shared one the caller will shut down"""
+    if executor is None:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return nullcontext(executor)
+
+
+def _transform_pool(
+    dfNum,
+    dfPre,
+    dfSub,
+    dfTag,
+    symbols,
+    writer,
+    logger,
+    max_workers,
+    batch_facts,
+    report,
+    label_ids=None,
+    executor=None,
+):
+    with report.stage("dict_build"):
+        dfNum, adsh_ranges = partition_by_adsh(dfNum)
+        dfTag_dict = dict(zip(dfTag["tag"], dfTag["doc"]))
+        if label_ids is not None:
+            dfTag_dict = encode_tag_dict(dfTag_dict, label_ids)
+        pre_arrays, pre_ranges = encode_pre(build_pre_dict(dfPre), label_ids)
+
+        submissions, skipped = _submission_documents(
+            dfSub, symbols, logger, report.skipped
+        )
+        sizes = {}
+        for adsh in submissions:
+            start, stop = adsh_ranges.get(adsh, (0, 0))
+            sizes[adsh] = stop - start
+        batches = plan_batches(sizes, batch_facts)
+
+        shared = SharedQuarter(dfNum, {"tag": dfTag_dict}, pre_arrays)
+
+    logger.info("Preprocessing complete, starting transformation...")
+
+    max_workers = max_workers or os.cpu_count() or 1
+
+    with shared, _pool(executor, max_workers) as executor, report.stage("dispatch"):
+        logger.info(
+            f"Processing {len(submissions)} submissions in {len(batches)} batches "
+            f"on {max_workers} workers"
+        )
+        tasks = (
+            (
+                _process_batch,
+                shared.ref,
+                [
+                    (
+                        adsh,
+                        submissions[adsh],
+                        *adsh_ranges.get(adsh, (0, 0)),
+                        pre_ranges.get(adsh, (0, 0)),
                     )
-                    return None
-            else:
-                logger.warning(f"No symbol found for CIK <{cik}> or <{cik_no_zeros}>")
-                return None
+                    for adsh in batch
+                ],
+            )
+            for batch in batches
+        )
+        _write_results(
+            chain(skipped, _dispatch(executor, tasks, 2 * max_workers, report)),
+            writer,
+            logger,
+            report,
+        )
 
-        adsh = submission_data["adsh"]
 
-        for _, row in dfNum_filtered.iterrows():
-            tag = row["tag"]
+def iter_num_submissions(f, chunk_rows: int, select=None):
+    """Yield (adsh, facts) for each submission of a num.txt stream.
 
-            if tag in dfTag_dict:
-                label = dfTag_dict[tag]
-            else:
-                continue
+    num.txt is read chunk_rows rows at a time and must be grouped by adsh, as
+    published by the SEC. A submission is yielded as soon as the next one
+    starts; facts is its list of (tag, value, uom) in file order, without
+    the rows that have no value. With select, a function returning the mask
+    of rows to keep, chunks are read with the NUM_CONTEXT_COLUMNS and
+    filtered (see primary_contexts).
+    """
+    seen = set()
+    current_adsh, current_facts = None, []
 
-            pre_key = (adsh, tag)
-            if pre_key in dfPre_dict:
-                stmt, plabel = dfPre_dict[pre_key]
-            else:
+    contexts = select is not None
+    with read_num(f, contexts, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            if contexts:
+                chunk = chunk.reindex(
+                    columns=NUM_COLUMNS + NUM_CONTEXT_COLUMNS, copy=False
+                )
+                chunk = chunk[select(chunk)]
+            chunk = chunk.dropna(subset=["adsh", "value"])
+            if chunk.empty:
                 continue
 
-            if pd.isna(row["value"]):
-                continue
+            adsh = chunk["adsh"].to_numpy()
+            starts = np.flatnonzero(adsh[1:] != adsh[:-1]) + 1
+            starts = np.concatenate(([0], starts))
+            stops = np.append(starts[1:], len(adsh))
+            tags = chunk["tag"].tolist()
+            values = chunk["value"].tolist()
+            uoms = chunk["uom"].tolist()
 
-            element = {
-                "label": label,
-                "concept": tag,
-                # "info": plabel.replace('"', "'"),
-                "info": plabel,
-                "unit": row["uom"],
-                "value": int(row["value"]),
-            }
+            for start, stop in zip(starts, stops):
+                facts = list(
+                    zip(tags[start:stop], values[start:stop], uoms[start:stop])
+                )
+                if adsh[start] == current_adsh:
+                    current_facts.extend(facts)
+                    continue
+                if current_adsh is not None:
+                    yield current_adsh, current_facts
+                if adsh[start] in seen:
+                    raise ValueError(
+                        f"num.txt is not grouped by adsh: <{adsh[start]}> "
+                        "appears in more than one run of rows"
+                    )
+                seen.add(adsh[start])
+                current_adsh, current_facts = adsh[start], facts
 
-            if stmt == "BS":
-                result["data"]["bs"].append(element)
-            elif stmt == "CF":
-                result["data"]["cf"].append(element)
-            elif stmt == "IC":
-                result["data"]["ic"].append(element)
+    if current_adsh is not None:
+        yield current_adsh, current_facts
 
-        logger.info(f"Processed submission <{submission_data['adsh']}>")
-        return result
 
-    except Exception as e:
-        logger.warning(
-            f"Error processing submission <{submission_data['adsh']}>: {str(e)}"
+def read_pre_dict(f, chunk_rows: int) -> Dict:
+    """Build the same dict as build_pre_dict from a pre.txt stream read in
+    chunks, so the full pre table is never held in memory"""
+    dfPre_dict = {}
+    with pd.read_table(
+        f, delimiter="\t", usecols=PRE_COLUMNS, chunksize=chunk_rows
+    ) as reader:
+        for chunk in reader:
+            chunk = chunk.drop_duplicates(subset=["adsh", "tag"], keep="last")
+            exported = chunk["stmt"].isin(list(STATEMENTS))
+            # A later non-exported row overrides an earlier exported one
+            dropped = chunk[~exported]
+            for key in zip(dropped["adsh"], dropped["tag"]):
+                dfPre_dict.pop(key, None)
+            dfPre_dict.update(build_pre_dict(chunk[exported]))
+    return dfPre_dict
+
+
+def _streaming_tasks(
+    ref: Dict, submission_facts, submissions: Dict, pre_ranges: Dict, batch_facts
+):
+    batch, batch_size = [], 0
+    for adsh, facts in submission_facts:
+        if adsh not in submissions:
+            continue
+        batch.append((adsh, submissions.pop(adsh), facts, pre_ranges.get(adsh, (0, 0))))
+        batch_size += max(len(facts), 1)
+        if batch_size >= batch_facts:
+            yield _process_streamed_batch, ref, batch
+            batch, batch_size = [], 0
+
+    # Submissions without any facts still get a (statement-less) document
+    for adsh, result in submissions.items():
+        batch.append((adsh, result, [], pre_ranges.get(adsh, (0, 0))))
+        batch_size += 1
+        if batch_size >= batch_facts:
+            yield _process_streamed_batch, ref, batch
+            batch, batch_size = [], 0
+    if batch:
+        yield _process_streamed_batch, ref, batch
+
+
+def _stream_chunk_rows(memory_budget_mb: int) -> int:
+    # Half of the budget for the num chunk being parsed, half for work units
+    # waiting in or for the pool
+    return max(1000, memory_budget_mb * 1024 * 1024 // 2 // STREAM_ROW_BYTES)
+
+
+def _transform_streaming(
+    myzip,
+    dfSub,
+    dfPre_dict,
+    dfTag,
+    symbols,
+    writer,
+    logger,
+    max_workers,
+    batch_facts,
+    memory_budget_mb,
+    report,
+    label_ids=None,
+    executor=None,
+    select=None,
+):
+    budget = memory_budget_mb * 1024 * 1024
+    chunk_rows = _stream_chunk_rows(memory_budget_mb)
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max(
+        1, min(2 * max_workers, budget // 2 // (batch_facts * STREAM_ROW_BYTES))
+    )
+
+    with report.stage("dict_build"):
+        dfTag_dict = dict(zip(dfTag["tag"], dfTag["doc"]))
+        if label_ids is not None:
+            dfTag_dict = encode_tag_dict(dfTag_dict, label_ids)
+        pre_arrays, pre_ranges = encode_pre(dfPre_dict, label_ids)
+        submissions, skipped = _submission_documents(
+            dfSub, symbols, logger, report.skipped
         )
-        return None
+        shared = SharedQuarter(None, {"tag": dfTag_dict}, pre_arrays)
 
+    logger.info(
+        f"Streaming num.txt in chunks of {chunk_rows} rows, "
+        f"{max_in_flight} batches in flight on {max_workers} workers"
+    )
 
-def transform_to_json(year: int, quarter: int, logger=None) -> int:
-    """Transform SEC data to JSON format using parallel processing"""
+    # num.txt is read while dispatching, so its parsing counts as dispatch
+    with shared, _pool(executor, max_workers) as executor, report.stage("dispatch"):
+        tasks = _streaming_tasks(
+            shared.ref,
+            iter_num_submissions(myzip.open("num.txt"), chunk_rows, select),
+            submissions,
+            pre_ranges,
+            batch_facts,
+        )
+        _write_results(
+            chain(skipped, _dispatch(executor, tasks, max_in_flight, report)),
+            writer,
+            logger,
+            report,
+        )
+
+
+def _adsh_hashes(df: pd.DataFrame, columns: List[str]) -> pd.Series:
+    """Order-sensitive 64-bit hash of each adsh's rows of df"""
+    rows = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    position = df.groupby("adsh", sort=False, observed=True).cumcount()
+    mixed = pd.util.hash_array(rows ^ position.to_numpy(dtype=np.uint64))
+    adsh = np.asarray(df["adsh"], dtype=object)
+    return pd.Series(mixed, index=adsh).groupby(level=0, sort=False).sum()
+
+
+def submission_fingerprints(
+    dfNum: pd.DataFrame,
+    dfPre: pd.DataFrame,
+    dfSub: pd.DataFrame,
+    dfTag: pd.DataFrame,
+    symbol_dict,
+    context: str = "",
+) -> Dict[str, str]:
+    """Fingerprint everything a submission's document is built from: its sub
+    row and ticker symbol, its num and pre rows, and the tag table and
+    context (output format, serializer) shared by the whole quarter"""
+    combined = pd.util.hash_pandas_object(
+        dfSub.assign(symbol=as_symbol_index(symbol_dict).resolve(dfSub["cik"])),
+        index=False,
+    ).to_numpy()
+
+    adsh = np.asarray(dfSub["adsh"], dtype=object)
+    for part in (
+        _adsh_hashes(
+            dfNum,
+            ["tag", "value", "uom"]
+            + [column for column in NUM_CONTEXT_COLUMNS if column in dfNum],
+        ),
+        _adsh_hashes(dfPre, ["tag", "stmt", "plabel"]),
+    ):
+        hashes = part.reindex(adsh, fill_value=0).to_numpy(dtype=np.uint64)
+        combined = pd.util.hash_array(combined ^ hashes)
+
+    shared = pd.util.hash_pandas_object(dfTag, index=False).to_numpy().sum()
+    shared ^= pd.util.hash_array(
+        np.array([f"{FINGERPRINT_VERSION}:{context}"], dtype=object)
+    )[0]
+    combined = pd.util.hash_array(combined ^ shared)
+    return {a: f"{h:016x}" for a, h in zip(adsh, combined.tolist())}
+
+
+def parse_shard(text: str) -> tuple:
+    """Parse "2/8" into (2, 8), the second of eight shards"""
+    match = re.fullmatch(r"(\d+)/(\d+)", text.strip())
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard: {text}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def in_shard(adsh, shard: tuple) -> np.ndarray:
+    """Mask of the adsh values in shard (index, count). Submissions are
+    assigned by the CRC-32 of their adsh, so every node agrees on it."""
+    index, count = shard
+    return np.fromiter(
+        (zlib.crc32(str(a).encode()) % count == index - 1 for a in adsh),
+        dtype=bool,
+        count=len(adsh),
+    )
+
+
+def kept_entries(
+    dfSub: pd.DataFrame,
+    previous: Dict[str, Dict],
+    fingerprints: Dict[str, str] | None,
+    export_dir: Path,
+    output: str,
+) -> List[Dict]:
+    """Manifest entries of the previous export that can be kept as they are:
+    their output is still on disk and, when fingerprints are given, the
+    submission's fingerprint is unchanged. An NDJSON shard is kept whole or
+    not at all, so a submission exported again never stays behind in its
+    old shard."""
+    if output == "parquet":
+        # The Parquet table is always written as a whole
+        return []
+    location = "file" if output == "json" else "shard"
+    kept = []
+    for adsh in dfSub["adsh"]:
+        entry = previous.get(adsh)
+        if entry is None or location not in entry:
+            continue
+        if fingerprints is not None and entry.get("fingerprint") != fingerprints.get(
+            adsh
+        ):
+            continue
+        if (export_dir / entry[location]).is_file():
+            kept.append(entry)
+    if output == "ndjson":
+        done = {entry["adsh"] for entry in kept}
+        partial = {
+            entry["shard"]
+            for entry in previous.values()
+            if "shard" in entry and entry["adsh"] not in done
+        }
+        kept = [entry for entry in kept if entry["shard"] not in partial]
+    return kept
+
+
+def transform_quarter(
+    year: int,
+    quarter: int,
+    logger=None,
+    engine="pool",
+    max_workers: int | None = None,
+    batch_facts: int = 20000,
+    memory_budget_mb: int = 1024,
+    cache: bool = True,
+    reader: str = "pandas",
+    output: str = "json",
+    shard_size_mb: int = 100,
+    compression: str | None = None,
+    writer_queue: int = 1000,
+    serializer: str = "auto",
+    mode: str = "incremental",
+    symbols: SymbolIndex | None = None,
+    executor=None,
+    labels: str = "inline",
+    facts: str = "all",
+    other_contexts: bool = False,
+    shard: tuple | None = None,
+    progress=None,
+    symbol_dict: Dict | None = None,
+    stage_peaks: bool = True,
+) -> Dict:
+    """Transform one quarter of SEC data to JSON and return its statistics
+
+    engine="pool" processes submissions in parallel worker processes,
+    engine="vectorized" joins num/pre/tag once and builds every document
+    in-process, engine="streaming" reads num.txt in chunks and hands each
+    submission to the pool as soon as all its rows have been read. All
+    engines write identical files.
+
+    max_workers sizes the single process pool used for the whole run
+    (defaults to the CPU count) and batch_facts is the number of facts per
+    work unit sent to a worker. memory_budget_mb caps the num rows held by
+    the streaming engine; the sub/tag/pre lookups are loaded in full, and
+    output="parquet" holds the whole table, as Arrow record batches, until
+    the end of the run.
+
+    With cache=True the pool and vectorized engines load the quarter from a
+    memory-mapped Arrow cache in ./data/cache/, built on first use and
+    rebuilt when the zip changes. The streaming engine always reads the zip.
+    The symbol index built from ticker.txt is persisted there too, as
+    symbols.npz, and rebuilt when ticker.txt changes. reader="arrow" parses
+    the tables with the multithreaded Arrow CSV reader instead of
+    pd.read_table (pool and vectorized engines).
+
+    output="json" writes one file per submission, output="ndjson" writes
+    newline-delimited shards of about shard_size_mb each, optionally
+    compressed with "gzip" or "zstd". Either way manifest.jsonl lists each
+    exported symbol/quarter/year with its file, or shard, line and offset.
+    Documents are serialized and written on a separate thread behind a
+    queue of at most writer_queue documents, with orjson when it is
+    installed (serializer="auto") or the stdlib json module.
+    output="parquet" instead writes the statement facts as one long-format
+    table under parquet/, partitioned by statement and sorted by symbol
+    (see sec_export.ParquetWriter), with labels="dictionary" implied for
+    its label_id column; compression is its codec, snappy by default. The
+    table is rewritten as a whole, so incremental and resume runs export
+    everything again.
+
+    labels="dictionary" writes each statement element's label and info as
+    ids into a per-quarter dictionary, labels.jsonl, instead of repeating
+    the text in every document; sec_export.read_labels and expand_labels
+    turn such documents back into the inline form (labels="inline").
+
+    facts="primary" exports only the facts of each filing's primary context
+    (see primary_contexts) instead of every num.txt row, which drops the
+    prior-period comparatives and segment breakdowns that otherwise repeat
+    a concept within a statement. other_contexts=True (pool and vectorized
+    engines, not with output="parquet") keeps the dropped statement facts
+    apart, with their context, under each document's "otherContexts".
+
+    The manifest also records each submission's content fingerprint, so
+    reruns can reuse earlier output: mode="incremental" skips submissions
+    whose fingerprint is unchanged and whose output is still on disk,
+    mode="resume" skips every submission the last (possibly interrupted) run
+    got into the manifest, and mode="full" exports everything again. The
+    streaming engine computes no fingerprints and treats incremental as full.
+
+    symbols (a SymbolIndex of ticker.txt) and executor, a process pool to run on
+    instead of a pool of max_workers of its own, let several quarters share
+    reference data and workers; see sec_batch.transform_quarters. A
+    {cik: symbol} symbol_dict is still accepted in place of symbols.
+
+    shard=(i, n) processes only the submissions in shard i of n (see
+    in_shard), so n nodes can export a quarter between them without any
+    coordination. Each writes its own manifest-<i>-of-<n>.jsonl, and ndjson
+    files named part-<i>-of-<n>-*; merge_manifests combines the partial
+    manifests into manifest.jsonl once all shards are done.
+
+    progress, if given, is called with the percent of the submissions left
+    to process that have been processed, each time it reaches a new whole
+    percent.
+
+    Every run writes a report to ./exportfiles/reports/<year>q<quarter>.json
+    with the wall time and peak RSS of each stage (zip_read, preprocess,
+    dict_build, dispatch, worker_compute, write) and the number of
+    submissions exported and skipped by reason (see SKIP_REASONS), which
+    are also part of the returned statistics. stage_peaks=False, for runs
+    sharing this process with others at the same time, records the peak RSS
+    of the whole process instead of resetting it for each stage.
+    """
     if logger is None:
         logger = logging.getLogger(__name__)
 
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine}")
+    if output not in OUTPUTS:
+        raise ValueError(f"Unknown output: {output}")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    if labels not in LABELS:
+        raise ValueError(f"Unknown labels: {labels}")
+    if facts not in FACTS:
+        raise ValueError(f"Unknown facts: {facts}")
+    if output == "parquet":
+        labels = "dictionary"
+    if other_contexts and (facts != "primary" or engine == "streaming"):
+        raise ValueError(
+            "other_contexts needs facts='primary' and the pool or vectorized engine"
+        )
+    if other_contexts and output == "parquet":
+        # The Parquet table has no columns for the context of a fact
+        raise ValueError("other_contexts is not supported with output='parquet'")
+    if shard is not None and not 1 <= shard[0] <= shard[1]:
+        raise ValueError(f"Invalid shard: {shard}")
+
     dirname = f"{year}q{quarter}"
     base_path = Path("./data")
     out_path = Path("./exportfiles")
 
-    if not out_path.is_dir() or not (out_path / dirname).is_dir():
-        out_path.mkdir(exist_ok=True)
-        (out_path / dirname).mkdir()
+    # Shards of a quarter may start at the same time
+    (out_path / dirname).mkdir(parents=True, exist_ok=True)
 
-    logger.info(f"Starting transformation for {dirname}...")
+    logger.info(f"Starting transformation for {dirname} ({engine} engine)...")
     start_time = datetime.now()
 
-    with ZipFile(base_path / f"{dirname}.zip") as myzip:
-        dfNum = pd.read_table(
-            myzip.open("num.txt"),
-            delimiter="\t",
-            usecols=["adsh", "tag", "value", "uom"],
-            dtype={"value": "float64"},
-        )
-        dfPre = pd.read_table(
-            myzip.open("pre.txt"),
-            delimiter="\t",
-            usecols=["adsh", "tag", "stmt", "plabel"],
-        )
-        dfSub = pd.read_table(
-            myzip.open("sub.txt"),
-            delimiter="\t",
-            usecols=[
-                "adsh",
-                "cik",
-                "name",
-                "countryma",
-                "cityma",
-                "period",
-                "fp",
-                "fy",
-            ],
-        )
-        dfTag = pd.read_table(
-            myzip.open("tag.txt"), delimiter="\t", usecols=["tag", "doc"]
+    if symbols is None:
+        symbols = symbol_dict
+    if symbols is None:
+        symbols = load_symbol_index(
+            base_path / "ticker.txt",
+            cache_dir=base_path / "cache" if cache else None,
+            logger=logger,
         )
+    symbols = as_symbol_index(symbols)
+    json_serializer = get_serializer(serializer)
+    logger.info(f"Serializing with {json_serializer.name}")
 
-    dfSym = pd.read_table(
-        base_path / "ticker.txt", delimiter="\t", header=None, names=["symbol", "cik"]
+    export_dir = out_path / dirname
+    report = RunReport(
+        stage_peaks=stage_peaks, year=year, quarter=quarter, engine=engine, mode=mode
     )
+    previous = {} if mode == "full" else read_manifest(export_dir)
+    report_name = dirname
+    if shard is not None:
+        report.info["shard"] = f"{shard[0]}/{shard[1]}"
+        report_name += f"-{shard[0]}-of-{shard[1]}"
+        if mode != "full":
+            # The merged manifest of an earlier run, then this shard's own
+            previous.update(read_manifest(export_dir, shard_manifest_name(shard)))
+    fingerprints = None
+    fact_count = None
+    label_ids = None
+    contexts = None
+    context = f"{output}:{compression}:{json_serializer.name}"
+    if facts != "all":
+        context += f":facts:{facts}:{other_contexts}"
 
-    logger.info("Data loaded, preprocessing...")
+    with ExitStack() as stack:
+        if engine == "streaming":
+            myzip = stack.enter_context(ZipFile(base_path / f"{dirname}.zip"))
+            with report.stage("zip_read"):
+                dfSub = read_sub(myzip.open("sub.txt"))
+                dfTag = read_tag(myzip.open("tag.txt"))
+                dfPre_dict = read_pre_dict(
+                    myzip.open("pre.txt"), _stream_chunk_rows(memory_budget_mb)
+                )
+        else:
+            with report.stage("zip_read"):
+                tables = load_quarter(
+                    base_path / f"{dirname}.zip",
+                    cache_dir=base_path / "cache" / dirname if cache else None,
+                    reader=reader,
+                    logger=logger,
+                    contexts=facts != "all",
+                )
+            dfNum, dfPre, dfSub, dfTag = (
+                tables["num"],
+                tables["pre"],
+                tables["sub"],
+                tables["tag"],
+            )
 
-    dfNum = dfNum.dropna(subset=["value"])
-    dfTag_dict = dict(zip(dfTag["tag"], dfTag["doc"]))
-    symbol_dict = {
-        str(cik): str(symbol).upper() if isinstance(symbol, str) else str(symbol)
-        for cik, symbol in zip(dfSym["cik"].astype(str), dfSym["symbol"])
-    }
+            logger.info("Data loaded, preprocessing...")
 
-    dfPre_dict = {
-        (row["adsh"], row["tag"]): (row["stmt"], row["plabel"])
-        for _, row in dfPre.iterrows()
-    }
+        with report.stage("preprocess"):
+            if shard is not None:
+                dfSub = dfSub[in_shard(dfSub["adsh"], shard)]
+                logger.info(f"Shard {shard[0]}/{shard[1]}: {len(dfSub)} submissions")
 
-    logger.info("Preprocessing complete, starting transformation...")
+            if labels == "dictionary":
+                if engine == "streaming":
+                    pre_tags = (tag for _, tag in dfPre_dict)
+                    plabels = (plabel for _, plabel in dfPre_dict.values())
+                else:
+                    pre = statement_pre(dfPre)
+                    pre_tags, plabels = pre["tag"], pre["plabel"]
+                label_ids = build_label_ids(pre_tags, plabels, dfTag)
+                # Kept documents must use the ids of the dictionary written now
+                digest = hashlib.sha256("\0".join(label_ids).encode("utf-8"))
+                context += f":labels:{digest.hexdigest()}"
 
-    schema = SymbolFinancialsSchema()
-    chunk_size = 5000
-
-    for chunk_start in range(0, len(dfSub), chunk_size):
-        chunk_end = min(chunk_start + chunk_size, len(dfSub))
-        dfSub_chunk = dfSub.iloc[chunk_start:chunk_end]
-
-        with ProcessPoolExecutor() as executor:
-            logger.info(f"Using {executor} workers")
-            logger.info(f"Processing chunk <{chunk_start}> - <{chunk_end}>")
-            futures = []
-
-            for _, submission in dfSub_chunk.iterrows():
-                dfNum_filtered = dfNum[dfNum["adsh"] == submission["adsh"]]
-                logger.info(f"Processing submission <{submission['adsh']}>")
-                futures.append(
-                    executor.submit(
-                        process_submission,
-                        submission.to_dict(),
-                        dfNum_filtered,
-                        dfPre_dict,
-                        dfTag_dict,
-                        symbol_dict,
-                    )
+            if engine != "streaming":
+                dfNum = dfNum.dropna(subset=["value"])
+                if shard is not None:
+                    dfNum = dfNum[dfNum["adsh"].isin(dfSub["adsh"])]
+                fingerprints = submission_fingerprints(
+                    dfNum, dfPre, dfSub, dfTag, symbols, context=context
                 )
-            logger.info(f"Processing {len(futures)} submissions")
-            for future in as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    json_str = json.dumps(result)
-                    json_str = json_str.replace("\\r", "").replace("\\n", " ")
-
-                    with open(
-                        f"{out_path}/{dirname}/{result['symbol']}_{result['quarter']}_{result['year']}.json",
-                        "w",
-                    ) as f:
-                        f.write(json_str)
-                    logger.info(f"Processed submission <{result['symbol']}>")
-                else:
-                    logger.warning(f"Skipping submission <{submission['adsh']}>")
+                if facts == "primary":
+                    primary = primary_contexts(dfNum, dfSub)
+                    if other_contexts:
+                        contexts = other_contexts_of(
+                            dfNum[~primary], dfPre, dfTag, label_ids
+                        )
+                    dfNum = dfNum[primary]
+                fact_count = len(dfNum)
+
+            if mode == "incremental" and fingerprints is None:
+                # Fingerprints need the whole num table, which streaming never
+                # loads
+                logger.info("The streaming engine does not fingerprint; exporting all")
+                previous = {}
+            kept = kept_entries(
+                dfSub,
+                previous,
+                fingerprints if mode == "incremental" else None,
+                export_dir,
+                output,
+            )
+        report.counters["kept"] = len(kept)
+        if kept:
+            done = {entry["adsh"] for entry in kept}
+            dfSub = dfSub[~dfSub["adsh"].isin(done)]
+            logger.info(
+                f"Keeping {len(kept)} previously exported submissions ({mode}), "
+                f"{len(dfSub)} left to process"
+            )
+
+        async_writer = stack.enter_context(
+            AsyncWriter(
+                open_writer(
+                    export_dir,
+                    output,
+                    shard_size_mb,
+                    compression,
+                    json_serializer,
+                    kept,
+                    fingerprints,
+                    shard,
+                ),
+                max_queue=writer_queue,
+            )
+        )
+        if progress is not None:
+            report.track_progress(len(dfSub), progress)
+
+        writer = (
+            async_writer
+            if contexts is None
+            else _OtherContextsWriter(async_writer, contexts)
+        )
+
+        if engine == "streaming":
+            logger.info("Lookups loaded, streaming facts...")
+            _transform_streaming(
+                myzip,
+                dfSub,
+                dfPre_dict,
+                dfTag,
+                symbols,
+                writer,
+                logger,
+                max_workers,
+                batch_facts,
+                memory_budget_mb,
+                report,
+                label_ids,
+                executor,
+                (
+                    (lambda chunk: primary_contexts(chunk, dfSub))
+                    if facts == "primary"
+                    else None
+                ),
+            )
+        elif engine == "vectorized":
+            with report.stage("dispatch"):
+                _write_results(
+                    transform_vectorized(
+                        dfNum,
+                        dfPre,
+                        dfSub,
+                        dfTag,
+                        symbols,
+                        logger,
+                        report.skipped,
+                        label_ids,
+                    ),
+                    writer,
+                    logger,
+                    report,
+                )
+        else:
+            _transform_pool(
+                dfNum,
+                dfPre,
+                dfSub,
+                dfTag,
+                symbols,
+                writer,
+                logger,
+                max_workers,
+                batch_facts,
+                report,
+                label_ids,
+                executor,
+            )
+
+    if label_ids is not None:
+        write_labels(export_dir, list(label_ids))
+    else:
+        (export_dir / LABELS_NAME).unlink(missing_ok=True)
+
+    # The writer thread shares this process, so its memory shows in the
+    # dispatch stage's peak
+    report.add_stage("write", async_writer.stats["writer_busy_seconds"])
+    logger.info(
+        f"Writer: {async_writer.stats['written']} documents, max queue depth "
+        f"{async_writer.stats['max_queue_depth']}/{writer_queue}, producers blocked "
+        f"{async_writer.stats['producer_blocked_seconds']:.2f}s, writer idle "
+        f"{async_writer.stats['writer_idle_seconds']:.2f}s"
+    )
+    if report.skipped:
+        logger.warning(
+            f"Skipped {sum(report.skipped.values())} submissions: "
+            + ", ".join(f"{count} {reason}" for reason, count in report.skipped.items())
+        )
+
     end_time = datetime.now()
     processing_time = (end_time - start_time).total_seconds()
     logger.info(
         f"Transformation complete. Total processing time: {processing_time:.2f} seconds"
     )
 
+    stats = {
+        "year": year,
+        "quarter": quarter,
+        "submissions": len(dfSub),
+        "kept": len(kept),
+        "documents": async_writer.stats["written"],
+        "facts": fact_count,
+        "seconds": processing_time,
+    }
+    report.info.update(stats)
+    report.write(out_path / "reports" / f"{report_name}.json")
+    return report.to_dict()
+
+
+def transform_to_json(year: int, quarter: int, logger=None, **options) -> int:
+    """Transform SEC data to JSON format; options are those of
+    transform_quarter"""
+    transform_quarter(year, quarter, logger, **options)
     return 0
 
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transform one quarter of SEC data to JSON, or one shard of it"
+    )
+    parser.add_argument("year", type=int)
+    parser.add_argument("quarter", type=int, choices=[1, 2, 3, 4])
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="process only shard i of n, e.g. 2/8",
+    )
+    parser.add_argument(
+        "--merge",
+        type=int,
+        default=None,
+        metavar="N",
+        help="merge the manifests of the N shards of the quarter and exit",
+    )
+    parser.add_argument("--engine", choices=ENGINES, default="pool")
+    parser.add_argument("--mode", choices=MODES, default="incremental")
+    parser.add_argument("--output", choices=OUTPUTS, default="json")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.merge is not None:
+        export_dir = Path("./exportfiles") / f"{args.year}q{args.quarter}"
+        entries = merge_manifests(export_dir, args.merge)
+        print(f"Merged {args.merge} shard manifests, {entries} entries")
+        return
+
+    transform_to_json(
+        args.year,
+        args.quarter,
+        engine=args.engine,
+        mode=args.mode,
+        output=args.output,
+        max_workers=args.workers,
+        shard=args.shard,
+    )
+
+
 if __name__ == "__main__":
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    transform_to_json(year=2024, quarter=4)
+    main()
@@ -0,0 +1,123 @@
+import json
+import resource
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict
+
+
+def current_peak_rss_mb() -> float:
+    """Peak resident set size of this process since start, or since the
+    last reset_peak_rss, in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def children_peak_rss_mb() -> float:
+    """Largest peak RSS of this process's finished child processes, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS to the current RSS (Linux only); returns False
+    when the peak cannot be reset and keeps counting from process start"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class RunReport:
+    """Timings, memory high-water marks and counters of one transform run.
+
+    stage() times a block of the run and records the peak RSS of the process
+    reached within it. Peak RSS is process-wide, so runs sharing a process at
+    the same time pass stage_peaks=False: their stages then record the
+    peak of the whole process so far rather than resetting it for each
+    other, and to_dict says so under "peak_rss_scope". Worker processes report each task's compute time,
+    their peak RSS and the submissions they skipped through add_worker; the
+    "worker_compute" stage sums their time over all workers, so it can
+    exceed the wall time of the run. counters count submissions by outcome
+    and skipped the submissions skipped by reason; see track_progress for
+    following the "processed" count as it grows.
+    """
+
+    def __init__(self, stage_peaks: bool = True, **info):
+        self.stage_peaks = stage_peaks
+        self.info = info
+        self.stages: Dict[str, Dict] = {}
+        self.counters = Counter()
+        self.skipped = Counter()
+        self.worker_tasks = 0
+        self._progress = None
+
+    def track_progress(self, total: int, callback) -> None:
+        """Have update_progress call callback with the percent of total
+        submissions processed, each time it reaches a new whole percent"""
+        self._progress = {"total": max(total, 1), "callback": callback, "last": -1}
+
+    def update_progress(self) -> None:
+        if self._progress is None:
+            return
+        percent = min(100, 100 * self.counters["processed"] // self._progress["total"])
+        if percent > self._progress["last"]:
+            self._progress["last"] = percent
+            self._progress["callback"](percent)
+
+    def add_stage(self, name: str, seconds: float, peak_rss_mb: float | None = None):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "peak_rss_mb": None})
+        stage["seconds"] += seconds
+        if peak_rss_mb is not None:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"] or 0.0, peak_rss_mb)
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.stage_peaks:
+            reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start, current_peak_rss_mb())
+
+    def add_worker(self, metrics: Dict) -> None:
+        self.worker_tasks += 1
+        self.add_stage("worker_compute", metrics["seconds"], metrics["peak_rss_mb"])
+        self.skipped.update(metrics["skipped"])
+
+    def to_dict(self) -> Dict:
+        stages = {
+            name: {
+                "seconds": round(stage["seconds"], 3),
+                "peak_rss_mb": (
+                    round(stage["peak_rss_mb"], 1)
+                    if stage["peak_rss_mb"] is not None
+                    else None
+                ),
+            }
+            for name, stage in self.stages.items()
+        }
+        return {
+            **self.info,
+            "stages": stages,
+            "peak_rss_scope": "stage" if self.stage_peaks else "process",
+            "worker_tasks": self.worker_tasks,
+            "counts": {**self.counters, "skipped": dict(self.skipped)},
+        }
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), indent=2) + "\n")
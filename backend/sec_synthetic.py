@@ -0,0 +1,297 @@
+"""Generate synthetic SEC financial statement datasets.
+
+Writes {year}q{quarter}.zip files with sub/num/pre/tag tables in the layout
+of the SEC Financial Statement Data Sets, plus a ticker.txt covering most
+filers, e.g. python sec_synthetic.py 2023q1 2023q4 --scale 10 --out ./data
+"""
+
+import argparse
+from pathlib import Path
+from typing import Dict, List
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import numpy as np
+import pandas as pd
+
+# Submissions per quarter at scale 1; a real quarter has about 6000
+SUBMISSIONS_PER_SCALE = 100
+STANDARD_TAGS = 4000
+
+SUB_TXT_COLUMNS = [
+    "adsh", "cik", "name", "sic", "countryba", "stprba", "cityba", "zipba",
+    "bas1", "bas2", "baph", "countryma", "stprma", "cityma", "zipma", "mas1",
+    "mas2", "countryinc", "stprinc", "ein", "former", "changed", "afs",
+    "wksi", "fye", "form", "period", "fy", "fp", "filed", "accepted",
+    "prevrpt", "detail", "instance", "nciks", "aciks",
+]  # fmt: skip
+
+COMMON_TAGS = [
+    "Assets", "Liabilities", "StockholdersEquity", "LiabilitiesAndStockholdersEquity",
+    "CashAndCashEquivalentsAtCarryingValue", "Revenues", "NetIncomeLoss",
+    "OperatingIncomeLoss", "EarningsPerShareBasic", "EarningsPerShareDiluted",
+    "NetCashProvidedByUsedInOperatingActivities",
+    "NetCashProvidedByUsedInInvestingActivities",
+    "NetCashProvidedByUsedInFinancingActivities",
+]  # fmt: skip
+
+FORMS = ["10-Q", "10-K", "20-F"]
+FORM_WEIGHTS = [0.72, 0.25, 0.03]
+# Median facts per filing; annual reports are far larger than quarterlies
+FORM_MEDIAN_FACTS = {"10-Q": 250, "10-K": 700, "20-F": 900}
+STATEMENTS = ["BS", "IS", "CF", "EQ", "CI", "UN"]
+STATEMENT_WEIGHTS = [0.35, 0.25, 0.2, 0.1, 0.05, 0.05]
+UOMS = ["USD", "shares", "pure", "EUR", "USD/shares"]
+UOM_WEIGHTS = [0.8, 0.08, 0.04, 0.03, 0.05]
+CITIES = ["NEW YORK", "CHICAGO", "SAN JOSE", "HOUSTON", "BOSTON", "TORONTO"]
+COUNTRIES = ["US", "CA", "GB", "CN", "IL"]
+COUNTRY_WEIGHTS = [0.88, 0.04, 0.03, 0.03, 0.02]
+
+
+def _standard_tags() -> np.ndarray:
+    names = COMMON_TAGS + [
+        f"SyntheticConcept{i:04d}" for i in range(STANDARD_TAGS - len(COMMON_TAGS))
+    ]
+    return np.array(names, dtype=object)
+
+
+def _with_line_breaks(rng, labels: np.ndarray, rate: float) -> np.ndarray:
+    """Put a CR/LF into a fraction of labels, as some filers do"""
+    broken = rng.random(len(labels)) < rate
+    labels = labels.copy()
+    labels[broken] = [label + "\r\n(continued)" for label in labels[broken]]
+    return labels
+
+
+def _ticker(index: int) -> str:
+    letters = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord("a") + rest) + letters
+    return letters
+
+
+def filer_universe(scale: float, seed: int = 0) -> pd.DataFrame:
+    """The cik, name and ticker of every filer, shared by all quarters of a
+    dataset. About 10% of filers have no ticker."""
+    rng = np.random.default_rng([seed, 0])
+    count = max(1, round(SUBMISSIONS_PER_SCALE * scale * 1.2))
+    ciks = rng.choice(np.arange(1000, 1000 + count * 20), count, replace=False)
+    return pd.DataFrame(
+        {
+            "cik": ciks,
+            "name": [f"SYNTHETIC CO {i} INC" for i in range(count)],
+            "symbol": [_ticker(i) for i in range(count)],
+            "listed": rng.random(count) < 0.9,
+        }
+    )
+
+
+def generate_quarter(
+    year: int, quarter: int, filers: pd.DataFrame, scale: float, seed: int = 0
+) -> Dict[str, pd.DataFrame]:
+    """Build the sub, num, pre and tag tables of one synthetic quarter.
+
+    Facts per filing are log-normal around a per-form median, so a few large
+    annual reports dominate as in the real data. Tag use is Zipf-distributed
+    over a standard taxonomy plus filer-specific custom tags. num rows are
+    grouped by adsh, as the SEC publishes them.
+    """
+    rng = np.random.default_rng([seed, year, quarter])
+    count = max(1, round(SUBMISSIONS_PER_SCALE * scale))
+    chosen = filers.iloc[rng.choice(len(filers), count, replace=False)]
+
+    # sub
+    adsh = np.array(
+        [f"{cik:010d}-{year % 100:02d}-{i:06d}" for i, cik in enumerate(chosen["cik"])],
+        dtype=object,
+    )
+    forms = rng.choice(FORMS, count, p=FORM_WEIGHTS)
+    annual = forms != "10-Q"
+    fp = np.where(annual, "FY", rng.choice(["Q1", "Q2", "Q3"], count))
+    quarter_start = pd.Timestamp(year, 3 * (quarter - 1) + 1, 1)
+    period_ends = [quarter_start - pd.offsets.MonthEnd(k) for k in range(1, 7)]
+    periods = rng.choice(
+        [int(end.strftime("%Y%m%d")) for end in period_ends],
+        count,
+        p=[0.55, 0.15, 0.1, 0.1, 0.05, 0.05],
+    )
+    fy = np.where(rng.random(count) < 0.02, np.nan, periods // 10000).astype(float)
+    countries = rng.choice(COUNTRIES, count, p=COUNTRY_WEIGHTS).astype(object)
+    countries[rng.random(count) < 0.03] = None
+    sub = pd.DataFrame(
+        {
+            "adsh": adsh,
+            "cik": chosen["cik"].to_numpy(),
+            "name": chosen["name"].to_numpy(),
+            "sic": rng.choice([1311, 2834, 3674, 6022, 7372], count),
+            "countryba": countries,
+            "cityba": rng.choice(CITIES, count),
+            "countryma": countries,
+            "cityma": rng.choice(CITIES, count),
+            "form": forms,
+            "period": periods,
+            "fy": fy,
+            "fp": fp,
+            "filed": int(quarter_start.strftime("%Y%m%d")) + 14,
+            "prevrpt": 0,
+            "detail": 1,
+            "nciks": 1,
+        }
+    ).reindex(columns=SUB_TXT_COLUMNS)
+
+    # num
+    medians = np.array([FORM_MEDIAN_FACTS[form] for form in forms])
+    sizes = np.clip(rng.lognormal(np.log(medians), 0.8), 5, 20000).astype(int)
+    rows = int(sizes.sum())
+    owner = np.repeat(np.arange(count), sizes)
+
+    standard = _standard_tags()
+    popularity = 1.0 / np.arange(1, len(standard) + 1) ** 1.1
+    tag_index = rng.choice(len(standard), rows, p=popularity / popularity.sum())
+    tags = standard[tag_index]
+    custom = rng.random(rows) < 0.1
+    custom_tags = np.array(
+        [
+            f"Custom{o}Item{k}"
+            for o, k in zip(owner[custom], rng.integers(0, 50, int(custom.sum())))
+        ],
+        dtype=object,
+    )
+    tags[custom] = custom_tags
+
+    amounts = rng.choice([-1, 1], rows, p=[0.15, 0.85]) * rng.lognormal(
+        13, 3, rows
+    ).clip(max=1e15)
+    values = np.where(rng.random(rows) < 0.9, np.round(amounts), np.round(amounts, 2))
+    values[rng.random(rows) < 0.03] = np.nan
+    segments = np.where(rng.random(rows) < 0.25, "Segment=Americas;", None)
+    coreg = np.where(rng.random(rows) < 0.03, "Subsidiary", None)
+    num = pd.DataFrame(
+        {
+            "adsh": adsh[owner],
+            "tag": tags,
+            "version": np.where(custom, adsh[owner], "us-gaap/2023"),
+            "ddate": np.where(
+                rng.random(rows) < 0.7, periods[owner], periods[owner] - 10000
+            ),
+            "qtrs": rng.choice([0, 1, 2, 3, 4], rows, p=[0.4, 0.3, 0.05, 0.05, 0.2]),
+            "uom": rng.choice(UOMS, rows, p=UOM_WEIGHTS),
+            "segments": segments,
+            "coreg": coreg,
+            "value": values,
+            "footnote": None,
+        }
+    )
+
+    # pre: most (adsh, tag) pairs of num, a few placed on two statements
+    pairs = num[["adsh", "tag", "version"]].drop_duplicates(["adsh", "tag"])
+    pairs = pairs[rng.random(len(pairs)) < 0.85]
+    statement_of_tag = rng.choice(STATEMENTS, len(standard), p=STATEMENT_WEIGHTS)
+    known = pd.Series(statement_of_tag, index=standard)
+    stmts = known.reindex(pairs["tag"]).to_numpy(dtype=object)
+    unknown = pd.isna(stmts)
+    stmts[unknown] = rng.choice(STATEMENTS, int(unknown.sum()), p=STATEMENT_WEIGHTS)
+    pre = pairs.assign(stmt=stmts)
+    twice = pre[rng.random(len(pre)) < 0.05].assign(stmt="EQ")
+    pre = pd.concat([pre, twice], ignore_index=True)
+    pre["report"] = pd.Categorical(pre["stmt"], categories=STATEMENTS).codes + 1
+    pre["line"] = pre.groupby(["adsh", "report"]).cumcount() + 1
+    pre["inpth"] = 0
+    pre["rfile"] = "H"
+    pre["plabel"] = _with_line_breaks(
+        rng, ("Label of " + pre["tag"].astype(str)).to_numpy(dtype=object), 0.01
+    )
+    pre["negating"] = (rng.random(len(pre)) < 0.05).astype(int)
+    pre = pre[
+        [
+            "adsh",
+            "report",
+            "line",
+            "stmt",
+            "inpth",
+            "rfile",
+            "tag",
+            "version",
+            "plabel",
+            "negating",
+        ]
+    ]
+
+    # tag: the standard taxonomy plus each custom tag used
+    custom_used = num.loc[custom, ["tag", "version"]].drop_duplicates("tag")
+    tag_names = np.concatenate([standard, custom_used["tag"].to_numpy()])
+    docs = _with_line_breaks(
+        rng, np.array([f"Definition of {name}." for name in tag_names]), 0.01
+    ).astype(object)
+    docs[rng.random(len(docs)) < 0.01] = None
+    tag = pd.DataFrame(
+        {
+            "tag": tag_names,
+            "version": np.concatenate(
+                [
+                    np.full(len(standard), "us-gaap/2023", dtype=object),
+                    custom_used["version"].to_numpy(),
+                ]
+            ),
+            "custom": np.r_[np.zeros(len(standard)), np.ones(len(custom_used))],
+            "abstract": 0,
+            "datatype": "monetary",
+            "iord": rng.choice(["I", "D"], len(tag_names)),
+            "crdr": rng.choice(["C", "D"], len(tag_names)),
+            "tlabel": [f"Label of {name}" for name in tag_names],
+            "doc": docs,
+        }
+    ).astype({"custom": int})
+
+    return {"sub": sub, "num": num, "pre": pre, "tag": tag}
+
+
+def write_quarter(tables: Dict[str, pd.DataFrame], zip_path: Path) -> None:
+    with ZipFile(zip_path, "w", ZIP_DEFLATED) as myzip:
+        for name, df in tables.items():
+            myzip.writestr(f"{name}.txt", df.to_csv(sep="\t", index=False))
+
+
+def write_tickers(filers: pd.DataFrame, path: Path) -> None:
+    """ticker.txt as published by the SEC: lower-case symbol, tab, cik"""
+    listed = filers[filers["listed"]]
+    listed[["symbol", "cik"]].to_csv(path, sep="\t", index=False, header=False)
+
+
+def generate_dataset(
+    data_dir: Path, quarters: List[tuple], scale: float = 1, seed: int = 0
+) -> Dict[tuple, int]:
+    """Write a zip per (year, quarter) and a ticker.txt into data_dir.
+    Returns the number of num.txt rows of each quarter."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    filers = filer_universe(scale, seed)
+    write_tickers(filers, data_dir / "ticker.txt")
+
+    rows = {}
+    for year, quarter in quarters:
+        tables = generate_quarter(year, quarter, filers, scale, seed)
+        write_quarter(tables, data_dir / f"{year}q{quarter}.zip")
+        rows[year, quarter] = len(tables["num"])
+    return rows
+
+
+def main():
+    from sec_batch import quarter_range
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("start", help="first quarter, e.g. 2023q1")
+    parser.add_argument("end", nargs="?", help="last quarter (default: start)")
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=Path, default=Path("./data"))
+    args = parser.parse_args()
+
+    quarters = quarter_range(args.start, args.end or args.start)
+    rows = generate_dataset(args.out, quarters, args.scale, args.seed)
+    for (year, quarter), count in rows.items():
+        print(f"{args.out / f'{year}q{quarter}.zip'}: {count} num rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Registries of the API's background tasks.
+
+A task is a dict with its task_id and name, a status (see STATUSES;
+"cancelling" is a running task asked to stop), the progress made in
+percent, created_at, started_at, finished_at and updated_at timestamps
+(seconds since the epoch, None until they happen) and the error text of
+a failed task. Stores forget a task ttl_seconds after its last update,
+and keep at most max_tasks of them.
+
+A task created with a key (say "transform:2024q4") coalesces with the
+key's previous task, see TaskStore.create; version identifies the inputs
+a task ran on, e.g. the zip it read. TaskStore.claim starts a pending task
+only while fewer than a limit of tasks of its name are running, so a limit
+holds across every process sharing the store.
+
+MemoryTaskStore lives in one process; SqliteTaskStore is shared by every
+process that opens the same database file, e.g. the workers of one API.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+
+STATUSES = ("pending", "running", "cancelling", "success", "failed", "cancelled")
+FINISHED = ("success", "failed", "cancelled")
+ACTIVE = ("pending", "running", "cancelling")
+RUNNING = ("running", "cancelling")
+TASK_FIELDS = (
+    "task_id",
+    "name",
+    "status",
+    "progress",
+    "created_at",
+    "started_at",
+    "finished_at",
+    "updated_at",
+    "error",
+    "key",
+    "version",
+)
+
+
+def new_task(
+    task_id: str,
+    name: str,
+    now: float,
+    key: str | None = None,
+    version: str | None = None,
+) -> Dict:
+    return {
+        "task_id": task_id,
+        "name": name,
+        "status": "pending",
+        "progress": 0.0,
+        "created_at": now,
+        "started_at": None,
+        "finished_at": None,
+        "updated_at": now,
+        "error": None,
+        "key": key,
+        "version": version,
+    }
+
+
+def apply_update(task: Dict, fields: Dict, now: float) -> Dict:
+    """task with fields changed; moving to running or to a finished status
+    stamps started_at or finished_at"""
+    unknown = set(fields) - {"status", "progress", "error", "version"}
+    if unknown:
+        raise ValueError(f"Unknown task fields: {', '.join(sorted(unknown))}")
+    if fields.get("status", task["status"]) not in STATUSES:
+        raise ValueError(f"Unknown status: {fields['status']}")
+
+    task = {**task, **fields, "updated_at": now}
+    if fields.get("status") == "running" and task["started_at"] is None:
+        task["started_at"] = now
+    if fields.get("status") in FINISHED:
+        task["finished_at"] = now
+        if task["status"] == "success":
+            task["progress"] = 100.0
+    return task
+
+
+def reuse(previous: Dict | None, version, now: float, stale_seconds) -> bool | None:
+    """Whether a new task of a key can be served by the key's previous
+    task: yes if it is pending or running (and not being cancelled) or
+    succeeded on the same version. None means it claims to be in flight
+    but has not been updated for stale_seconds, so whatever ran it is gone."""
+    if previous is None:
+        return False
+    if previous["status"] in ACTIVE:
+        if stale_seconds is not None and previous["updated_at"] < now - stale_seconds:
+            return None
+        return previous["status"] != "cancelling"
+    return previous["status"] == "success" and previous["version"] == version
+
+
+def holds_slot(task: Dict, name: str, since: float) -> bool:
+    """Whether task is a running task of name, updated at or after since"""
+    return (
+        task["name"] == name
+        and task["status"] in RUNNING
+        and task["updated_at"] >= since
+    )
+
+
+class TaskStore:
+    """Base class for task stores; task ids are stored as strings"""
+
+    def create(
+        self,
+        task_id,
+        name: str,
+        key: str | None = None,
+        version: str | None = None,
+        stale_seconds: float | None = None,
+    ) -> Dict:
+        """Create a pending task and return it. Given a key, the key's
+        previous task is returned instead when it can serve this one (see
+        reuse); one in flight but stale is marked failed."""
+        raise NotImplementedError
+
+    def update(self, task_id, if_status=None, **fields) -> Dict | None:
+        """Change a task's status, progress or error; returns the updated
+        task, or None if the store does not know it (any more). Given
+        if_status, a tuple of statuses, a task in another status is returned
+        unchanged."""
+        raise NotImplementedError
+
+    def claim(
+        self, task_id, limit: int, stale_seconds: float | None = None
+    ) -> Dict | None:
+        """Move a pending task to running if fewer than limit tasks of its
+        name are running (or cancelling), and return it. Running tasks not
+        updated for stale_seconds do not count. A task returned still pending
+        has no free slot yet; one in any other status is not to be run."""
+        raise NotImplementedError
+
+    def get(self, task_id) -> Dict | None:
+        raise NotImplementedError
+
+
+def _abandoned(task: Dict, now: float) -> Dict:
+    return apply_update(
+        task, {"status": "failed", "error": "Abandoned by its job executor"}, now
+    )
+
+
+class MemoryTaskStore(TaskStore):
+    """Tasks of this process, least recently used first out"""
+
+    def __init__(
+        self, max_tasks: int = 10000, ttl_seconds: float = 86400, clock=time.time
+    ):
+        self.max_tasks = max_tasks
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._tasks = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, task_id: str | None, now: float) -> Dict | None:
+        task = self._tasks.get(task_id)
+        if task is None:
+            return None
+        if task["updated_at"] < now - self.ttl_seconds:
+            self._forget(self._tasks.pop(task_id))
+            return None
+        self._tasks.move_to_end(task_id)
+        return task
+
+    def _store(self, task: Dict) -> None:
+        self._tasks[task["task_id"]] = task
+        self._tasks.move_to_end(task["task_id"])
+        while len(self._tasks) > self.max_tasks:
+            _, evicted = self._tasks.popitem(last=False)
+            self._forget(evicted)
+
+    def _forget(self, task: Dict) -> None:
+        """Drop the key of a task that is no longer kept, unless the key has
+        moved on to a newer task"""
+        if self._keys.get(task["key"]) == task["task_id"]:
+            del self._keys[task["key"]]
+
+    def create(
+        self,
+        task_id,
+        name: str,
+        key: str | None = None,
+        version: str | None = None,
+        stale_seconds: float | None = None,
+    ) -> Dict:
+        now = self.clock()
+        task = new_task(str(task_id), name, now, key, version)
+        with self._lock:
+            if key is not None:
+                previous = self._lookup(self._keys.get(key), now)
+                reusable = reuse(previous, version, now, stale_seconds)
+                if reusable:
+                    return dict(previous)
+                if reusable is None:
+                    self._store(_abandoned(previous, now))
+                self._keys[key] = task["task_id"]
+            self._store(task)
+        return dict(task)
+
+    def update(self, task_id, if_status=None, **fields) -> Dict | None:
+        now = self.clock()
+        with self._lock:
+            task = self._lookup(str(task_id), now)
+            if task is None:
+                return None
+            if if_status is None or task["status"] in if_status:
+                task = apply_update(task, fields, now)
+                self._store(task)
+        return dict(task)
+
+    def claim(
+        self, task_id, limit: int, stale_seconds: float | None = None
+    ) -> Dict | None:
+        now = self.clock()
+        since = now - min(self.ttl_seconds, stale_seconds or self.ttl_seconds)
+        with self._lock:
+            task = self._lookup(str(task_id), now)
+            if task is None:
+                return None
+            if task["status"] == "pending":
+                running = sum(
+                    holds_slot(other, task["name"], since)
+                    for other in self._tasks.values()
+                )
+                if running < limit:
+                    task = apply_update(task, {"status": "running"}, now)
+                    self._store(task)
+        return dict(task)
+
+    def get(self, task_id) -> Dict | None:
+        with self._lock:
+            task = self._lookup(str(task_id), self.clock())
+        return None if task is None else dict(task)
+
+
+class SqliteTaskStore(TaskStore):
+    """Tasks in a SQLite database in WAL mode, so any number of processes
+    can read them while one writes. Each thread has its own connection."""
+
+    def __init__(
+        self,
+        path: Path,
+        max_tasks: int = 10000,
+        ttl_seconds: float = 86400,
+        clock=time.time,
+    ):
+        self.path = str(path)
+        self.max_tasks = max_tasks
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                updated_at REAL NOT NULL,
+                error TEXT,
+                key TEXT,
+                version TEXT
+            )
+            """)
+        # Databases created before tasks had a key and version
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
+        for column in ["key", "version"]:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE tasks ADD COLUMN {column} TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_updated_at ON tasks (updated_at)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_key ON tasks (key, created_at)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name, status, updated_at)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit; writes that read first open their own transaction
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _select(
+        self, conn, task_id: str, now: float, column: str = "task_id"
+    ) -> Dict | None:
+        """The task with task_id, or the latest one with a key if column is
+        "key" """
+        row = conn.execute(
+            f"SELECT {', '.join(TASK_FIELDS)} FROM tasks "
+            f"WHERE {column} = ? AND updated_at >= ? "
+            "ORDER BY created_at DESC LIMIT 1",
+            (task_id, now - self.ttl_seconds),
+        ).fetchone()
+        return None if row is None else dict(zip(TASK_FIELDS, row))
+
+    def _write(self, conn, task: Dict) -> None:
+        conn.execute(
+            f"INSERT OR REPLACE INTO tasks ({', '.join(TASK_FIELDS)}) "
+            f"VALUES ({', '.join('?' * len(TASK_FIELDS))})",
+            [task[field] for field in TASK_FIELDS],
+        )
+
+    def create(
+        self,
+        task_id,
+        name: str,
+        key: str | None = None,
+        version: str | None = None,
+        stale_seconds: float | None = None,
+    ) -> Dict:
+        now = self.clock()
+        task = new_task(str(task_id), name, now, key, version)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if key is not None:
+                previous = self._select(conn, key, now, column="key")
+                reusable = reuse(previous, version, now, stale_seconds)
+                if reusable:
+                    conn.execute("COMMIT")
+                    return previous
+                if reusable is None:
+                    self._write(conn, _abandoned(previous, now))
+            self._write(conn, task)
+            conn.execute(
+                "DELETE FROM tasks WHERE updated_at < ?", (now - self.ttl_seconds,)
+            )
+            conn.execute(
+                "DELETE FROM tasks WHERE task_id IN (SELECT task_id FROM tasks "
+                "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_tasks,),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return task
+
+    def update(self, task_id, if_status=None, **fields) -> Dict | None:
+        now = self.clock()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            task = self._select(conn, str(task_id), now)
+            if task is not None and (if_status is None or task["status"] in if_status):
+                task = apply_update(task, fields, now)
+                self._write(conn, task)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return task
+
+    def claim(
+        self, task_id, limit: int, stale_seconds: float | None = None
+    ) -> Dict | None:
+        now = self.clock()
+        since = now - min(self.ttl_seconds, stale_seconds or self.ttl_seconds)
+        conn = self._connect()
+        # Counting and starting in one write transaction: two processes
+        # cannot both take the last slot
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            task = self._select(conn, str(task_id), now)
+            if task is not None and task["status"] == "pending":
+                (running,) = conn.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE name = ? "
+                    f"AND status IN ({', '.join('?' * len(RUNNING))}) "
+                    "AND updated_at >= ?",
+                    (task["name"], *RUNNING, since),
+                ).fetchone()
+                if running < limit:
+                    task = apply_update(task, {"status": "running"}, now)
+                    self._write(conn, task)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return task
+
+    def get(self, task_id) -> Dict | None:
+        return self._select(self._connect(), str(task_id), self.clock())
+
+
+def open_task_store(url: str = "memory", **options) -> TaskStore:
+    """Task store for url: "memory", or "sqlite:///path/to/tasks.db".
+    options are passed on to the store."""
+    if url == "memory":
+        return MemoryTaskStore(**options)
+    if url.startswith("sqlite:///"):
+        return SqliteTaskStore(Path(url[len("sqlite:///") :]), **options)
+    raise ValueError(f"Unknown task store: {url}")
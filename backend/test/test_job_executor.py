@@ -0,0 +1,188 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from job_executor import JobExecutor
+from task_store import MemoryTaskStore
+
+
+def record_job(context, log: str, name: str, release: str | None = None):
+    """Append name to log, then wait until release exists"""
+    with open(log, "a") as f:
+        f.write(name + "\n")
+    while release is not None and not Path(release).exists():
+        context.check()
+        time.sleep(0.02)
+
+
+def progress_job(context):
+    context.progress(50)
+
+
+def failing_job(context):
+    raise ValueError("bad quarter")
+
+
+class TestJobExecutor(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log = str(Path(self.temp_dir.name) / "log")
+        self.release = Path(self.temp_dir.name) / "release"
+        self.store = MemoryTaskStore()
+        self.executor = JobExecutor(
+            self.store, limits={"transform": 1}, default_limit=2, poll_seconds=0.05
+        )
+
+    def tearDown(self):
+        self.executor.shutdown(wait_seconds=5)
+        self.temp_dir.cleanup()
+
+    def wait_for(self, task_id, statuses=("success", "failed", "cancelled")):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            task = self.store.get(task_id)
+            if task["status"] in statuses:
+                return task
+            time.sleep(0.02)
+        self.fail(f"Task {task_id} still {task['status']}")
+
+    def test_limit_and_priority(self):
+        """Test a job type runs within its limit, highest priority first"""
+        first = self.executor.submit(
+            "transform", record_job, self.log, "first", str(self.release)
+        )
+        self.wait_for(first, ["running"])
+        low = self.executor.submit("transform", record_job, self.log, "low")
+        high = self.executor.submit(
+            "transform", record_job, self.log, "high", priority=5
+        )
+        time.sleep(0.2)
+        self.assertEqual(self.store.get(low)["status"], "pending")
+        self.assertEqual(self.executor.running(), {"transform": 1})
+
+        self.release.touch()
+        for task_id in [first, high, low]:
+            self.assertEqual(self.wait_for(task_id)["status"], "success")
+        self.assertEqual(Path(self.log).read_text().split(), ["first", "high", "low"])
+
+    def test_cancel(self):
+        """Test queued jobs are dropped and running ones stop cooperatively"""
+        running = self.executor.submit(
+            "transform", record_job, self.log, "running", str(self.release)
+        )
+        self.wait_for(running, ["running"])
+        queued = self.executor.submit("transform", record_job, self.log, "queued")
+
+        self.assertEqual(self.executor.cancel(queued)["status"], "cancelled")
+        self.assertEqual(self.executor.cancel(running)["status"], "cancelling")
+        self.assertEqual(self.wait_for(running)["status"], "cancelled")
+        self.assertEqual(Path(self.log).read_text().split(), ["running"])
+        self.assertIsNone(self.executor.cancel("unknown"))
+
+    def test_cancel_through_store(self):
+        """Test a cancel recorded in the store by another executor is seen"""
+        running = self.executor.submit(
+            "transform", record_job, self.log, "running", str(self.release)
+        )
+        self.wait_for(running, ["running"])
+        JobExecutor(self.store).cancel(running)
+
+        self.assertEqual(self.wait_for(running)["status"], "cancelled")
+
+    def test_limit_across_executors(self):
+        """Test executors sharing a store share a job type's limit"""
+        other = JobExecutor(self.store, limits={"transform": 1}, poll_seconds=0.05)
+        try:
+            first = self.executor.submit(
+                "transform", record_job, self.log, "first", str(self.release)
+            )
+            self.wait_for(first, ["running"])
+            second = other.submit("transform", record_job, self.log, "second")
+            time.sleep(0.3)
+            self.assertEqual(self.store.get(second)["status"], "pending")
+            self.assertEqual(other.running(), {})
+
+            self.release.touch()
+            for task_id in [first, second]:
+                self.assertEqual(self.wait_for(task_id)["status"], "success")
+            self.assertEqual(Path(self.log).read_text().split(), ["first", "second"])
+        finally:
+            other.shutdown(wait_seconds=5)
+
+    def test_cancel_finished(self):
+        """Test cancelling a finished job leaves its status alone"""
+        task_id = self.executor.submit("download", progress_job)
+        self.wait_for(task_id)
+
+        self.assertEqual(self.executor.cancel(task_id)["status"], "success")
+        self.assertEqual(JobExecutor(self.store).cancel(task_id)["status"], "success")
+        self.assertEqual(self.store.get(task_id)["status"], "success")
+
+    def test_progress_and_failure(self):
+        """Test progress and errors of jobs are recorded"""
+        progress = self.executor.submit("download", progress_job)
+        failing = self.executor.submit("download", failing_job)
+
+        self.assertEqual(self.wait_for(progress)["progress"], 100)
+        task = self.wait_for(failing)
+        self.assertEqual(task["status"], "failed")
+        self.assertEqual(task["error"], "bad quarter")
+
+    def test_coalescing(self):
+        """Test duplicate submissions share a task until the version changes"""
+        version = Path(self.temp_dir.name) / "version"
+        version.write_text("1")
+
+        def submit():
+            return self.executor.submit(
+                "download",
+                record_job,
+                self.log,
+                "job",
+                str(self.release),
+                key="download:2024q4",
+                version=version.read_text,
+            )
+
+        first = submit()
+        self.assertEqual(submit(), first)
+        self.release.touch()
+        self.wait_for(first)
+        self.assertEqual(submit(), first)
+
+        version.write_text("2")
+        second = submit()
+        self.assertNotEqual(second, first)
+        self.wait_for(second)
+        self.assertEqual(Path(self.log).read_text().split(), ["job", "job"])
+
+    def test_version_changed_while_running(self):
+        """Test a job's result is kept under the version it was submitted
+        with, or the one it finished with if it produces the version"""
+        version = Path(self.temp_dir.name) / "version"
+
+        for produces_version in [False, True]:
+            version.write_text("1")
+            self.release.unlink(missing_ok=True)
+
+            def submit():
+                return self.executor.submit(
+                    "transform",
+                    record_job,
+                    self.log,
+                    "job",
+                    str(self.release),
+                    key=f"transform:{produces_version}",
+                    version=version.read_text,
+                    produces_version=produces_version,
+                )
+
+            first = submit()
+            self.wait_for(first, ["running"])
+            version.write_text("2")
+            self.release.touch()
+            self.assertEqual(self.wait_for(first)["version"], str(produces_version + 1))
+            again = submit()
+            self.assertEqual(again == first, produces_version)
+            self.wait_for(again)
@@ -0,0 +1,48 @@
+import unittest
+from sec_batch import format_report, parse_quarter, quarter_range
+
+
+class TestSECBatch(unittest.TestCase):
+    def test_quarter_range(self):
+        """Test quarter ranges wrap across years"""
+        self.assertEqual(parse_quarter("2024Q4"), (2024, 4))
+        self.assertEqual(
+            quarter_range("2023q3", "2024q2"),
+            [(2023, 3), (2023, 4), (2024, 1), (2024, 2)],
+        )
+        self.assertEqual(quarter_range("2024q2", "2024q1"), [])
+        with self.assertRaises(ValueError):
+            parse_quarter("2024q5")
+
+    def test_format_report(self):
+        """Test the report has a line per quarter and a total"""
+        report = format_report(
+            [
+                {
+                    "year": 2024,
+                    "quarter": 1,
+                    "submissions": 10,
+                    "kept": 2,
+                    "documents": 8,
+                    "facts": 400,
+                    "seconds": 2.0,
+                },
+                {"year": 2024, "quarter": 2, "error": "missing zip"},
+            ],
+            4.0,
+        )
+        lines = report.splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn("2024q1", lines[1])
+        self.assertIn("200", lines[1])
+        self.assertIn("failed: missing zip", lines[2])
+        self.assertTrue(lines[3].startswith("total"))
+
+        report = format_report([], 1.0, peak_rss_mb=512.4)
+        self.assertEqual(
+            report.splitlines()[-1], "peak RSS of the whole process: 512 MB"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
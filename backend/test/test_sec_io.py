@@ -0,0 +1,192 @@
+import unittest
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+from sec_io import (
+    SymbolIndex,
+    load_quarter,
+    load_symbol_index,
+    lookup_symbol,
+    read_quarter,
+)
+
+
+class TestSECQuarterCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.zip_path = self.temp_dir / "2022q1.zip"
+        self.cache_dir = self.temp_dir / "cache" / "2022q1"
+        self.write_zip(values=[1000000, 500000])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_zip(self, values):
+        tables = {
+            "num": pd.DataFrame(
+                {
+                    "adsh": ["0000123456-22-000123"] * 2,
+                    "tag": ["Assets", "Liabilities"],
+                    "value": values,
+                    "uom": ["USD"] * 2,
+                }
+            ),
+            "pre": pd.DataFrame(
+                {
+                    "adsh": ["0000123456-22-000123"] * 2,
+                    "tag": ["Assets", "Liabilities"],
+                    "stmt": ["BS", "BS"],
+                    "plabel": ["Total Assets", "Total Liabilities"],
+                }
+            ),
+            "sub": pd.DataFrame(
+                {
+                    "adsh": ["0000123456-22-000123"],
+                    "cik": [123456],
+                    "name": ["Test Company"],
+                    "countryma": [np.nan],
+                    "cityma": ["New York"],
+                    "period": [20220331],
+                    "fp": ["Q1"],
+                    "fy": [2022],
+                }
+            ),
+            "tag": pd.DataFrame(
+                {"tag": ["Assets", "Liabilities"], "doc": ["Assets", "Liabilities"]}
+            ),
+        }
+        with ZipFile(self.zip_path, "w") as zf:
+            for name, df in tables.items():
+                zf.writestr(f"{name}.txt", df.to_csv(sep="\t", index=False))
+
+    def test_cache_matches_zip(self):
+        """Test that cached tables hold the same data as the zip"""
+        expected = read_quarter(self.zip_path)
+        cached = load_quarter(self.zip_path, cache_dir=self.cache_dir)
+
+        self.assertTrue((self.cache_dir / "num.arrow").exists())
+        self.assertIsInstance(cached["num"]["tag"].dtype, pd.CategoricalDtype)
+        for name in expected:
+            pd.testing.assert_frame_equal(
+                cached[name].astype(object), expected[name].astype(object)
+            )
+
+    def test_arrow_reader_matches_pandas(self):
+        """Test that the Arrow CSV reader returns the same tables"""
+        expected = read_quarter(self.zip_path, reader="pandas")
+        tables = read_quarter(self.zip_path, reader="arrow")
+
+        for name in expected:
+            pd.testing.assert_frame_equal(
+                tables[name].astype(object),
+                expected[name].astype(object),
+                check_dtype=False,
+            )
+
+    def test_cache_invalidated_when_zip_changes(self):
+        """Test that a changed zip rebuilds the cache"""
+        load_quarter(self.zip_path, cache_dir=self.cache_dir)
+        self.write_zip(values=[1, 2])
+        cached = load_quarter(self.zip_path, cache_dir=self.cache_dir)
+
+        self.assertEqual(cached["num"]["value"].tolist(), [1.0, 2.0])
+
+    def test_concurrent_builds(self):
+        """Test processes building the same cache at once all get it whole,
+        also when they replace a stale one"""
+        for values in [[1000000, 500000], [1, 2]]:
+            self.write_zip(values=values)
+            with ThreadPoolExecutor(max_workers=4) as threads:
+                results = list(
+                    threads.map(
+                        lambda _: load_quarter(self.zip_path, cache_dir=self.cache_dir),
+                        range(4),
+                    )
+                )
+            for cached in results:
+                self.assertEqual(cached["num"]["value"].tolist(), values)
+        self.assertEqual(
+            [path.name for path in self.cache_dir.parent.iterdir()], ["2022q1"]
+        )
+
+    def test_contexts(self):
+        """Test that num context columns are read on request, and missing
+        ones come back empty"""
+        plain = load_quarter(self.zip_path, cache_dir=self.cache_dir)
+        cached = load_quarter(self.zip_path, cache_dir=self.cache_dir, contexts=True)
+        tables = read_quarter(self.zip_path, reader="arrow", contexts=True)
+
+        self.assertEqual(list(plain["num"]), ["adsh", "tag", "value", "uom"])
+        for num in [cached["num"], tables["num"]]:
+            self.assertEqual(
+                list(num),
+                ["adsh", "tag", "value", "uom", "ddate", "qtrs", "segments", "coreg"],
+            )
+            self.assertTrue(num["ddate"].isna().all())
+
+
+class TestSymbolIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.ticker_path = self.temp_dir / "ticker.txt"
+        self.ticker_path.write_text(
+            "aapl\t320193\nold\t789019\nmsft\t789019\n"
+            "waytoolongsymbolnameforsure\t1000\nna\t2000\n"
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_resolve(self):
+        """Test bulk resolution by integer CIK with pre-validated symbols"""
+        index = SymbolIndex.read_tickers(self.ticker_path)
+
+        self.assertEqual(len(index), 4)
+        self.assertEqual(
+            index.resolve(
+                pd.Series([320193, 789019, 1000, 2000, 42, np.nan, 999999999])
+            ).tolist(),
+            ["AAPL", "MSFT", "", "NA", None, None, None],
+        )
+        self.assertEqual(index.resolve(["0000320193"]).tolist(), ["AAPL"])
+        self.assertEqual(SymbolIndex.from_dict({}).resolve([320193]).tolist(), [None])
+
+    def test_lookup_symbol(self):
+        """Test a single dict lookup gives what the index resolves"""
+        symbol_dict = {"320193": "aapl", "1000": "waytoolongsymbolnameforsure"}
+        index = SymbolIndex.from_dict(symbol_dict)
+        for cik in [320193, "0000320193", 1000, 42]:
+            self.assertEqual(
+                lookup_symbol(symbol_dict, cik), index.resolve([cik])[0], cik
+            )
+            self.assertEqual(lookup_symbol(index, cik), index.resolve([cik])[0])
+
+    def test_index_rebuilt_when_tickers_change(self):
+        """Test the persisted index is reused until ticker.txt changes"""
+        cache_dir = self.temp_dir / "cache"
+        load_symbol_index(self.ticker_path, cache_dir)
+        self.assertTrue((cache_dir / "symbols.npz").exists())
+        cached = load_symbol_index(self.ticker_path, cache_dir)
+        self.assertEqual(cached.resolve([789019]).tolist(), ["MSFT"])
+
+        self.ticker_path.write_text("goog\t1652044\n")
+        rebuilt = load_symbol_index(self.ticker_path, cache_dir)
+        self.assertEqual(rebuilt.resolve([1652044, 789019]).tolist(), ["GOOG", None])
+
+    def test_concurrent_saves(self):
+        """Test processes saving the index at once never share a temporary file"""
+        index = SymbolIndex.read_tickers(self.ticker_path)
+        path = self.temp_dir / "cache" / "symbols.npz"
+        with ThreadPoolExecutor(max_workers=8) as threads:
+            list(threads.map(lambda _: index.save(path, "hash"), range(16)))
+
+        self.assertEqual(len(SymbolIndex.load(path, "hash")), 4)
+        self.assertEqual([p.name for p in path.parent.iterdir()], ["symbols.npz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
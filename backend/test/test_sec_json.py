@@ -9,13 +9,55 @@ import shutil
 from zipfile import ZipFile
 import requests
 import copy
+import gzip
+import io
+import os
+import pyarrow.parquet as pq
+from collections import Counter
 from sec_json import (
+    transform_quarter,
     transform_to_json,
     process_submission,
+    submission_header,
+    submission_headers,
+    header_documents,
+    partition_by_adsh,
+    primary_contexts,
+    other_contexts_of,
+    iter_num_submissions,
+    plan_batches,
+    parse_shard,
+    in_shard,
+    transform_vectorized,
+    encode_pre,
+    decode_strings,
     SymbolFinancialsSchema,
     FinancialsDataSchema,
     FinancialElementImportSchema,
 )
+from sec_batch import transform_quarters
+from sec_export import (
+    AsyncWriter,
+    ExportWriter,
+    ParquetWriter,
+    expand_labels,
+    get_serializer,
+    merge_manifests,
+    read_labels,
+    serialize_result,
+)
+
+
+def write_quarter(path: Path, df_num, df_pre, df_sub, df_tag) -> None:
+    """Write the tables as a quarterly SEC zip"""
+    with ZipFile(path, "w") as zf:
+        for name, df in [
+            ("num", df_num),
+            ("pre", df_pre),
+            ("sub", df_sub),
+            ("tag", df_tag),
+        ]:
+            zf.writestr(f"{name}.txt", df.to_csv(sep="\t", index=False))
 
 
 class TestSECJsonTransformation(unittest.TestCase):
@@ -105,19 +147,9 @@ class TestSECJsonTransformation(unittest.TestCase):
         cls.df_sym = pd.DataFrame(sym_data)
 
         # Save test data to files
-        with ZipFile(cls.data_dir / "2022q1.zip", "w") as zf:
-            with tempfile.NamedTemporaryFile(mode="w") as f:
-                cls.df_num.to_csv(f.name, sep="\t", index=False)
-                zf.write(f.name, "num.txt")
-            with tempfile.NamedTemporaryFile(mode="w") as f:
-                cls.df_pre.to_csv(f.name, sep="\t", index=False)
-                zf.write(f.name, "pre.txt")
-            with tempfile.NamedTemporaryFile(mode="w") as f:
-                cls.df_sub.to_csv(f.name, sep="\t", index=False)
-                zf.write(f.name, "sub.txt")
-            with tempfile.NamedTemporaryFile(mode="w") as f:
-                cls.df_tag.to_csv(f.name, sep="\t", index=False)
-                zf.write(f.name, "tag.txt")
+        write_quarter(
+            cls.data_dir / "2022q1.zip", cls.df_num, cls.df_pre, cls.df_sub, cls.df_tag
+        )
 
         cls.df_sym.to_csv(
             cls.data_dir / "ticker.txt", sep="\t", index=False, header=False
@@ -160,7 +192,11 @@ class TestSECJsonTransformation(unittest.TestCase):
         }
 
         result = process_submission(
-            submission, dfNum_filtered, dfPre_dict, dfTag_dict, symbol_dict
+            submission,
+            dfNum_filtered,
+            dfPre_dict,
+            dfTag_dict,
+            symbol_dict=symbol_dict,
         )
 
         self.assertIsNotNone(result)
@@ -170,6 +206,810 @@ class TestSECJsonTransformation(unittest.TestCase):
         self.assertEqual(len(result["data"]["bs"]), 2)  # Assets and Liabilities
         self.assertEqual(len(result["data"]["ic"]), 1)  # Revenue
 
+    def test_skipped_reasons(self):
+        """Test skipped submissions are counted by reason"""
+        submission = self.df_sub.iloc[0].to_dict()
+        skipped = Counter()
+        for symbol_dict, fp in [({}, "Q1"), ({"123456": "TEST"}, "Q9")]:
+            self.assertIsNone(
+                process_submission(
+                    {**submission, "fp": fp},
+                    self.df_num,
+                    {},
+                    {},
+                    symbol_dict,
+                    skipped=skipped,
+                )
+            )
+        self.assertEqual(skipped, {"no_symbol": 1, "bad_quarter": 1})
+
+    def test_submission_headers(self):
+        """Test vectorized headers match submission_header row by row"""
+        df_sub = pd.DataFrame(
+            {
+                "adsh": [f"a{i}" for i in range(8)],
+                "cik": [123456, 123456, 123456, 123456, 42, 7, 123456, 123456],
+                "name": ["Test Company"] * 8,
+                "countryma": ["US"] * 8,
+                "cityma": ["New York"] * 8,
+                "period": [
+                    20220331,
+                    20231130,
+                    20240229,
+                    20230229,
+                    20220331,
+                    20220331,
+                    20220630,
+                    20221231,
+                ],
+                "fp": ["Q1", " fy", "H1", "Q1", "Q2", "Q3", "XX", np.nan],
+                "fy": [2022, 2023, np.nan, 2023, 2022, 2022, 2022, 2022],
+            }
+        )
+        symbol_dict = {"123456": "test", "42": "X" * 20}
+
+        headers = submission_headers(df_sub, symbol_dict)
+        documents = list(header_documents(headers))
+        for submission, (adsh, document, skip) in zip(
+            df_sub.to_dict("records"), documents
+        ):
+            skipped = Counter()
+            try:
+                expected = submission_header(submission, symbol_dict, None, skipped)
+            except ValueError:
+                expected, skipped = None, Counter(["error"])
+            self.assertEqual(adsh, submission["adsh"])
+            self.assertEqual(document, expected)
+            self.assertEqual(skip, next(iter(skipped), None))
+
+        self.assertEqual(documents[0][1]["endDate"], "2022-06-29")
+        self.assertEqual(documents[1][1]["endDate"], "2024-11-29")
+        self.assertEqual(documents[2][1]["year"], 0)
+        self.assertEqual(
+            list(headers["skip"]),
+            [
+                None,
+                None,
+                None,
+                "error",
+                "invalid_symbol",
+                "no_symbol",
+                "bad_quarter",
+                "bad_quarter",
+            ],
+        )
+
+    def test_encode_pre(self):
+        """Test the shared pre arrays decode to the pre lookup, per adsh"""
+        dfPre_dict = {
+            ("b", "Assets"): ("BS", "Total Assets"),
+            ("a", "Revenue"): ("IC", np.nan),
+            ("b", "Cash"): ("CF", "Cash"),
+            ("a", "Assets"): ("BS", "Assets, total"),
+        }
+        label_ids = {"Assets, total": 0, "Cash": 1, "Total Assets": 2}
+
+        for ids in (None, label_ids):
+            arrays, ranges = encode_pre(dfPre_dict, ids)
+            self.assertEqual(ranges, {"b": (0, 2), "a": (2, 4)})
+            tags = decode_strings(
+                arrays["pre_tags"], arrays["pre_tag_offsets"], arrays["pre_tag"]
+            )
+            if ids is None:
+                plabels = decode_strings(
+                    arrays["pre_plabels"],
+                    arrays["pre_plabel_offsets"],
+                    arrays["pre_plabel"],
+                )
+            else:
+                texts = {label_id: text for text, label_id in ids.items()}
+                plabels = [texts.get(code, np.nan) for code in arrays["pre_plabel"]]
+            stmts = [["BS", "CF", "IC"][code] for code in arrays["pre_stmt"]]
+            adsh = ["b", "b", "a", "a"]
+            self.assertEqual(
+                {(adsh[i], tags[i]): (stmts[i], plabels[i]) for i in range(len(tags))},
+                dfPre_dict,
+            )
+
+        arrays, ranges = encode_pre({})
+        self.assertEqual(ranges, {})
+        self.assertEqual(len(arrays["pre_tag"]), 0)
+
+    def test_partition_by_adsh(self):
+        """Test that num rows are grouped into contiguous per-submission ranges"""
+        df_num = pd.DataFrame(
+            {
+                "adsh": ["b", "a", "b", "c", "a"],
+                "tag": ["B1", "A1", "B2", "C1", "A2"],
+                "value": [1.0, 2.0, 3.0, 4.0, 5.0],
+                "uom": ["USD"] * 5,
+            }
+        )
+        df_sorted, ranges = partition_by_adsh(df_num)
+
+        self.assertEqual(set(ranges), {"a", "b", "c"})
+        for adsh in ["a", "b", "c"]:
+            start, stop = ranges[adsh]
+            expected = df_num[df_num["adsh"] == adsh]
+            self.assertEqual(
+                df_sorted.iloc[start:stop]["tag"].tolist(), expected["tag"].tolist()
+            )
+
+    def test_primary_contexts(self):
+        """Test only facts of the filing's own period, span and entity are primary"""
+        df_sub = pd.DataFrame(
+            {"adsh": ["a", "b"], "period": [20220331, 20221231], "fp": ["Q1", "FY"]}
+        )
+        df_num = pd.DataFrame(
+            {
+                "adsh": ["a", "a", "a", "a", "a", "b", "b", "c"],
+                "tag": ["Assets"] * 8,
+                "value": [1.0] * 8,
+                "uom": ["USD"] * 8,
+                "ddate": [
+                    20220331,
+                    20220331,
+                    20211231,
+                    20220331,
+                    20220331,
+                    20221231,
+                    20221231,
+                    20220331,
+                ],
+                "qtrs": [0, 1, 0, 4, 1, 4, 1, 0],
+                "segments": [None, None, None, None, "Segment=East;", None, None, None],
+                "coreg": [None] * 8,
+            }
+        )
+
+        mask = primary_contexts(df_num, df_sub)
+
+        self.assertEqual(
+            mask.tolist(), [True, True, False, False, False, True, False, False]
+        )
+
+        contexts = other_contexts_of(
+            df_num[~mask], self.df_pre.assign(adsh="a"), self.df_tag
+        )
+        self.assertEqual(list(contexts), ["a"])
+        self.assertEqual(len(contexts["a"]["bs"]), 3)
+        self.assertEqual(
+            contexts["a"]["bs"][2],
+            {
+                "label": "Total Assets",
+                "concept": "Assets",
+                "info": "Total Assets",
+                "unit": "USD",
+                "value": 1,
+                "ddate": 20220331,
+                "qtrs": 1,
+                "segments": "Segment=East;",
+                "coreg": None,
+            },
+        )
+
+    def test_primary_contexts_year_to_date(self):
+        """Test a 10-Q's year-to-date cash flows are primary, like its quarter"""
+        df_sub = pd.DataFrame({"adsh": ["a"], "period": [20220630], "fp": ["Q2"]})
+        df_num = pd.DataFrame(
+            {
+                "adsh": ["a"] * 4,
+                "tag": ["Revenue", "NetCashProvidedByOperatingActivities"] * 2,
+                "value": [1.0] * 4,
+                "uom": ["USD"] * 4,
+                "ddate": [20220630] * 4,
+                "qtrs": [1, 2, 3, 4],
+                "segments": [None] * 4,
+                "coreg": [None] * 4,
+            }
+        )
+
+        mask = primary_contexts(df_num, df_sub)
+
+        self.assertEqual(mask.tolist(), [True, True, False, False])
+
+    def test_iter_num_submissions_select(self):
+        """Test streaming keeps only the selected rows of each chunk"""
+        num_txt = (
+            "adsh\ttag\tversion\tddate\tqtrs\tuom\tsegments\tcoreg\tvalue\n"
+            "a\tAssets\tus-gaap\t20220331\t0\tUSD\t\t\t1\n"
+            "a\tAssets\tus-gaap\t20211231\t0\tUSD\t\t\t2\n"
+            "b\tRevenue\tus-gaap\t20220331\t1\tUSD\tSegment=East;\t\t3\n"
+        )
+        submissions = list(
+            iter_num_submissions(
+                io.StringIO(num_txt),
+                chunk_rows=2,
+                select=lambda chunk: (chunk["ddate"] == 20220331).to_numpy()
+                & chunk["segments"].isna().to_numpy(),
+            )
+        )
+
+        self.assertEqual(submissions, [("a", [("Assets", 1.0, "USD")])])
+
+    def test_vectorized_engine_matches_process_submission(self):
+        """Test that the join-based engine builds the same documents"""
+        symbol_dict = {
+            str(cik): str(symbol)
+            for cik, symbol in zip(self.df_sym["cik"], self.df_sym["symbol"])
+        }
+        dfPre_dict = {
+            (row["adsh"], row["tag"]): (row["stmt"], row["plabel"])
+            for _, row in self.df_pre.iterrows()
+        }
+        dfTag_dict = dict(zip(self.df_tag["tag"], self.df_tag["doc"]))
+
+        expected = process_submission(
+            self.df_sub.iloc[0].to_dict(),
+            self.df_num,
+            dfPre_dict,
+            dfTag_dict,
+            symbol_dict,
+        )
+        results = list(
+            transform_vectorized(
+                self.df_num, self.df_pre, self.df_sub, self.df_tag, symbol_dict
+            )
+        )
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(json.dumps(results[0][1]), json.dumps(expected))
+
+    def test_iter_num_submissions(self):
+        """Test streaming num.txt into per-submission fact lists"""
+        num_txt = (
+            "adsh\ttag\tvalue\tuom\n"
+            "a\tAssets\t1\tUSD\n"
+            "a\tLiabilities\t\tUSD\n"
+            "a\tRevenue\t3\tUSD\n"
+            "b\tAssets\t4\tUSD\n"
+            "c\tAssets\t5\tUSD\n"
+        )
+        submissions = list(iter_num_submissions(io.StringIO(num_txt), chunk_rows=2))
+
+        self.assertEqual([adsh for adsh, _ in submissions], ["a", "b", "c"])
+        self.assertEqual(
+            submissions[0][1], [("Assets", 1.0, "USD"), ("Revenue", 3.0, "USD")]
+        )
+
+        ungrouped = num_txt + "a\tOther\t6\tUSD\n"
+        with self.assertRaises(ValueError):
+            list(iter_num_submissions(io.StringIO(ungrouped), chunk_rows=2))
+
+    def test_plan_batches(self):
+        """Test size-balanced, largest-first work units"""
+        sizes = {"small1": 2, "big": 50, "small2": 3, "medium": 8, "empty": 0}
+        batches = plan_batches(sizes, batch_facts=10)
+
+        self.assertEqual(batches[0], ["big"])
+        self.assertEqual(sorted(sum(batches, [])), sorted(sizes))
+        for batch in batches[:-1]:
+            self.assertGreaterEqual(sum(max(sizes[a], 1) for a in batch), 10)
+
+    def test_transform_to_json_engines(self):
+        """Test that all engines export identical files"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            outputs = {}
+            for engine in ["pool", "vectorized", "streaming"]:
+                shutil.rmtree(self.export_dir / "2022q1", ignore_errors=True)
+                self.assertEqual(
+                    transform_to_json(2022, 1, engine=engine, max_workers=2), 0
+                )
+                outputs[engine] = {
+                    p.name: p.read_text()
+                    for p in (self.export_dir / "2022q1").glob("*.json")
+                }
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(list(outputs["pool"]), ["TEST_Q1_2022.json"])
+        self.assertEqual(outputs["pool"], outputs["vectorized"])
+        self.assertEqual(outputs["pool"], outputs["streaming"])
+        data = json.loads(outputs["pool"]["TEST_Q1_2022.json"])
+        self.assertEqual(len(data["data"]["bs"]), 2)
+        self.assertEqual(len(data["data"]["ic"]), 1)
+
+    def test_transform_to_json_ndjson_shards(self):
+        """Test NDJSON shard output and its manifest"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q1"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            transform_to_json(2022, 1, max_workers=2)
+            expected = (quarter_dir / "TEST_Q1_2022.json").read_text()
+
+            shutil.rmtree(quarter_dir)
+            transform_to_json(
+                2022, 1, max_workers=2, output="ndjson", compression="gzip"
+            )
+            with open(quarter_dir / "manifest.jsonl") as f:
+                manifest = [json.loads(line) for line in f]
+            with gzip.open(quarter_dir / manifest[0]["shard"], "rt") as f:
+                lines = f.read().splitlines()
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(len(manifest), 1)
+        self.assertEqual(manifest[0]["symbol"], "TEST")
+        self.assertEqual(manifest[0]["quarter"], "Q1")
+        self.assertEqual(manifest[0]["year"], 2022)
+        self.assertEqual(manifest[0]["offset"], 0)
+        self.assertEqual(lines, [expected])
+
+    def test_shards(self):
+        """Test every adsh falls in exactly one shard"""
+        self.assertEqual(parse_shard("2/8"), (2, 8))
+        for text in ["0/8", "9/8", "2"]:
+            with self.assertRaises(ValueError):
+                parse_shard(text)
+
+        adsh = [f"0000123456-22-{i:06d}" for i in range(100)]
+        masks = [in_shard(adsh, (index, 3)) for index in [1, 2, 3]]
+        self.assertTrue((sum(mask.astype(int) for mask in masks) == 1).all())
+        self.assertTrue(all(mask.any() for mask in masks))
+
+    def test_transform_to_json_sharded(self):
+        """Test shards of a quarter write partial manifests that merge into
+        the manifest of an unsharded run"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q1"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            transform_to_json(2022, 1, max_workers=2, output="ndjson")
+            with open(quarter_dir / "manifest.jsonl") as f:
+                expected = [json.loads(line) for line in f]
+
+            shutil.rmtree(quarter_dir)
+            stats = [
+                transform_quarter(
+                    2022, 1, max_workers=2, output="ndjson", shard=(index, 2)
+                )
+                for index in [1, 2]
+            ]
+            with self.assertRaises(FileNotFoundError):
+                merge_manifests(quarter_dir, 3)
+            entries = merge_manifests(quarter_dir, 2)
+            with open(quarter_dir / "manifest.jsonl") as f:
+                manifest = [json.loads(line) for line in f]
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(entries, 1)
+        self.assertEqual(sorted(s["documents"] for s in stats), [0, 1])
+        self.assertEqual(stats[0]["shard"], "1/2")
+        self.assertRegex(manifest[0].pop("shard"), r"^part-[12]-of-2-00000\.ndjson$")
+        expected[0].pop("shard")
+        self.assertEqual(manifest, expected)
+
+    def test_transform_to_json_parquet(self):
+        """Test the Parquet export holds one row per fact by statement"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q1"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            transform_to_json(2022, 1, max_workers=2, labels="dictionary")
+            expected = json.loads((quarter_dir / "TEST_Q1_2022.json").read_text())
+
+            shutil.rmtree(quarter_dir)
+            transform_to_json(2022, 1, max_workers=2, output="parquet")
+            tables = {
+                stmt: pq.read_table(quarter_dir / "parquet" / stmt / "part.parquet")
+                for stmt in ["bs", "cf", "ic"]
+            }
+            labels = read_labels(quarter_dir)
+            with open(quarter_dir / "manifest.jsonl") as f:
+                manifest = [json.loads(line) for line in f]
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(tables["cf"].num_rows, 0)
+        for stmt in ["bs", "ic"]:
+            rows = tables[stmt].to_pylist()
+            self.assertEqual(
+                [(row["concept"], row["label_id"], row["value"]) for row in rows],
+                [
+                    (fact["concept"], fact["label"], fact["value"])
+                    for fact in expected["data"][stmt]
+                ],
+            )
+        row = tables["bs"].to_pylist()[0]
+        self.assertEqual(row["symbol"], "TEST")
+        self.assertEqual(row["stmt"], "bs")
+        self.assertEqual(row["endDate"].isoformat(), expected["endDate"])
+        self.assertEqual(labels[row["label_id"]], "Total Assets")
+        self.assertEqual(manifest[0]["rows"], 3)
+
+    def test_transform_to_json_parquet_failed_run(self):
+        """Test a failed or cancelled run leaves the previous table in place"""
+
+        def cancel(percent):
+            raise RuntimeError("cancelled")
+
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q1"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            transform_to_json(2022, 1, max_workers=2, output="parquet")
+            table_path = quarter_dir / "parquet" / "bs" / "part.parquet"
+            expected = (
+                table_path.read_bytes(),
+                (quarter_dir / "manifest.jsonl").read_text(),
+            )
+
+            for engine in ["pool", "vectorized", "streaming"]:
+                with self.assertRaises(RuntimeError):
+                    transform_to_json(
+                        2022,
+                        1,
+                        engine=engine,
+                        max_workers=2,
+                        output="parquet",
+                        mode="full",
+                        progress=cancel,
+                    )
+            after = (
+                table_path.read_bytes(),
+                (quarter_dir / "manifest.jsonl").read_text(),
+            )
+            leftovers = list(quarter_dir.glob("parquet/*/*.tmp"))
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(after, expected)
+        self.assertEqual(leftovers, [])
+
+    def test_transform_to_json_parquet_missing_doc(self):
+        """Test a tag without a doc exports a null label_id on every engine"""
+        write_quarter(
+            self.data_dir / "2022q3.zip",
+            self.df_num,
+            self.df_pre,
+            self.df_sub,
+            self.df_tag.assign(doc=["Total Assets", "Total Liabilities", np.nan]),
+        )
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q3"
+            label_ids = {}
+            for engine in ["pool", "vectorized", "streaming"]:
+                shutil.rmtree(quarter_dir, ignore_errors=True)
+                transform_to_json(
+                    2022, 3, engine=engine, max_workers=2, output="parquet"
+                )
+                table = pq.read_table(quarter_dir / "parquet" / "ic" / "part.parquet")
+                label_ids[engine] = table.column("label_id").to_pylist()
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(label_ids["pool"], [None])
+        self.assertEqual(label_ids["pool"], label_ids["vectorized"])
+        self.assertEqual(label_ids["pool"], label_ids["streaming"])
+
+    def test_transform_to_json_incremental(self):
+        """Test reruns keep unchanged submissions and redo the rest"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q1"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            output = quarter_dir / "TEST_Q1_2022.json"
+
+            transform_to_json(2022, 1, max_workers=2)
+            expected = output.read_text()
+            with open(quarter_dir / "manifest.jsonl") as f:
+                manifest = [json.loads(line) for line in f]
+
+            output.write_text("kept")
+            transform_to_json(2022, 1, max_workers=2)
+            kept = output.read_text()
+            transform_to_json(2022, 1, max_workers=2, engine="vectorized")
+            kept_vectorized = output.read_text()
+
+            (quarter_dir / "manifest.jsonl").write_text("")
+            transform_to_json(2022, 1, max_workers=2, mode="resume")
+            resumed = output.read_text()
+
+            output.write_text("kept")
+            transform_to_json(2022, 1, max_workers=2, mode="full")
+            full = output.read_text()
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(len(manifest), 1)
+        self.assertEqual(len(manifest[0]["fingerprint"]), 16)
+        self.assertEqual(kept, "kept")
+        self.assertEqual(kept_vectorized, "kept")
+        self.assertEqual(resumed, expected)
+        self.assertEqual(full, expected)
+
+    def test_transform_to_json_incremental_ndjson(self):
+        """Test an NDJSON rerun re-exports the whole shard of a changed
+        submission and drops shards torn by a crash"""
+        second = "0000123456-22-000124"
+        df_num = pd.concat([self.df_num, self.df_num.assign(adsh=second)])
+        df_pre = pd.concat([self.df_pre, self.df_pre.assign(adsh=second)])
+        df_sub = pd.concat([self.df_sub, self.df_sub.assign(adsh=second)])
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q4"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            zip_path = self.data_dir / "2022q4.zip"
+            write_quarter(zip_path, df_num, df_pre, df_sub, self.df_tag)
+            transform_to_json(2022, 4, max_workers=2, output="ndjson")
+
+            changed = df_num.assign(
+                value=np.where(df_num["adsh"] == second, 1, df_num["value"])
+            )
+            write_quarter(zip_path, changed, df_pre, df_sub, self.df_tag)
+            (quarter_dir / "shard-00007.ndjson").write_text('{"torn"')
+            stats = transform_quarter(2022, 4, max_workers=2, output="ndjson")
+
+            with open(quarter_dir / "manifest.jsonl") as f:
+                manifest = [json.loads(line) for line in f]
+            lines = []
+            for path in sorted(quarter_dir.glob("*.ndjson")):
+                lines += [json.loads(line) for line in path.read_text().splitlines()]
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(stats["kept"], 0)
+        self.assertEqual(len(manifest), 2)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(
+            sorted(fact["value"] for line in lines for fact in line["data"]["bs"]),
+            [1, 1, 500000, 1000000],
+        )
+
+    def test_transform_to_json_label_dictionary(self):
+        """Test label dictionary output expands back to the inline documents"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2022q1"
+            output = quarter_dir / "TEST_Q1_2022.json"
+            shutil.rmtree(quarter_dir, ignore_errors=True)
+            transform_to_json(2022, 1, max_workers=2)
+            expected = json.loads(output.read_text())
+
+            documents = {}
+            # Pool last: streaming writes no fingerprints to keep entries by
+            for engine in ["streaming", "vectorized", "pool"]:
+                transform_to_json(
+                    2022, 1, engine=engine, max_workers=2, labels="dictionary"
+                )
+                documents[engine] = json.loads(output.read_text())
+            labels = read_labels(quarter_dir)
+
+            stats = transform_quarter(2022, 1, max_workers=2, labels="dictionary")
+            transform_to_json(2022, 1, max_workers=2)
+            sidecar_removed = not (quarter_dir / "labels.jsonl").exists()
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(documents["pool"], documents["vectorized"])
+        self.assertEqual(documents["pool"], documents["streaming"])
+        self.assertIsInstance(documents["pool"]["data"]["bs"][0]["label"], int)
+        self.assertEqual(expand_labels(documents["pool"], labels), expected)
+        self.assertEqual(sorted(labels), labels)
+        self.assertEqual(stats["kept"], 1)
+        self.assertTrue(sidecar_removed)
+
+    def test_transform_to_json_other_contexts_label_dictionary(self):
+        """Test otherContexts labels expand back to the inline documents"""
+        df_num = pd.DataFrame(
+            {
+                "adsh": ["0000123456-22-000123"] * 4,
+                "tag": ["Assets", "Assets", "Liabilities", "Revenue"],
+                "version": ["us-gaap"] * 4,
+                "ddate": [20220331, 20211231, 20220331, 20220331],
+                "qtrs": [0, 0, 0, 1],
+                "uom": ["USD"] * 4,
+                "segments": [None, None, "Segment=East;", None],
+                "coreg": [None] * 4,
+                "value": [1000000, 900000, 500000, 750000],
+            }
+        )
+        write_quarter(
+            self.data_dir / "2021q1.zip", df_num, self.df_pre, self.df_sub, self.df_tag
+        )
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            quarter_dir = self.export_dir / "2021q1"
+            output = quarter_dir / "TEST_Q1_2022.json"
+            documents = {}
+            for engine in ["pool", "vectorized"]:
+                for labels in ["inline", "dictionary"]:
+                    transform_to_json(
+                        2021,
+                        1,
+                        engine=engine,
+                        max_workers=2,
+                        mode="full",
+                        labels=labels,
+                        facts="primary",
+                        other_contexts=True,
+                    )
+                    documents[engine, labels] = json.loads(output.read_text())
+            dictionary = read_labels(quarter_dir)
+        finally:
+            os.chdir(cwd)
+
+        for engine in ["pool", "vectorized"]:
+            expected = documents[engine, "inline"]
+            self.assertEqual(len(expected["otherContexts"]["bs"]), 2)
+            self.assertIsInstance(
+                documents[engine, "dictionary"]["otherContexts"]["bs"][0]["label"], int
+            )
+            self.assertEqual(
+                expand_labels(documents[engine, "dictionary"], dictionary), expected
+            )
+
+    def test_parquet_other_contexts_rejected(self):
+        """Test other_contexts is refused for Parquet, which cannot hold it"""
+        with self.assertRaises(ValueError):
+            transform_quarter(
+                2022, 1, output="parquet", facts="primary", other_contexts=True
+            )
+
+    def test_run_report(self):
+        """Test a run writes its stage timings and counts to a report"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            shutil.rmtree(self.export_dir / "2022q1", ignore_errors=True)
+            stats = transform_quarter(2022, 1, max_workers=2, mode="full")
+            with open(self.export_dir / "reports" / "2022q1.json") as f:
+                report = json.load(f)
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(report, stats)
+        self.assertEqual(report["documents"], 1)
+        self.assertEqual(
+            set(report["stages"]),
+            {
+                "zip_read",
+                "preprocess",
+                "dict_build",
+                "dispatch",
+                "worker_compute",
+                "write",
+            },
+        )
+        self.assertGreater(report["stages"]["zip_read"]["peak_rss_mb"], 0)
+        self.assertEqual(report["counts"]["exported"], 1)
+        self.assertEqual(report["counts"]["skipped"], {})
+
+    def test_transform_quarters(self):
+        """Test the batch transform shares one pool across quarters"""
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            shutil.rmtree(self.export_dir / "2022q1", ignore_errors=True)
+            results = transform_quarters(
+                [(2022, 1), (2022, 2)], max_workers=2, max_quarters=2
+            )
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(results[0]["documents"], 1)
+        self.assertEqual(results[0]["kept"], 0)
+        self.assertEqual(results[0]["peak_rss_scope"], "process")
+        self.assertEqual(results[1]["quarter"], 2)
+        self.assertIn("error", results[1])
+
+    def test_async_writer(self):
+        """Test the background writer keeps order and re-raises errors"""
+
+        class ListWriter(ExportWriter):
+            def __init__(self, fail_on=None):
+                self.items = []
+                self.fail_on = fail_on
+                self.closed = False
+
+            def write(self, adsh, result):
+                if adsh == self.fail_on:
+                    raise OSError("disk full")
+                self.items.append((adsh, result))
+
+            def close(self):
+                self.closed = True
+
+        inner = ListWriter()
+        with AsyncWriter(inner, max_queue=2, batch_size=3) as writer:
+            for i in range(10):
+                writer.write(f"a{i}", {"n": i})
+        self.assertTrue(inner.closed)
+        self.assertEqual(
+            [adsh for adsh, _ in inner.items], [f"a{i}" for i in range(10)]
+        )
+        self.assertEqual(writer.stats["written"], 10)
+        self.assertLessEqual(writer.stats["max_queue_depth"], 3)
+
+        with self.assertRaises(OSError):
+            with AsyncWriter(ListWriter(fail_on="a3"), max_queue=2) as writer:
+                for i in range(10):
+                    writer.write(f"a{i}", {"n": i})
+
+    def test_parquet_writer_batches(self):
+        """Test rows written across batches are sorted by symbol, keeping
+        document order within a symbol"""
+
+        def document(symbol, values):
+            return {
+                "symbol": symbol,
+                "year": 2022,
+                "quarter": "Q1",
+                "startDate": "2022-03-31",
+                "endDate": "2022-06-30",
+                "data": {
+                    "bs": [
+                        {"concept": "Assets", "label": 0, "unit": "USD", "value": v}
+                        for v in values
+                    ],
+                    "cf": [],
+                    "ic": [],
+                },
+            }
+
+        export_dir = Path(tempfile.mkdtemp())
+        try:
+            writer = ParquetWriter(export_dir)
+            writer.write_many(
+                [("b1", document("B", [1, 2])), ("a1", document("A", [3]))]
+            )
+            writer.write_many([("b2", document("B", [4]))])
+            writer.write("a2", document("A", [5]))
+            writer.close()
+            table = pq.read_table(export_dir / "parquet" / "bs" / "part.parquet")
+            cf_rows = pq.read_table(export_dir / "parquet" / "cf" / "part.parquet")
+        finally:
+            shutil.rmtree(export_dir)
+
+        self.assertEqual(table.column("symbol").to_pylist(), ["A", "A", "B", "B", "B"])
+        self.assertEqual(table.column("value").to_pylist(), [3, 5, 1, 2, 4])
+        self.assertEqual(table.column("startDate").to_pylist()[0], date(2022, 3, 31))
+        self.assertEqual(cf_rows.num_rows, 0)
+
+    def test_serialize_result(self):
+        """Test newline stripping leaves escaped backslashes intact"""
+        line = serialize_result({"label": "a\r\nb\\nc"})
+        self.assertEqual(json.loads(line), {"label": "a b\\nc"})
+
+    def test_serializers(self):
+        """Test the orjson and stdlib serializers encode the same document"""
+        document = {
+            "symbol": "TEST",
+            "name": "Multi\r\nline",
+            "data": {"bs": [{"label": "a\nb", "value": 2**70}], "cf": [], "ic": []},
+            "otherContexts": {"bs": [{"segments": "Segment=East;\r\n"}]},
+        }
+        expected = {
+            "symbol": "TEST",
+            "name": "Multi line",
+            "data": {"bs": [{"label": "a b", "value": 2**70}], "cf": [], "ic": []},
+            "otherContexts": {"bs": [{"segments": "Segment=East; "}]},
+        }
+        for name in ("stdlib", "orjson"):
+            try:
+                serializer = get_serializer(name)
+            except ImportError:
+                continue
+            encoded = serializer.dumps(document)
+            self.assertNotIn(b"\\n", encoded)
+            self.assertEqual(json.loads(encoded), expected)
+        with self.assertRaises(ValueError):
+            get_serializer("yaml")
+
     def test_transform_to_json(self):
         """Test the complete transformation process"""
         try:
@@ -0,0 +1,78 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from sec_report import RunReport, current_peak_rss_mb
+
+
+class TestRunReport(unittest.TestCase):
+    def test_stages_accumulate(self):
+        """Test repeated stages add up their time and keep the highest peak"""
+        report = RunReport(year=2024)
+        report.add_stage("write", 1.0, 10.0)
+        report.add_stage("write", 0.5, 5.0)
+        with report.stage("dispatch"):
+            pass
+        report.add_worker({"seconds": 2.0, "peak_rss_mb": 50.0, "skipped": {}})
+        report.add_worker(
+            {"seconds": 1.0, "peak_rss_mb": 70.0, "skipped": {"no_symbol": 2}}
+        )
+        report.counters["exported"] += 3
+
+        result = report.to_dict()
+        self.assertEqual(result["year"], 2024)
+        self.assertEqual(
+            result["stages"]["write"], {"seconds": 1.5, "peak_rss_mb": 10.0}
+        )
+        self.assertGreater(result["stages"]["dispatch"]["peak_rss_mb"], 0)
+        self.assertEqual(
+            result["stages"]["worker_compute"], {"seconds": 3.0, "peak_rss_mb": 70.0}
+        )
+        self.assertEqual(result["worker_tasks"], 2)
+        self.assertEqual(result["counts"], {"exported": 3, "skipped": {"no_symbol": 2}})
+
+    def test_process_peaks(self):
+        """Test a report sharing its process keeps the process-wide peak"""
+        data = b"x" * (64 * 1024 * 1024)
+        del data
+        before = current_peak_rss_mb()
+        report = RunReport(stage_peaks=False, year=2024)
+        with report.stage("dispatch"):
+            pass
+
+        result = report.to_dict()
+        self.assertGreaterEqual(
+            result["stages"]["dispatch"]["peak_rss_mb"], round(before, 1)
+        )
+        self.assertEqual(result["peak_rss_scope"], "process")
+        self.assertEqual(RunReport().to_dict()["peak_rss_scope"], "stage")
+
+    def test_progress(self):
+        """Test progress is reported once per whole percent reached"""
+        report = RunReport(year=2024)
+        percents = []
+        report.update_progress()
+        report.track_progress(200, percents.append)
+        for _ in range(5):
+            report.counters["processed"] += 1
+            report.update_progress()
+
+        self.assertEqual(percents, [0, 1, 2])
+
+    def test_write(self):
+        """Test the report is written as JSON, creating its directory"""
+        report = RunReport(year=2024)
+        report.add_stage("write", 1.0)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "reports" / "2024q1.json"
+            report.write(path)
+            self.assertEqual(json.loads(path.read_text()), report.to_dict())
+
+    def test_current_peak_rss(self):
+        """Test the peak RSS grows with allocations"""
+        before = current_peak_rss_mb()
+        data = b"x" * (64 * 1024 * 1024)
+        self.assertGreaterEqual(current_peak_rss_mb(), before)
+        self.assertGreater(current_peak_rss_mb(), 32)
+        del data
@@ -0,0 +1,63 @@
+import unittest
+import os
+import json
+from pathlib import Path
+import tempfile
+import shutil
+from sec_io import read_quarter
+from sec_json import transform_to_json
+from sec_synthetic import filer_universe, generate_dataset, generate_quarter
+
+
+class TestSECSyntheticData(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_generate_quarter(self):
+        """Test generated tables are consistent and reproducible"""
+        filers = filer_universe(0.5, seed=1)
+        tables = generate_quarter(2023, 2, filers, 0.5, seed=1)
+        again = generate_quarter(2023, 2, filers, 0.5, seed=1)
+
+        self.assertEqual(len(tables["sub"]), 50)
+        self.assertTrue(tables["num"].equals(again["num"]))
+        # num rows are grouped by adsh
+        runs = tables["num"]["adsh"].ne(tables["num"]["adsh"].shift()).sum()
+        self.assertEqual(runs, tables["num"]["adsh"].nunique())
+        self.assertTrue(tables["num"]["adsh"].isin(tables["sub"]["adsh"]).all())
+        self.assertTrue(tables["pre"]["adsh"].isin(tables["sub"]["adsh"]).all())
+        self.assertTrue(tables["num"]["tag"].isin(tables["tag"]["tag"]).all())
+        self.assertTrue(tables["sub"]["cik"].isin(filers["cik"]).all())
+
+    def test_generated_dataset_transforms(self):
+        """Test a generated quarter reads and transforms with every engine"""
+        rows = generate_dataset(self.temp_dir / "data", [(2023, 1)], scale=0.2)
+        tables = read_quarter(self.temp_dir / "data" / "2023q1.zip")
+        self.assertEqual(len(tables["num"]), rows[2023, 1])
+
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            outputs = {}
+            for engine in ["pool", "vectorized", "streaming"]:
+                shutil.rmtree(self.temp_dir / "exportfiles", ignore_errors=True)
+                transform_to_json(2023, 1, engine=engine, max_workers=2, cache=False)
+                outputs[engine] = {
+                    p.name: p.read_bytes()
+                    for p in (self.temp_dir / "exportfiles" / "2023q1").glob("*.json")
+                }
+        finally:
+            os.chdir(cwd)
+
+        self.assertGreater(len(outputs["pool"]), 0)
+        self.assertEqual(outputs["pool"], outputs["vectorized"])
+        self.assertEqual(outputs["pool"], outputs["streaming"])
+        for document in outputs["pool"].values():
+            self.assertIn("data", json.loads(document))
+
+
+if __name__ == "__main__":
+    unittest.main()
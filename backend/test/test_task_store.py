@@ -0,0 +1,199 @@
+import tempfile
+import threading
+import unittest
+import uuid
+from pathlib import Path
+
+from task_store import MemoryTaskStore, SqliteTaskStore, open_task_store
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TaskStoreTests:
+    """Tests shared by every task store; make_store(**options) builds one"""
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_lifecycle(self):
+        """Test a task records its status, progress, timestamps and error"""
+        store = self.make_store()
+        task_id = uuid.uuid4()
+        created = store.create(task_id, "transform")
+        self.assertEqual(created["status"], "pending")
+        self.assertEqual(store.get(task_id), created)
+
+        self.clock.now += 1
+        store.update(task_id, status="running")
+        self.clock.now += 1
+        store.update(task_id, progress=40)
+        self.clock.now += 1
+        store.update(task_id, status="failed", error="missing zip")
+
+        task = store.get(str(task_id))
+        self.assertEqual(task["name"], "transform")
+        self.assertEqual(task["status"], "failed")
+        self.assertEqual(task["progress"], 40)
+        self.assertEqual(
+            (task["created_at"], task["started_at"], task["finished_at"]),
+            (1000.0, 1001.0, 1003.0),
+        )
+        self.assertEqual(task["error"], "missing zip")
+        self.assertIsNone(store.update(uuid.uuid4(), status="running"))
+        with self.assertRaises(ValueError):
+            store.update(task_id, status="done")
+
+    def test_success_completes_progress(self):
+        """Test a successful task reports 100 percent"""
+        store = self.make_store()
+        store.create("a", "download")
+        self.assertEqual(store.update("a", status="success")["progress"], 100)
+
+    def test_ttl(self):
+        """Test tasks are forgotten ttl_seconds after their last update"""
+        store = self.make_store(ttl_seconds=60)
+        store.create("old", "download")
+        self.clock.now += 30
+        store.create("new", "download")
+        self.clock.now += 31
+
+        self.assertIsNone(store.get("old"))
+        self.assertIsNotNone(store.get("new"))
+
+    def test_max_tasks(self):
+        """Test only the max_tasks most recently used tasks are kept"""
+        store = self.make_store(max_tasks=2)
+        for task_id in ["a", "b"]:
+            store.create(task_id, "download")
+            self.clock.now += 1
+        store.update("a", progress=10)
+        self.clock.now += 1
+        store.create("c", "download")
+
+        self.assertIsNone(store.get("b"))
+        self.assertIsNotNone(store.get("a"))
+        self.assertIsNotNone(store.get("c"))
+
+    def test_key_coalescing(self):
+        """Test a key's task is reused while in flight or succeeded on the
+        same version, and replaced once failed, changed or stale"""
+        store = self.make_store()
+        first = store.create("a", "transform", key="k", version="v1")
+        self.assertEqual(store.create("b", "transform", key="k")["task_id"], "a")
+        self.assertEqual(store.create("c", "transform", key="other")["task_id"], "c")
+
+        store.update("a", status="success")
+        self.assertEqual(
+            store.create("d", "transform", key="k", version="v1")["task_id"], "a"
+        )
+        self.assertEqual(
+            store.create("e", "transform", key="k", version="v2")["task_id"], "e"
+        )
+        store.update("e", status="failed", error="missing zip")
+        self.assertEqual(
+            store.create("f", "transform", key="k", version="v2")["task_id"], "f"
+        )
+
+        self.clock.now += 60
+        self.assertEqual(
+            store.create("g", "transform", key="k", stale_seconds=30)["task_id"], "g"
+        )
+        self.assertEqual(store.get("f")["status"], "failed")
+        self.assertEqual(first["key"], "k")
+
+    def test_claim(self):
+        """Test a task starts only while its name has a free slot, not
+        counting running tasks gone stale"""
+        store = self.make_store()
+        for task_id, name in [("a", "transform"), ("b", "transform"), ("c", "load")]:
+            store.create(task_id, name)
+
+        self.assertEqual(store.claim("a", 1)["status"], "running")
+        self.assertEqual(store.claim("b", 1)["status"], "pending")
+        self.assertEqual(store.claim("c", 1)["status"], "running")
+        self.assertEqual(store.claim("b", 2)["status"], "running")
+        self.assertEqual(store.claim("a", 5)["status"], "running")
+        self.assertIsNone(store.claim("unknown", 1))
+
+        store.create("d", "transform")
+        self.clock.now += 60
+        store.update("b", status="cancelling")
+        self.assertEqual(store.claim("d", 1, stale_seconds=30)["status"], "pending")
+        self.assertEqual(store.claim("d", 2, stale_seconds=90)["status"], "pending")
+        store.update("b", status="cancelled")
+        self.assertEqual(store.claim("d", 1, stale_seconds=30)["status"], "running")
+
+    def test_conditional_update(self):
+        """Test an update with if_status leaves tasks in other statuses alone"""
+        store = self.make_store()
+        store.create("a", "transform")
+        store.update("a", status="success")
+
+        task = store.update("a", if_status=("running",), status="cancelling")
+        self.assertEqual(task["status"], "success")
+        self.assertEqual(store.get("a")["status"], "success")
+        task = store.update("a", if_status=("success",), progress=50)
+        self.assertEqual(task["progress"], 50)
+
+
+class TestMemoryTaskStore(TaskStoreTests, unittest.TestCase):
+    def make_store(self, **options):
+        return MemoryTaskStore(clock=self.clock, **options)
+
+    def test_keys_forgotten(self):
+        """Test the keys of expired and evicted tasks are dropped with them"""
+        store = self.make_store(max_tasks=2, ttl_seconds=60)
+        store.create("a", "transform", key="a")
+        self.clock.now += 61
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store._keys, {})
+
+        for task_id in "bcd":
+            store.create(task_id, "transform", key=task_id)
+        self.assertEqual(store._keys, {"c": "c", "d": "d"})
+
+
+class TestSqliteTaskStore(TaskStoreTests, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "tasks.db"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_store(self, **options):
+        return SqliteTaskStore(self.path, clock=self.clock, **options)
+
+    def test_shared(self):
+        """Test stores on one database see each other's tasks from any thread"""
+        writer = self.make_store()
+        reader = open_task_store(f"sqlite:///{self.path}", clock=self.clock)
+        writer.create("a", "transform")
+
+        def work():
+            for percent in range(1, 51):
+                writer.update("a", progress=percent)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(reader.get("a")["progress"], 50)
+        self.assertEqual(reader.get("a")["created_at"], 1000.0)
+
+
+class TestOpenTaskStore(unittest.TestCase):
+    def test_unknown(self):
+        """Test unknown store URLs are rejected"""
+        self.assertIsInstance(open_task_store("memory"), MemoryTaskStore)
+        with self.assertRaises(ValueError):
+            open_task_store("redis://localhost")
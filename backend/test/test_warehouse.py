@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import unittest
+
+from warehouse import QueryMetrics, Warehouse, percentile, pool_options
+
+
+class FakePool:
+    """Enough of a SQLAlchemy QueuePool: reuses returned connections"""
+
+    def __init__(self, size: int):
+        self._size = size
+        self.idle = []
+        self.logins = 0
+        self.checked_out = 0
+        self.lock = threading.Lock()
+
+    def size(self):
+        return self._size
+
+    def checkedin(self):
+        return len(self.idle)
+
+    def checkedout(self):
+        return self.checked_out
+
+    def overflow(self):
+        return max(0, self.checked_out + len(self.idle) - self._size)
+
+
+class FakeConnection:
+    def __init__(self, pool: FakePool):
+        self.pool = pool
+
+    def execute(self, sql: str):
+        if sql == "bad":
+            raise ValueError("SQL compilation error")
+        return self
+
+    def fetchall(self):
+        return [(1,)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with self.pool.lock:
+            self.pool.checked_out -= 1
+            self.pool.idle.append(self)
+
+
+class FakeEngine:
+    def __init__(self, pool_size: int = 3):
+        self.pool = FakePool(pool_size)
+        self.disposed = False
+
+    def connect(self):
+        with self.pool.lock:
+            self.pool.checked_out += 1
+            if self.pool.idle:
+                return self.pool.idle.pop()
+            self.pool.logins += 1
+        return FakeConnection(self.pool)
+
+    def dispose(self):
+        self.disposed = True
+
+
+class TestWarehouse(unittest.TestCase):
+    def setUp(self):
+        self.engine = FakeEngine(pool_size=3)
+        self.warehouse = Warehouse(self.engine, max_workers=4)
+
+    def tearDown(self):
+        self.warehouse.close()
+
+    def test_pool_options(self):
+        """Test the engine is configured to check and recycle connections"""
+        options = pool_options(pool_size=2, max_overflow=1, recycle_seconds=60)
+        self.assertEqual(options["pool_size"], 2)
+        self.assertEqual(options["max_overflow"], 1)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["pool_recycle"], 60)
+
+    def test_warm_up(self):
+        """Test warm-up logs in the pool size of connections at once"""
+        self.assertEqual(self.warehouse.warm_up(), 3)
+        self.assertEqual(self.engine.pool.logins, 3)
+        self.assertEqual(
+            self.warehouse.pool_status(),
+            {"size": 3, "checked_in": 3, "checked_out": 0, "overflow": 0},
+        )
+
+    def test_queries_reuse_connections(self):
+        """Test queries reuse pooled connections and are measured"""
+
+        async def run():
+            return await asyncio.gather(
+                *[self.warehouse.execute("select 1") for _ in range(10)]
+            )
+
+        self.warehouse.warm_up()
+        self.assertEqual(asyncio.run(run()), [[(1,)]] * 10)
+        self.assertLessEqual(self.engine.pool.logins, 4)
+        metrics = self.warehouse.metrics.to_dict()
+        self.assertEqual(metrics["queries"], 10)
+        self.assertEqual(metrics["errors"], 0)
+        self.assertIsNotNone(metrics["latency_ms"]["p95"])
+
+        with self.assertRaises(ValueError):
+            asyncio.run(self.warehouse.execute("bad"))
+        self.assertEqual(self.warehouse.metrics.to_dict()["errors"], 1)
+        self.assertEqual(self.engine.pool.checked_out, 0)
+
+    def test_close(self):
+        """Test closing disposes of the pool"""
+        self.warehouse.close()
+        self.assertTrue(self.engine.disposed)
+
+
+class TestQueryMetrics(unittest.TestCase):
+    def test_percentiles(self):
+        """Test nearest-rank percentiles over the latest window"""
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 99), 4)
+
+        metrics = QueryMetrics(window=4)
+        self.assertIsNone(metrics.to_dict()["latency_ms"]["max"])
+        for seconds in [10.0, 0.001, 0.002, 0.003, 0.004]:
+            metrics.record(0.0, seconds)
+        summary = metrics.to_dict()
+        self.assertEqual(summary["queries"], 5)
+        self.assertEqual(summary["latency_ms"]["max"], 4.0)
+        self.assertEqual(summary["latency_ms"]["p50"], 2.0)
+        self.assertAlmostEqual(summary["mean_ms"], 2002.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
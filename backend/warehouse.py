@@ -0,0 +1,170 @@
+"""Runs the API's Snowflake queries on a pool of logged-in connections.
+
+Logging in to Snowflake takes seconds, so connections are kept in the
+engine's pool for the life of the API rather than opened per request
+(see pool_options for the engine settings). Queries run in a thread pool
+no larger than the connection pool, so they never block the event loop
+and no thread waits for a connection another query holds; the latency of
+each is recorded in QueryMetrics.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+def pool_options(
+    pool_size: int = 5,
+    max_overflow: int = 5,
+    recycle_seconds: int = 3600,
+    timeout_seconds: int = 30,
+) -> Dict:
+    """create_engine options for a pool of pool_size connections plus up to
+    max_overflow more under load. Connections are checked before use
+    (pre-ping) and replaced after recycle_seconds, before Snowflake drops
+    idle sessions; a query waits up to timeout_seconds for a connection."""
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_pre_ping": True,
+        "pool_recycle": recycle_seconds,
+        "pool_timeout": timeout_seconds,
+    }
+
+
+def percentile(values: List[float], percent: float) -> float | None:
+    """Nearest-rank percentile of values, None if there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+class QueryMetrics:
+    """Counts of queries and errors, and percentiles of the latencies of
+    the last window queries: how long each waited for a thread and how
+    long it then took, connection checkout included"""
+
+    def __init__(self, window: int = 1000):
+        self.queries = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self._waits = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, wait_seconds: float, seconds: float, ok: bool = True) -> None:
+        with self._lock:
+            self.queries += 1
+            self.errors += not ok
+            self.total_seconds += seconds
+            self._waits.append(wait_seconds)
+            self._latencies.append(seconds)
+
+    def to_dict(self) -> Dict:
+        """The metrics in milliseconds"""
+        with self._lock:
+            waits, latencies = list(self._waits), list(self._latencies)
+            summary = {
+                "queries": self.queries,
+                "errors": self.errors,
+                "mean_ms": (
+                    1000 * self.total_seconds / self.queries if self.queries else None
+                ),
+            }
+        for name, values in [("latency_ms", latencies), ("wait_ms", waits)]:
+            summary[name] = {
+                f"p{percent}": (
+                    None if not values else 1000 * percentile(values, percent)
+                )
+                for percent in (50, 95, 99)
+            }
+            summary[name]["max"] = 1000 * max(values) if values else None
+        return summary
+
+
+class Warehouse:
+    """Queries on engine's connection pool, from at most max_workers
+    threads (default: the pool size; pass pool_size + max_overflow to let
+    queries use the overflow)"""
+
+    def __init__(self, engine, max_workers: int | None = None, window: int = 1000):
+        self.engine = engine
+        self.max_workers = max_workers or engine.pool.size()
+        self.metrics = QueryMetrics(window)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="warehouse"
+        )
+
+    def _query(self, sql: str, submitted: float):
+        start = time.perf_counter()
+        ok = False
+        try:
+            with self.engine.connect() as connection:
+                rows = connection.execute(sql).fetchall()
+            ok = True
+            return rows
+        finally:
+            seconds = time.perf_counter() - start
+            self.metrics.record(start - submitted, seconds, ok)
+            logger.info(
+                f"Query {'took' if ok else 'failed after'} {1000 * seconds:.0f} ms "
+                f"({1000 * (start - submitted):.0f} ms waiting)"
+            )
+
+    async def execute(self, sql: str) -> List:
+        """Rows of sql, run in the query threads"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._query, sql, time.perf_counter()
+        )
+
+    def warm_up(self, connections: int | None = None, timeout_seconds: float = 60):
+        """Log in connections (default: the pool size) at once and return
+        them to the pool; returns the number that logged in"""
+        if connections is None:
+            connections = self.engine.pool.size()
+        connections = min(connections, self.max_workers)
+        if connections <= 0:
+            return 0
+        # Each thread holds its connection until all have one, or they would
+        # all reuse the first
+        barrier = threading.Barrier(connections)
+
+        def hold() -> bool:
+            try:
+                connection = self.engine.connect()
+            except Exception:
+                barrier.abort()
+                logger.exception("Warm-up connection failed")
+                return False
+            with connection:
+                try:
+                    barrier.wait(timeout_seconds)
+                except threading.BrokenBarrierError:
+                    pass
+            return True
+
+        futures = [self._executor.submit(hold) for _ in range(connections)]
+        return sum(future.result() for future in futures)
+
+    def pool_status(self) -> Dict:
+        pool = self.engine.pool
+        return {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+
+    def close(self) -> None:
+        """Wait for running queries, then close every pooled connection"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.engine.dispose()